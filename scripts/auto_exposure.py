@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, mosaic_band_view
+from spectral_stats import NUM_LEVELS, histogram_percentiles
+
+def mosaic_histograms(image, layout=XIMEA_NIR_5X5, step=4, sort_bands=True):
+    """
+    Computes subsampled per-band histograms straight from a RAW8 mosaic,
+    without demosaicing. Every step-th row and column of each band is read
+    through the strided band view, and the band index is folded into the
+    values (band * 256 + level) so all bands are counted by one bincount.
+
+    Parameters:
+    - image: numpy.ndarray
+        RAW8 mosaic of shape (height, width).
+    - layout: MosaicLayout
+    - step: int
+        Subsampling step along both axes of each band (1 reads every pixel).
+    - sort_bands: bool
+        Order the histograms by ascending wavelength.
+
+    Returns:
+    - histograms: numpy.ndarray
+        int64 array of shape (num_bands, 256).
+    """
+
+    p = layout.pattern_size
+    samples = mosaic_band_view(image, layout)[:, :, ::step, ::step]
+    offsets = (np.arange(p * p, dtype=np.uint16) * NUM_LEVELS).reshape(p, p, 1, 1)
+    histograms = np.bincount((samples + offsets).ravel(), minlength=p * p * NUM_LEVELS)
+    histograms = histograms.reshape(p * p, NUM_LEVELS)
+    return histograms[list(layout.sort_order)] if sort_bands else histograms
+
+class AutoExposure:
+    """
+    Closed-loop exposure/gain controller driven by mosaic_histograms.
+
+    The brightest band sets the exposure: its percentile-th level is brought
+    to target. Raw intensities are linear in exposure, so the correction
+    ratio target / level is applied in one step and the loop usually settles
+    in two or three frames. If more than clip_fraction of the pixels of any
+    band are saturated, the level is only known to be at least 255 and the
+    ratio target / (255 * clip_step) is applied instead. Exposure is used
+    first and gain only once exposure is at max_exposure_us (and gain is
+    removed first when reducing).
+
+    Cameras apply a new exposure a few frames late, so frames whose reported
+    exposure/gain differ from the last request by more than 1% / 0.1 dB are
+    ignored. After settle_frames such frames in a row the camera is assumed
+    to have clamped or quantized the request, and the reported exposure/gain
+    are adopted as the current settings.
+
+    Parameters:
+    - target: float
+        Level of the percentile of the brightest band, in DN.
+    - percentile: float
+        Percentile of each band used as its level.
+    - tolerance: float
+        Relative error of the level under which the exposure is kept.
+    - clip_fraction: float
+        Fraction of saturated pixels in a band that counts as clipping.
+    - clip_step: float
+        Extra exposure divisor applied while clipping.
+    - min_exposure_us, max_exposure_us: int
+    - max_gain_db: float
+    - step: int
+        Subsampling step of the histograms.
+    - settle_frames: int
+        Number of consecutive mismatched frames after which the reported
+        settings are adopted.
+    - calibrations: dict, optional
+        FFC ids by the exposure (in us) they were calibrated at.
+    - layout: MosaicLayout
+    """
+
+    def __init__(self, target=180.0, percentile=99.0, tolerance=0.08, clip_fraction=0.001, clip_step=1.5,
+                 min_exposure_us=100, max_exposure_us=500000, max_gain_db=12.0, step=4, settle_frames=3,
+                 calibrations=None, layout=XIMEA_NIR_5X5):
+        self.target = target
+        self.percentile = percentile
+        self.tolerance = tolerance
+        self.clip_fraction = clip_fraction
+        self.clip_step = clip_step
+        self.min_exposure_us = min_exposure_us
+        self.max_exposure_us = max_exposure_us
+        self.max_gain_db = max_gain_db
+        self.step = step
+        self.settle_frames = settle_frames
+        self.calibrations = dict(calibrations or {})
+        self.layout = layout
+
+        self.exposure_us = None
+        self.gain_db = None
+        self.level = None
+        self.clipped_bands = 0
+        self.converged = False
+        self.frames = 0
+        self.adjustments = 0
+        self.mismatched = 0
+
+    def update(self, image, exposure_us, gain_db=0.0):
+        """
+        Measures a frame captured at exposure_us/gain_db.
+
+        Returns:
+        - settings: tuple or None
+            (exposure_us, gain_db) to set on the camera, or None to keep the
+            current settings.
+        """
+        if self.exposure_us is not None and (abs(exposure_us - self.exposure_us) > 0.01 * self.exposure_us
+                                             or abs(gain_db - self.gain_db) > 0.1):
+            # The previous request has not reached the sensor yet (the camera
+            # may round the values slightly), or the camera could not apply it.
+            self.mismatched += 1
+            if self.mismatched < self.settle_frames:
+                return None
+        self.mismatched = 0
+        self.exposure_us, self.gain_db = exposure_us, gain_db
+        self.frames += 1
+
+        histograms = mosaic_histograms(image, self.layout, self.step)
+        count = histograms[0].sum()
+        if count == 0:
+            # Nothing to measure (percentiles of empty bands are NaN).
+            return None
+        self.clipped_bands = int(np.count_nonzero(histograms[:, -1] > self.clip_fraction * count))
+        self.level = int(np.nanmax(histogram_percentiles(histograms, [self.percentile])))
+
+        if self.clipped_bands:
+            # The true level is at least 255, so step below target / 255.
+            ratio = self.target / ((NUM_LEVELS - 1) * self.clip_step)
+        else:
+            ratio = self.target / max(self.level, 1)
+            if abs(ratio - 1.0) <= self.tolerance:
+                self.converged = True
+                return None
+        self.converged = False
+
+        settings = self._apply_ratio(ratio)
+        if settings == (self.exposure_us, self.gain_db):
+            # At a limit: nothing more can be done.
+            return None
+        self.exposure_us, self.gain_db = settings
+        self.adjustments += 1
+        return settings
+
+    def _apply_ratio(self, ratio):
+        # Splits a brightness ratio between gain and exposure, preferring a
+        # low gain: gain is reduced first and increased last.
+        gain_db = self.gain_db
+        if ratio < 1.0 and gain_db > 0.0:
+            gain_db = max(0.0, gain_db + 20.0 * math.log10(ratio))
+            ratio /= 10.0 ** ((gain_db - self.gain_db) / 20.0)
+
+        exposure_us = int(round(min(max(self.exposure_us * ratio, self.min_exposure_us), self.max_exposure_us)))
+        ratio /= exposure_us / self.exposure_us
+
+        if ratio > 1.0 + self.tolerance and exposure_us == self.max_exposure_us:
+            gain_db = min(self.max_gain_db, gain_db + 20.0 * math.log10(ratio))
+        return exposure_us, round(gain_db, 2)
+
+    def matching_calibration(self, exposure_us=None):
+        """
+        Returns the calibration whose exposure is closest (by ratio) to
+        exposure_us, by default the current exposure.
+
+        Returns:
+        - calibration_exposure_us: int or None
+            None without calibrations.
+        - ffc_id: str
+        """
+        exposure_us = self.exposure_us if exposure_us is None else exposure_us
+        if not self.calibrations or not exposure_us:
+            return None, ""
+        exposure = min(self.calibrations, key=lambda calibrated: abs(math.log(calibrated / exposure_us)))
+        return exposure, self.calibrations[exposure]
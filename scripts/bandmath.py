@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import re
+import ast
+import argparse
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, demosaic_array
+
+# Common indices over the NIR sensor bands.
+INDICES = {
+    "nir_ratio": "b951 / b675",
+    "nir_ndi": "(b951 - b675) / (b951 + b675)",
+    "red_edge_ndi": "(b793 - b715) / (b793 + b715)",
+}
+
+_BAND_NAME = re.compile(r"^b(\d+)$")
+
+_BINARY_OPS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+
+_UNARY_OPS = {
+    ast.USub: np.negative,
+}
+
+_FUNCTIONS = {
+    "abs": np.absolute,
+    "sqrt": np.sqrt,
+    "log": np.log,
+    "exp": np.exp,
+    "min": np.minimum,
+    "max": np.maximum,
+}
+
+class BandMath:
+    """
+    Evaluates band-math expressions such as "(b951 - b675) / (b951 + b675)"
+    over hypercubes. Bands are referenced by wavelength as b<nm>; the
+    operators + - * / ** and unary -, numbers, and the functions abs, sqrt,
+    log, exp, min and max are supported.
+
+    The expressions are parsed once into a short register program. Each pass
+    converts a chunk of rows of the bands that are used to float32 once, then
+    runs every expression on the chunk with numpy ufuncs writing into
+    preallocated chunk-sized registers, so no temporary of the full frame size
+    is created, whatever the number of expressions.
+
+    Parameters:
+    - expressions: str, list of str or dict
+        One expression, several expressions, or expressions by name.
+    - layout: MosaicLayout
+    - sort_bands: bool
+        Band order of the hypercubes that will be evaluated.
+    """
+
+    def __init__(self, expressions, layout=XIMEA_NIR_5X5, sort_bands=True):
+        if isinstance(expressions, str):
+            expressions = [expressions]
+        if not isinstance(expressions, dict):
+            expressions = {expression: expression for expression in expressions}
+
+        self.names = list(expressions)
+        self.expressions = list(expressions.values())
+        self.num_bands = layout.num_bands
+        self._wavelengths = {int(w): band for band, w in enumerate(layout.band_wavelengths(sort_bands))}
+
+        # Bands used by any expression, loaded once per chunk.
+        self.bands = []
+        self._programs = []
+        self._num_registers = 0
+        for expression in self.expressions:
+            try:
+                tree = ast.parse(expression, mode="eval")
+            except SyntaxError as e:
+                raise ValueError(f"Invalid band math expression {expression!r}: {e.msg}") from None
+            program = []
+            self._free = []
+            self._used = 0
+            result = self._compile(tree.body, program, expression)
+            if result[0] == "register":
+                # The last instruction computes the result; -1 marks the output.
+                ufunc, operands, _ = program[-1]
+                program[-1] = (ufunc, operands, -1)
+            self._programs.append((program, result))
+            self._num_registers = max(self._num_registers, self._used)
+        del self._free, self._used
+
+    def _compile(self, node, program, expression):
+        # Returns the operand holding the value of node: ("band", slot),
+        # ("register", index) or ("constant", value), and appends the
+        # instructions computing it to program.
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return ("constant", float(node.value))
+
+        if isinstance(node, ast.Name):
+            match = _BAND_NAME.match(node.id)
+            if match is None or int(match.group(1)) not in self._wavelengths:
+                raise ValueError(f"Unknown band {node.id!r} in {expression!r}, expected one of "
+                                 f"{', '.join(f'b{w}' for w in sorted(self._wavelengths))}.")
+            band = self._wavelengths[int(match.group(1))]
+            if band not in self.bands:
+                self.bands.append(band)
+            return ("band", self.bands.index(band))
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPS:
+            return self._emit(_BINARY_OPS[type(node.op)], [node.left, node.right], program, expression)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            return self._emit(_UNARY_OPS[type(node.op)], [node.operand], program, expression)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.UAdd):
+            return self._compile(node.operand, program, expression)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _FUNCTIONS \
+                and not node.keywords:
+            ufunc = _FUNCTIONS[node.func.id]
+            if len(node.args) != ufunc.nin:
+                raise ValueError(f"{node.func.id}() takes {ufunc.nin} arguments in {expression!r}.")
+            return self._emit(ufunc, node.args, program, expression)
+
+        raise ValueError(f"Unsupported syntax {ast.dump(node)} in {expression!r}.")
+
+    def _emit(self, ufunc, nodes, program, expression):
+        operands = [self._compile(node, program, expression) for node in nodes]
+        if all(kind == "constant" for kind, _ in operands):
+            return ("constant", float(ufunc(*(value for _, value in operands))))
+
+        # Reuse a register of an operand, or a free one, for the result.
+        for kind, value in operands:
+            if kind == "register":
+                self._free.append(value)
+        if self._free:
+            register = min(self._free)
+            self._free.remove(register)
+        else:
+            register = self._used
+            self._used += 1
+        program.append((ufunc, operands, register))
+        return ("register", register)
+
+    def evaluate(self, hypercube, chunk_rows=64, out=None):
+        """
+        Evaluates every expression on a hypercube or a stack of hypercubes.
+
+        Parameters:
+        - hypercube: numpy.ndarray
+            Array of shape (num_bands, height, width) or (N, num_bands, height, width).
+        - chunk_rows: int
+            Number of rows evaluated at a time.
+        - out: numpy.ndarray, optional
+            float32 output of the returned shape.
+
+        Returns:
+        - values: numpy.ndarray
+            float32 array of shape (num_expressions, height, width), or
+            (N, num_expressions, height, width) for a stack.
+        """
+
+        cubes = hypercube[None] if hypercube.ndim == 3 else hypercube
+        num_frames, num_bands, height, width = cubes.shape
+        if num_bands != self.num_bands:
+            raise ValueError(f"Expected {self.num_bands} bands, got {num_bands}.")
+        shape = (*hypercube.shape[:-3], len(self.expressions), height, width)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+            raise ValueError(f"Output must be a C-contiguous float32 array of shape {shape}.")
+        values = out.reshape(num_frames, len(self.expressions), height, width)
+
+        size = chunk_rows * width
+        bands = np.empty((len(self.bands), size), dtype=np.float32)
+        registers = np.empty((self._num_registers, size), dtype=np.float32)
+
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for frame, cube in enumerate(cubes):
+                for row in range(0, height, chunk_rows):
+                    rows = min(chunk_rows, height - row)
+                    n = rows * width
+                    for slot, band in enumerate(self.bands):
+                        np.copyto(bands[slot, :n].reshape(rows, width), cube[band, row:row + rows], casting="unsafe")
+
+                    for index, (program, result) in enumerate(self._programs):
+                        # Full-width rows of a C-contiguous output are contiguous,
+                        # so the last instruction writes straight into the output.
+                        chunk = values[frame, index, row:row + rows].reshape(n)
+                        for ufunc, operands, register in program:
+                            arguments = [bands[value, :n] if kind == "band" else
+                                         registers[value, :n] if kind == "register" else value
+                                         for kind, value in operands]
+                            ufunc(*arguments, out=registers[register, :n] if register >= 0 else chunk)
+
+                        kind, value = result
+                        if kind == "constant":
+                            chunk[...] = value
+                        elif kind == "band":
+                            np.copyto(chunk, bands[value, :n])
+
+        return out
+
+    def evaluate_dict(self, hypercube, chunk_rows=64):
+        """
+        Evaluates every expression and returns a dict of the results by name.
+        """
+        values = self.evaluate(hypercube, chunk_rows)
+        return {name: values[..., index, :, :] for index, name in enumerate(self.names)}
+
+def band_math(expression, hypercube, layout=XIMEA_NIR_5X5, sort_bands=True):
+    """
+    Evaluates a single band-math expression on a hypercube (or a stack of
+    them). See BandMath.
+
+    Returns:
+    - values: numpy.ndarray
+        float32 array of shape (height, width), or (N, height, width).
+    """
+    return BandMath(expression, layout, sort_bands).evaluate(hypercube)[..., 0, :, :]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute band-math indices over Ximea mosaic images.")
+    parser.add_argument("images", nargs="+", help="Images to process.")
+    parser.add_argument("-e", "--expression", action="append", metavar="NAME=EXPRESSION",
+                        help=f"Index to compute (default: {', '.join(INDICES)}). May be repeated.")
+    parser.add_argument("--output", help="Save the indices of every image to this .npz file.")
+    args = parser.parse_args()
+
+    expressions = dict(INDICES)
+    if args.expression:
+        expressions = dict(item.split("=", 1) if "=" in item else (item, item) for item in args.expression)
+    band_math_engine = BandMath(expressions)
+
+    results = []
+    for image_path in args.images:
+        values = band_math_engine.evaluate(demosaic_array(image_path))
+        means = np.nanmean(values.reshape(len(expressions), -1), axis=1)
+        print(image_path + ": " + ", ".join(f"{name} {mean:.4f}" for name, mean in zip(expressions, means)))
+        if args.output:
+            results.append(values)
+
+    if args.output:
+        np.savez(args.output, names=np.array(list(expressions)), images=np.array(args.images),
+                 values=np.stack(results))
+
+if __name__ == "__main__":
+    main()
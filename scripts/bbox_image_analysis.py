@@ -2,18 +2,21 @@
 # 1/29/2025
 
 import os
+import argparse
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
-from matplotlib.widgets import RectangleSelector
-from scipy.interpolate import make_interp_spline
 
-from utils import demosaic_ximea_5x5, hypercube_dict_to_array
+from utils import load_raw8_image
+from roi import ROI, load_rois, save_rois, extract_roi_spectra
+from hypercube_cache import HypercubeCache
+from plotting import use_headless, spectral_axes, plot_spectra, show_or_save
 
 class ImageBoxSelector:
-    def __init__(self, image_path):
-        self.image = cv2.imread(image_path)
-        self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+    def __init__(self, image_path, image=None):
+        # The RAW8 mosaic is shown as is, decoded once and handed on to the
+        # spectrum extraction (see select_rois).
+        self.image = load_raw8_image(image_path) if image is None else image
+        # pyplot and its widgets are only imported once a window is needed.
+        import matplotlib.pyplot as plt
         self.fig, self.ax = plt.subplots()
         self.rect_selector = None
         self.box_coords = None
@@ -33,7 +36,10 @@ class ImageBoxSelector:
         """
         Display the image and allow the user to select a bounding box.
         """
-        self.ax.imshow(self.image)
+        import matplotlib.pyplot as plt
+        from matplotlib.widgets import RectangleSelector
+
+        self.ax.imshow(self.image, cmap="gray", vmin=0, vmax=255)
         self.ax.set_title("Draw a box and close the window when done")
 
         # Create RectangleSelector widget
@@ -53,57 +59,37 @@ class ImageBoxSelector:
         """
         return self.box_coords
     
-def plot_spectral_intensities(band_intensities, spectral_range, image_name=""):
+def plot_spectral_intensities(band_intensities, spectral_range, image_name="", output=None):
     """
     Plots the spectral bands of a multispectral image.
     
     Parameters:
-    - band_intensities: numpy.ndarray of shape (height, width, num_bands),
+    - band_intensities: numpy.ndarray of shape (num_bands,),
+      or (num_spectra, num_bands) to draw several spectra at once.
     - spectral_range: numpy.ndarray of shape (num_bands,),
       where each value corresponds to the wavelength of a spectral band.
     - image_name: str, name of the image (default: ""). Used for the plot title.
+    - output: str, path of an image file to save the plot to instead of showing it.
     """
 
-    # Plot the spectral bands with curving lines
-    x = np.arange(len(band_intensities))
-    x_smooth = np.linspace(x.min(), x.max(), 300)
-    band_intensities_smooth = make_interp_spline(x, band_intensities)(x_smooth)
-
     if not image_name:
         image_name = "Spectral Bands"
     else:
         image_name = f"Spectral Bands ({image_name})"
-    
-    # Create a high quality figure
-    plt.figure(figsize=(10, 5), dpi=300)
-    plt.plot(x_smooth, band_intensities_smooth, linewidth=2)
-    plt.plot(x, band_intensities, 'o', color='red')
-    plt.xticks(x, [f"{int(wavelength)} nm" for wavelength in spectral_range], rotation=45)
-    plt.xlabel("Band Index")
-    plt.ylabel("Average Intensity")
-    plt.title("Spectral Bands")
-    plt.grid()
-    
-    # Set y-axis limits from 0 to 255 intensity values
-    plt.ylim(0, 255)
-    
-    plt.show()
-
-if __name__ == "__main__":
-
-    # Bands and pattern size
-    pattern_size = 5
-    spectral_bands = 25
-    spectral_range = np.linspace(665, 960, spectral_bands)
 
-    # Initialize the band intensities
-    folder = "fb_images"
-    image_names = os.listdir("fb_images")
-    # image_names = ["ros image.jpg"]
-    band_intensities = np.zeros((len(image_names), spectral_bands))
+    # Set y-axis limits from 0 to 255 intensity values
+    fig, ax = spectral_axes(spectral_range, title=image_name, ylim=(0, 255))
+    plot_spectra(ax, band_intensities, colors=("C0",), point_color="red")
+    show_or_save(fig, output)
 
-    # Load the image paths
-    for i, image_name in enumerate(image_names):
+def select_rois(folder, image_names, label="roi", images=None):
+    """
+    Asks the user to draw a box on each image and returns the selected ROIs.
+    Images without a box are skipped. The decoded images of the selected
+    ROIs are stored in the images dict, keyed by path, when it is given.
+    """
+    rois = []
+    for image_name in image_names:
         image_path = os.path.join(folder, image_name)
 
         selector = ImageBoxSelector(image_path)
@@ -114,31 +100,51 @@ if __name__ == "__main__":
             print("No box selected.")
             continue
         print(f"Final selected box: {box}")
+        rois.append(ROI(image_path, label, box))
+        if images is not None:
+            images[image_path] = selector.image
+    return rois
+
+def main():
+    parser = argparse.ArgumentParser(description="Average spectrum of boxes drawn on (or loaded for) each image.")
+    parser.add_argument("--folder", default="fb_images", help="Folder of images to draw boxes on.")
+    parser.add_argument("--rois", help="Replay ROIs from a JSON/CSV spec file instead of drawing them.")
+    parser.add_argument("--record", help="Save the drawn ROIs to this JSON spec file.")
+    parser.add_argument("--cache", help="Folder of a hypercube cache reused across runs.")
+    parser.add_argument("--plot", help="Save the plot to this image file instead of showing it.")
+    args = parser.parse_args()
+
+    if args.plot and args.rois:
+        # Nothing to draw interactively, so never open a window.
+        use_headless()
+
+    # Bands
+    spectral_bands = 25
+    spectral_range = np.linspace(665, 960, spectral_bands)
 
-        # Convert the image to a hypercube
-        hypercube_dict = demosaic_ximea_5x5(image_path) # TODO: Fix this function
-        hypercube = hypercube_dict_to_array(hypercube_dict)
-
-        # Extract the selected box from the hypercube
-        x1, y1, x2, y2 = box
-        x1, y1, x2, y2 = x1 // pattern_size, y1 // pattern_size, x2 // pattern_size, y2 // pattern_size
-        selected_box = hypercube[:, y1:y2, x1:x2]
-        print(f"Selected box shape: {selected_box.shape}")
-
-        # Compute the average intensity of each spectral band
-        band_intensities[i] = np.mean(selected_box, axis=(1, 2))
+    images = {}
+    if args.rois:
+        rois = load_rois(args.rois)
+    else:
+        # Load the image names
+        image_names = os.listdir(args.folder)
+        # image_names = ["ros image.jpg"]
+        rois = select_rois(args.folder, image_names, images=images)
+        if args.record:
+            save_rois(args.record, rois)
+            print(f"Saved {len(rois)} ROIs to {args.record}")
+
+    # Compute the average intensity of each spectral band in every box,
+    # reading only the mosaic tiles covered by the box.
+    band_intensities = extract_roi_spectra(rois, cache=HypercubeCache(args.cache) if args.cache else None,
+                                           images=images)
 
     # Compute the average intensity across all images
-    avg_band_intensities = np.mean(band_intensities, axis=0)
+    avg_band_intensities = np.nanmean(band_intensities, axis=0)
 
     # Plot the spectral intensities
-    plot_spectral_intensities(avg_band_intensities, spectral_range, image_name="Average Spectral Intensities")
-
-
-
-
-
-
-
-
+    plot_spectral_intensities(avg_band_intensities, spectral_range, image_name="Average Spectral Intensities",
+                              output=args.plot)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import glob
+import platform
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, demosaic_ximea_5x5, hypercube_dict_to_array, demosaic_ximea_5x5_array, \
+    band_wavelengths, load_raw8_image
+from ffc import FFCCorrector, apply_manual_ffc
+from spectral_stats import SpectralReducer, band_histograms
+from classify import SpectralClassifier, METHODS
+from upsample import demosaic_bilinear
+from bandmath import BandMath, INDICES
+from radiometry import RadiometricCorrector
+from pca import CovarianceAccumulator, SpectralBasis
+from raw_store import RawFrameStore
+from decode import read_raw8, read_many
+
+# Geometry of a full RAW8 frame from the Ximea NIR camera.
+FRAME_HEIGHT = 1088
+FRAME_WIDTH = 2048
+FRAME_BYTES = FRAME_HEIGHT * FRAME_WIDTH
+
+# Relative drop in frames/s (or growth in peak memory) reported as a regression.
+DEFAULT_TOLERANCE = 0.2
+
+# Modules timed by the "imports" group. The core demosaic/FFC modules and the
+# batch scripts must not load any of HEAVY_MODULES at import time.
+CORE_MODULES = ("utils", "decode", "ffc", "spectral_stats", "raw_store", "profiling")
+SCRIPT_MODULES = ("full_image_analysis", "tiled", "classify", "pca", "radiometry", "capture_image",
+                  "multi_capture", "calibration", "bbox_image_analysis", "pos_and_neg", "benchmark")
+HEAVY_MODULES = ("cv2", "matplotlib", "scipy", "PIL", "tifffile")
+
+_IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+def synthetic_frames(num_frames, seed=0):
+    """
+    Generates random RAW8 frames with the real sensor geometry.
+
+    Parameters:
+    - num_frames: int
+        Number of frames to generate.
+    - seed: int
+        Seed for the random number generator.
+
+    Returns:
+    - frames: numpy.ndarray
+        A uint8 array of shape (num_frames, 1088, 2048).
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(num_frames, FRAME_HEIGHT, FRAME_WIDTH), dtype=np.uint8)
+
+def frames_per_second(func, frames, repeats=3):
+    """
+    Times func over every frame and returns the best throughput of several repeats.
+
+    Parameters:
+    - func: callable
+        Called as func(frames) and expected to process all frames.
+    - frames: numpy.ndarray
+        The frames passed to func.
+    - repeats: int
+        Number of timed repeats.
+
+    Returns:
+    - fps: float
+        Frames processed per second in the fastest repeat.
+    """
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(frames)
+        best = min(best, time.perf_counter() - start)
+    return len(frames) / best
+
+def peak_memory(func, frames):
+    """
+    Returns the peak memory (bytes) allocated while running func(frames)
+    once, on top of what was allocated before. numpy arrays are included,
+    as numpy reports its allocations to tracemalloc.
+    """
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        func(frames)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(peak - base, 0)
+
+def measure(func, frames, bytes_per_frame=FRAME_BYTES, repeats=3):
+    """
+    Measures the throughput and peak memory of func over frames.
+
+    Parameters:
+    - func: callable
+        Called as func(frames) and expected to process all frames.
+    - frames: sequence
+        The frames passed to func; only its length is used for the rates.
+    - bytes_per_frame: int
+        Input bytes of one frame, for the MB/s rate (raw mosaic size by default).
+    - repeats: int
+        Number of timed repeats.
+
+    Returns:
+    - result: dict
+        "fps" (frames/s of the fastest repeat), "mb_per_s" and "peak_mb".
+    """
+    fps = frames_per_second(func, frames, repeats)
+    return {
+        "fps": fps,
+        "mb_per_s": fps * bytes_per_frame / 1e6,
+        "peak_mb": peak_memory(func, frames) / 1e6,
+    }
+
+def bench_demosaic(frames):
+    """
+    Compares the dict-based demosaic against the array engine.
+    """
+
+    def dict_only(frames):
+        for frame in frames:
+            demosaic_ximea_5x5(frame)
+
+    dicts = [demosaic_ximea_5x5(frame) for frame in frames]
+
+    def dict_to_array(frames):
+        for hypercube_dict in dicts:
+            hypercube_dict_to_array(hypercube_dict)
+
+    def dict_then_array(frames):
+        for frame in frames:
+            hypercube_dict_to_array(demosaic_ximea_5x5(frame))
+
+    def array_per_frame(frames):
+        for frame in frames:
+            demosaic_ximea_5x5_array(frame)
+
+    def array_batched(frames):
+        demosaic_ximea_5x5_array(frames)
+
+    out = demosaic_ximea_5x5_array(frames)
+
+    def array_batched_reused(frames):
+        demosaic_ximea_5x5_array(frames, out=out)
+
+    return {
+        "demosaic_ximea_5x5 (dict of views)": measure(dict_only, frames),
+        "hypercube_dict_to_array": measure(dict_to_array, frames),
+        "demosaic dict + hypercube_dict_to_array": measure(dict_then_array, frames),
+        "demosaic_ximea_5x5_array (per frame)": measure(array_per_frame, frames),
+        "demosaic_ximea_5x5_array (batched)": measure(array_batched, frames),
+        "demosaic_ximea_5x5_array (batched, reused out)": measure(array_batched_reused, frames),
+    }
+
+def bench_ffc(frames):
+    """
+    Compares the float32 manual FFC against the fixed-point FFCCorrector,
+    on raw frames and per band after demosaicing.
+    """
+    rng = np.random.default_rng(1)
+    dark_field = rng.integers(0, 20, size=frames.shape[1:], dtype=np.uint8)
+    flat_field = rng.integers(120, 250, size=frames.shape[1:], dtype=np.uint8)
+
+    corrector = FFCCorrector(flat_field, dark_field)
+    band_corrector = corrector.demosaiced()
+    cubes = demosaic_ximea_5x5_array(frames)
+    # Corrected into separate buffers, so every repeat corrects the same
+    # uncorrected inputs.
+    out = np.empty_like(frames[0])
+    band_out = np.empty_like(cubes[0])
+
+    def float_path(frames):
+        for frame in frames:
+            apply_manual_ffc(frame, flat_field, dark_field)
+
+    def fixed_point(frames):
+        for frame in frames:
+            corrector.apply(frame, out=out)
+
+    def fixed_point_bands(frames):
+        for cube in cubes:
+            band_corrector.apply(cube, out=band_out)
+
+    return {
+        "apply_manual_ffc (float32)": measure(float_path, frames),
+        "FFCCorrector.apply (reused out)": measure(fixed_point, frames),
+        "FFCCorrector.apply (per band, reused out)": measure(fixed_point_bands, frames),
+    }
+
+def bench_reduction(frames):
+    """
+    Compares separate numpy passes per statistic against the single-pass
+    histogram reducer, on demosaiced hypercubes.
+    """
+    cubes = demosaic_ximea_5x5_array(frames)
+
+    def separate_passes(frames):
+        for cube in cubes:
+            pixels = cube.reshape(cube.shape[0], -1)
+            pixels.mean(axis=1)
+            pixels.var(axis=1)
+            pixels.min(axis=1)
+            pixels.max(axis=1)
+            (pixels == 255).sum(axis=1)
+            for band in pixels:
+                np.bincount(band, minlength=256)
+
+    def single_pass(frames):
+        reducer = SpectralReducer(cubes.shape[1])
+        for cube in cubes:
+            reducer.update(cube)
+        reducer.result()
+
+    return {
+        "band stats (separate passes)": measure(separate_passes, frames),
+        "SpectralReducer.update (single pass)": measure(single_pass, frames),
+    }
+
+def bench_classifier(frames):
+    """
+    Times the per-pixel classifier on full 216 x 409 hypercubes, per method.
+    """
+    cubes = demosaic_ximea_5x5_array(frames)
+    rng = np.random.default_rng(2)
+    positives = rng.uniform(80, 200, size=(14, cubes.shape[1]))
+    negatives = rng.uniform(80, 200, size=(14, cubes.shape[1]))
+
+    results = {}
+    for method in METHODS:
+        classifier = SpectralClassifier(positives, negatives, method=method)
+        scores = np.empty((len(cubes),) + cubes.shape[2:], dtype=np.float32)
+        results[f"SpectralClassifier.score ({method})"] = measure(
+            lambda frames: classifier.score(cubes, out=scores), frames)
+    return results
+
+def bench_band_math(frames):
+    """
+    Compares the INDICES computed with plain numpy expressions on each
+    hypercube against the chunked BandMath evaluator.
+    """
+    cubes = demosaic_ximea_5x5_array(frames)
+    band_math = BandMath(INDICES)
+    out = band_math.evaluate(cubes)
+    wavelengths = list(band_wavelengths())
+
+    def numpy_expressions(frames):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for values, cube in zip(out, cubes):
+                band = lambda nm: cube[wavelengths.index(nm)].astype(np.float32)
+                values[0] = band(951) / band(675)
+                values[1] = (band(951) - band(675)) / (band(951) + band(675))
+                values[2] = (band(793) - band(715)) / (band(793) + band(715))
+
+    def compiled(frames):
+        band_math.evaluate(cubes, out=out)
+
+    return {
+        "band math (numpy expressions)": measure(numpy_expressions, frames),
+        "BandMath.evaluate (chunked)": measure(compiled, frames),
+    }
+
+def bench_radiometry(frames):
+    """
+    Compares per-band float FFC followed by a 25x25 crosstalk matrix written
+    as whole-cube numpy operations against the chunked RadiometricCorrector.
+    """
+    cubes = demosaic_ximea_5x5_array(frames)
+    rng = np.random.default_rng(3)
+    dark_field = rng.integers(0, 20, size=frames.shape[1:], dtype=np.uint8)
+    flat_field = rng.integers(120, 250, size=frames.shape[1:], dtype=np.uint8)
+    matrix = np.linalg.inv(np.eye(cubes.shape[1]) + rng.uniform(0, 0.03, (cubes.shape[1],) * 2))
+    corrector = RadiometricCorrector.from_mosaic(flat_field, dark_field, matrix)
+    out = corrector.apply(cubes)
+
+    def numpy_cube(frames):
+        for cube in cubes:
+            pixels = (cube.astype(np.float32) - corrector.dark) * corrector.gain
+            np.maximum(pixels, 0, out=pixels)
+            np.tensordot(corrector.matrix, pixels, axes=1)
+
+    def chunked(frames):
+        corrector.apply(cubes, out=out)
+
+    return {
+        "per-band FFC + crosstalk (numpy)": measure(numpy_cube, frames),
+        "RadiometricCorrector.apply (chunked GEMM)": measure(chunked, frames),
+    }
+
+def bench_pca(frames):
+    """
+    Compares covariance accumulation and projection onto 5 components written
+    as whole-cube float64 numpy operations against the chunked
+    CovarianceAccumulator and SpectralBasis.transform.
+    """
+    cubes = demosaic_ximea_5x5_array(frames)
+    num_bands = cubes.shape[1]
+    basis = SpectralBasis.fit(CovarianceAccumulator(num_bands, noise=False).update(cubes), 5)
+    out = basis.transform(cubes)
+
+    def numpy_covariance(frames):
+        for cube in cubes:
+            pixels = cube.reshape(num_bands, -1).astype(np.float64)
+            pixels.sum(axis=1)
+            pixels @ pixels.T
+
+    def accumulate(frames):
+        accumulator = CovarianceAccumulator(num_bands, noise=False)
+        for cube in cubes:
+            accumulator.update(cube)
+
+    def numpy_projection(frames):
+        for cube in cubes:
+            np.tensordot(basis.components, cube.astype(np.float32) - basis.mean[:, None, None].astype(np.float32),
+                         axes=1)
+
+    def chunked(frames):
+        basis.transform(cubes, out=out)
+
+    return {
+        "covariance (numpy, float64 cube)": measure(numpy_covariance, frames),
+        "CovarianceAccumulator.update (chunked GEMM)": measure(accumulate, frames),
+        "projection to 5 components (numpy)": measure(numpy_projection, frames),
+        "SpectralBasis.transform (chunked GEMM)": measure(chunked, frames),
+    }
+
+def bench_upsample(frames, max_frames=4):
+    """
+    Times the registered bilinear demosaic against the subsampled array
+    engine. Full resolution is slow enough to only use the first max_frames.
+    """
+    frames = frames[:max_frames]
+    full = np.empty((25, FRAME_HEIGHT - 8, FRAME_WIDTH - 3), dtype=np.uint8)
+
+    def subsampled(frames):
+        for frame in frames:
+            demosaic_ximea_5x5_array(frame)
+
+    def bilinear_band_size(frames):
+        for frame in frames:
+            demosaic_bilinear(frame, scale=1)
+
+    def bilinear_full(frames):
+        for frame in frames:
+            demosaic_bilinear(frame, out=full)
+
+    return {
+        "demosaic_ximea_5x5_array (subsampled)": measure(subsampled, frames),
+        "demosaic_bilinear (registered, band size)": measure(bilinear_band_size, frames),
+        "demosaic_bilinear (registered, full resolution)": measure(bilinear_full, frames),
+    }
+
+def upsample_quality():
+    """
+    Measures how well each demosaic recovers a smooth synthetic scene that is
+    identical in every band: the RMSE of every band against the scene on the
+    full-resolution grid, in DN. The subsampled bands are upsampled by
+    repeating each sample over its 5 x 5 tile, which shows their misregistration.
+
+    Returns:
+    - rmse: dict
+        Mapping of the engine name to the RMSE.
+    """
+    rows, cols = np.mgrid[0:FRAME_HEIGHT, 0:FRAME_WIDTH]
+    scene = 128 + 100 * np.sin(cols / 37.0) * np.cos(rows / 23.0)
+    frame = np.rint(scene).astype(np.uint8)
+    truth = scene[3:1083, 0:2045]
+
+    subsampled = demosaic_ximea_5x5_array(frame).repeat(5, axis=1).repeat(5, axis=2)
+    bilinear = demosaic_bilinear(frame, dtype=np.float32)
+    return {
+        "demosaic_ximea_5x5_array (subsampled, repeated)": np.sqrt(((subsampled - truth) ** 2).mean()),
+        "demosaic_bilinear (registered)": np.sqrt(((bilinear - truth) ** 2).mean()),
+    }
+
+def bench_decode(frames, image_files, max_frames=8):
+    """
+    Times reading RAW8 frames back from disk per format: the real PNG images,
+    and the synthetic frames written as PNG, TIFF, JPEG (quality 95), .npy,
+    headerless .bin and a raw frame store. Each format is decoded with
+    decode.read_raw8 into a reused buffer, whole and cropped to the mosaic
+    window, and with read_many on a thread pool; cv2.imread is the baseline
+    for the image formats. MB/s is the size of the decoded frames.
+    """
+    # Imported here so the other groups run without OpenCV installed.
+    import cv2
+
+    frames = frames[:max_frames]
+    crop = XIMEA_NIR_5X5.crop_slices
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        files = {extension: [] for extension in ("png", "tif", "jpg", "npy", "bin")}
+        store_path = os.path.join(folder, "store")
+        with RawFrameStore.create(store_path, frames.shape[1:]) as writer:
+            for i, frame in enumerate(frames):
+                for extension, paths in files.items():
+                    paths.append(os.path.join(folder, f"{i}.{extension}"))
+                cv2.imwrite(files["png"][-1], frame)
+                cv2.imwrite(files["tif"][-1], frame)
+                cv2.imwrite(files["jpg"][-1], frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+                np.save(files["npy"][-1], frame)
+                frame.tofile(files["bin"][-1])
+                writer.append(frame)
+
+        def imread(paths):
+            for path in paths:
+                cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+        def load_npy(paths):
+            for path in paths:
+                np.load(path)
+
+        def decode_into(paths, crop=None):
+            out = None
+            for path in paths:
+                out = read_raw8(path, out, crop)
+
+        def decode_cropped(paths):
+            decode_into(paths, crop)
+
+        def decode_threaded(paths):
+            read_many(paths)
+
+        def read_store(indices):
+            out = np.empty(frames.shape[1:], dtype=np.uint8)
+            with RawFrameStore(store_path) as reader:
+                for index in indices:
+                    np.copyto(out, reader[index])
+
+        formats = {"PNG (synthetic)": files["png"], "TIFF": files["tif"], "JPEG": files["jpg"],
+                   ".npy": files["npy"], ".bin": files["bin"]}
+        if image_files:
+            formats = {"PNG (fb_images)": image_files, **formats}
+        for name, paths in formats.items():
+            if name in ("PNG (fb_images)", "PNG (synthetic)", "TIFF", "JPEG"):
+                results[f"cv2.imread {name}"] = measure(imread, paths)
+            results[f"read_raw8 {name}"] = measure(decode_into, paths)
+            results[f"read_raw8 {name} cropped"] = measure(decode_cropped, paths)
+            results[f"read_many {name}"] = measure(decode_threaded, paths)
+        results["np.load .npy"] = measure(load_npy, files["npy"])
+        results["RawFrameStore read"] = measure(read_store, range(len(frames)))
+    return results
+
+def bench_real_images(image_files):
+    """
+    Times the full per-image pipeline on the real fb_images PNGs: decode,
+    demosaic and per-band histograms, and the same without decoding.
+    """
+    images = np.stack([load_raw8_image(path) for path in image_files])
+
+    def pipeline(paths):
+        for path in paths:
+            band_histograms(demosaic_ximea_5x5_array(path))
+
+    def in_memory(images):
+        for image in images:
+            band_histograms(demosaic_ximea_5x5_array(image))
+
+    return {
+        "fb_images decode + demosaic + histograms": measure(pipeline, image_files),
+        "fb_images demosaic + histograms": measure(in_memory, images),
+    }
+
+BENCHMARKS = {
+    "demosaic": bench_demosaic,
+    "ffc": bench_ffc,
+    "reduction": bench_reduction,
+    "classifier": bench_classifier,
+    "band_math": bench_band_math,
+    "radiometry": bench_radiometry,
+    "pca": bench_pca,
+    "upsample": bench_upsample,
+}
+
+def import_time(module, repeats=5):
+    """
+    Times importing a module in fresh interpreters, as a script or a worker
+    process pays it, and lists the HEAVY_MODULES it loaded.
+
+    Returns:
+    - seconds: float
+        Fastest import time of the repeats.
+    - heavy: list of str
+    """
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    code = _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+    best, heavy = float("inf"), []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", code], cwd=scripts, capture_output=True, text=True,
+                                check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        best, heavy = min(best, result["seconds"]), result["heavy"]
+    return best, heavy
+
+def bench_imports():
+    """
+    Times the import of numpy, the core modules and the scripts, and checks
+    that none of them loads a heavy module (plotting, GUI, image codecs)
+    before it is needed.
+
+    Returns:
+    - results: dict
+        "import <module>" to a measurement, with imports/s as "fps" so the
+        times are compared against baselines like the other benchmarks.
+    - violations: list of str
+    """
+    results, violations = {}, []
+    for module in ("numpy", *CORE_MODULES, *SCRIPT_MODULES):
+        seconds, heavy = import_time(module)
+        results[f"import {module}"] = {"fps": 1.0 / seconds, "mb_per_s": 0.0, "peak_mb": 0.0}
+        if heavy:
+            violations.append(f"import {module} loads {', '.join(heavy)}")
+    return results, violations
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results against a baseline saved by a previous run.
+
+    Parameters:
+    - results: dict
+        Benchmark name to measurement, as returned by measure.
+    - baseline: dict
+        The "results" of a saved baseline.
+    - tolerance: float
+        Allowed relative drop in frames/s, and relative growth in peak memory.
+
+    Returns:
+    - regressions: list of str
+        A description of every regression.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result["fps"] < before["fps"] * (1 - tolerance):
+            regressions.append(f"{name}: {before['fps']:.1f} -> {result['fps']:.1f} frames/s")
+        # Ignore noise in allocations of less than 1 MB.
+        if result["peak_mb"] > before["peak_mb"] * (1 + tolerance) + 1:
+            regressions.append(f"{name}: {before['peak_mb']:.1f} -> {result['peak_mb']:.1f} MB peak memory")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image analysis hot paths.")
+    parser.add_argument("--frames", type=int, default=32, help="Number of synthetic frames.")
+    parser.add_argument("--images", default="fb_images", help="Folder of real PNG images (skipped if missing).")
+    parser.add_argument("--only", action="append", choices=[*BENCHMARKS, "decode", "images", "quality", "imports"],
+                        help="Only run these benchmark groups. May be repeated.")
+    parser.add_argument("--save", help="Save the results as a JSON baseline.")
+    parser.add_argument("--compare", help="Compare against a JSON baseline and exit with 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Relative slowdown or memory growth reported as a regression.")
+    args = parser.parse_args()
+    groups = args.only or [*BENCHMARKS, "decode", "images", "quality", "imports"]
+
+    frames = synthetic_frames(args.frames)
+    image_files = sorted(glob.glob(os.path.join(args.images, "*.png")))
+    print(f"Benchmarking on {args.frames} synthetic {FRAME_WIDTH} x {FRAME_HEIGHT} RAW8 frames "
+          f"and {len(image_files)} images from {args.images}\n")
+
+    results = {}
+    for group, bench in BENCHMARKS.items():
+        if group in groups:
+            results.update(bench(frames))
+    if "decode" in groups:
+        results.update(bench_decode(frames, image_files))
+    if "images" in groups and image_files:
+        results.update(bench_real_images(image_files))
+
+    if results:
+        print(f"{'':<50} {'frames/s':>10} {'MB/s':>10} {'peak MB':>10}")
+    for name, result in results.items():
+        print(f"{name:<50} {result['fps']:10.1f} {result['mb_per_s']:10.1f} {result['peak_mb']:10.1f}")
+
+    if "quality" in groups:
+        print("\nRMSE against a smooth synthetic scene")
+        for name, rmse in upsample_quality().items():
+            print(f"{name:<50} {rmse:10.2f} DN")
+
+    violations = []
+    if "imports" in groups:
+        import_results, violations = bench_imports()
+        numpy_ms = 1e3 / import_results["import numpy"]["fps"]
+        print(f"\nImport time in a fresh interpreter{'':<16} {'ms':>10} {'numpy +ms':>10}")
+        for name, result in import_results.items():
+            print(f"{name:<50} {1e3 / result['fps']:10.1f} {1e3 / result['fps'] - numpy_ms:10.1f}")
+        for violation in violations:
+            print(f"  {violation}")
+        results.update(import_results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "frames": args.frames,
+                "images": len(image_files),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "results": results,
+            }, f, indent=4)
+        print(f"\nSaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) against {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.compare}")
+
+    if violations:
+        print(f"\n{len(violations)} module(s) load heavy dependencies at import time.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+import os
+import time
+import json
+import math
+import argparse
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+import numpy as np
+
+from ffc import FFCCorrector
+from raw_store import RawFrameStore
+from utils import load_raw8_image
+
+INDEX_FILE = "index.json"
+
+# ffc_id of the averaged frames in a calibration store (see calibration_capture.py).
+KINDS = ("dark", "flat")
+
+# Calibration ids are short so that an interpolated id ("<low>~<high>@<exposure>")
+# fits the 32-byte ffc_id field of raw frame stores.
+MAX_ID_LENGTH = 11
+
+@dataclass(frozen=True)
+class CalibrationSet:
+    """
+    A dark/flat pair captured at fixed camera settings.
+
+    Attributes:
+    - id: str
+        Identifier recorded with the frames corrected by this set.
+    - exposure_us: int
+    - gain_db: float
+    - temperature_c: float or None
+        Sensor temperature during calibration, if known.
+    - flat_file: str
+        Flat field .npy file, relative to the library folder.
+    - dark_file: str
+        Dark field .npy file, relative to the library folder.
+    """
+
+    id: str
+    exposure_us: int
+    gain_db: float = 0.0
+    temperature_c: float = None
+    flat_file: str = ""
+    dark_file: str = ""
+
+class CalibrationLibrary:
+    """
+    Folder of FFC calibration sets indexed by exposure, gain and temperature.
+
+    Each set is a pair of uint8 .npy files listed in index.json. The arrays
+    are memory mapped on first use, so a library of many sets costs nothing
+    until a set is selected. select() picks the set for a frame's settings:
+
+    - the sets with the gain closest to the frame's gain, then among them
+      those with the temperature closest to the frame's (when both are known),
+    - if the frame's exposure lies between two calibrated exposures, dark
+      and flat fields are linearly interpolated between the two sets (both
+      grow linearly with exposure on the raw sensor), otherwise the set with
+      the nearest exposure is used.
+
+    Results are cached by (exposure, gain, temperature bucket), so selecting
+    the corrector of a frame is a single dict lookup once the settings have
+    been seen. The library can be shared by worker threads.
+
+    Parameters:
+    - path: str
+        Library folder (created by add() if missing).
+    - temperature_step: float
+        Width in degrees C of the temperature buckets of the cache.
+    - max_cached: int
+        Number of correctors kept in the cache.
+    """
+
+    def __init__(self, path, temperature_step=2.0, max_cached=8):
+        self.path = path
+        self.temperature_step = temperature_step
+        self.max_cached = max_cached
+        self.sets = {}
+        self._arrays = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        index_path = os.path.join(path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for fields in json.load(f)["sets"]:
+                    calibration = CalibrationSet(**fields)
+                    self.sets[calibration.id] = calibration
+
+    def __len__(self):
+        return len(self.sets)
+
+    def __iter__(self):
+        return iter(sorted(self.sets.values(), key=lambda c: (c.gain_db, c.exposure_us)))
+
+    def add(self, flat_field, dark_field, exposure_us, gain_db=0.0, temperature_c=None, calibration_id=None):
+        """
+        Adds a dark/flat pair to the library and saves the index.
+
+        Parameters:
+        - flat_field: numpy.ndarray
+            uint8 flat field frame.
+        - dark_field: numpy.ndarray
+            uint8 dark field frame of the same shape.
+        - exposure_us: int
+        - gain_db: float
+        - temperature_c: float, optional
+        - calibration_id: str, optional
+            At most MAX_ID_LENGTH characters (default: ffc<number>).
+
+        Returns:
+        - calibration: CalibrationSet
+        """
+        if flat_field.shape != dark_field.shape:
+            raise ValueError("Flat field/dark field image dimensions do not match.")
+        if calibration_id is None:
+            number = len(self.sets)
+            while f"ffc{number:03d}" in self.sets:
+                number += 1
+            calibration_id = f"ffc{number:03d}"
+        if len(calibration_id) > MAX_ID_LENGTH or "~" in calibration_id or "@" in calibration_id:
+            raise ValueError(f"Calibration id {calibration_id!r} must have at most {MAX_ID_LENGTH} "
+                             "characters and no '~' or '@'.")
+        if calibration_id in self.sets:
+            raise ValueError(f"Calibration {calibration_id!r} already exists in {self.path}.")
+
+        os.makedirs(self.path, exist_ok=True)
+        calibration = CalibrationSet(id=calibration_id, exposure_us=int(exposure_us), gain_db=float(gain_db),
+                                     temperature_c=None if temperature_c is None else float(temperature_c),
+                                     flat_file=f"{calibration_id}_flat.npy", dark_file=f"{calibration_id}_dark.npy")
+        np.save(os.path.join(self.path, calibration.flat_file), np.ascontiguousarray(flat_field, dtype=np.uint8))
+        np.save(os.path.join(self.path, calibration.dark_file), np.ascontiguousarray(dark_field, dtype=np.uint8))
+        self.sets[calibration_id] = calibration
+        self._cache.clear()
+        self._save_index()
+        return calibration
+
+    def remove(self, calibration_id):
+        calibration = self.sets.pop(calibration_id)
+        self._arrays.pop(calibration_id, None)
+        self._cache.clear()
+        self._save_index()
+        for file_name in (calibration.flat_file, calibration.dark_file):
+            os.remove(os.path.join(self.path, file_name))
+
+    def _save_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"sets": [asdict(calibration) for calibration in self]}, f, indent=4)
+        os.replace(index_path + ".tmp", index_path)
+
+    def arrays(self, calibration_id):
+        """
+        Returns the memory-mapped (flat_field, dark_field) of a set.
+        """
+        if calibration_id not in self._arrays:
+            calibration = self.sets[calibration_id]
+            self._arrays[calibration_id] = (
+                np.load(os.path.join(self.path, calibration.flat_file), mmap_mode="r"),
+                np.load(os.path.join(self.path, calibration.dark_file), mmap_mode="r"),
+            )
+        return self._arrays[calibration_id]
+
+    def exposures(self):
+        """
+        Returns the calibration ids by calibrated exposure (e.g. for
+        AutoExposure). With several sets at one exposure, the lowest gain wins.
+        """
+        exposures = {}
+        for calibration in self:
+            exposures.setdefault(calibration.exposure_us, calibration.id)
+        return exposures
+
+    def _candidates(self, gain_db, temperature_c):
+        # Sets with the closest gain, then the closest temperature.
+        gain = min({c.gain_db for c in self.sets.values()}, key=lambda g: abs(g - gain_db))
+        candidates = [c for c in self.sets.values() if c.gain_db == gain]
+        temperatures = {c.temperature_c for c in candidates if c.temperature_c is not None}
+        if temperature_c is not None and temperatures:
+            temperature = min(temperatures, key=lambda t: abs(t - temperature_c))
+            candidates = [c for c in candidates if c.temperature_c in (temperature, None)]
+        return sorted(candidates, key=lambda c: c.exposure_us)
+
+    def bracket(self, exposure_us, gain_db=0.0, temperature_c=None):
+        """
+        Returns the sets used for the given settings: (set, None) for a single
+        set, or (lower, upper) when the exposure is interpolated between them.
+        """
+        if not self.sets:
+            raise LookupError(f"No calibration sets in {self.path}.")
+        candidates = self._candidates(gain_db, temperature_c)
+        for lower, upper in zip(candidates, candidates[1:]):
+            if lower.exposure_us < exposure_us < upper.exposure_us:
+                return lower, upper
+        nearest = min(candidates, key=lambda c: abs(math.log(c.exposure_us / max(exposure_us, 1))))
+        return nearest, None
+
+    def select(self, exposure_us, gain_db=0.0, temperature_c=None):
+        """
+        Returns the FFC corrector for frames captured with these settings.
+
+        Returns:
+        - ffc_id: str
+            The set id, or "<lower>~<upper>@<exposure>" when interpolated.
+        - corrector: FFCCorrector
+        """
+        bucket = None if temperature_c is None else round(temperature_c / self.temperature_step)
+        key = (int(exposure_us), round(float(gain_db), 1), bucket)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                return result
+
+        lower, upper = self.bracket(exposure_us, gain_db, temperature_c)
+        if upper is None:
+            result = (lower.id, FFCCorrector(*self.arrays(lower.id)))
+        else:
+            weight = (exposure_us - lower.exposure_us) / (upper.exposure_us - lower.exposure_us)
+            (lower_flat, lower_dark), (upper_flat, upper_dark) = self.arrays(lower.id), self.arrays(upper.id)
+            result = (f"{lower.id}~{upper.id}@{int(exposure_us)}",
+                      FFCCorrector(_interpolate(lower_flat, upper_flat, weight),
+                                   _interpolate(lower_dark, upper_dark, weight)))
+
+        with self._lock:
+            self._cache[key] = result
+            if len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return result
+
+def _interpolate(lower, upper, weight):
+    # Linear interpolation of two uint8 fields, rounded back to uint8.
+    result = lower.astype(np.float32)
+    result += (upper.astype(np.float32) - result) * np.float32(weight)
+    return np.rint(result).astype(np.uint8)
+
+def save_averaged(path, kind, averager, exposure_us, gain_db):
+    """
+    Appends the averaged frame of a FrameAverager to the RawFrameStore at path, with kind
+    ("dark" or "flat") as its ffc_id, and saves the float32 noise and the
+    rejection count maps next to it as <kind>_noise.npy and <kind>_rejected.npy.
+
+    Returns:
+    - index: int
+        Index of the averaged frame in the store.
+    """
+    if kind not in KINDS:
+        raise ValueError(f"Unknown calibration frame kind: {kind}")
+    with RawFrameStore.open_or_create(path, averager.shape) as store:
+        index = store.append(averager.averaged_frame(), timestamp_ns=time.time_ns(), exposure_us=exposure_us,
+                             gain_db=gain_db, ffc_id=kind)
+    np.save(os.path.join(path, f"{kind}_noise.npy"), averager.noise())
+    np.save(os.path.join(path, f"{kind}_rejected.npy"), averager.rejected)
+    return index
+
+def load_averaged(path):
+    """
+    Loads the latest averaged flat and dark fields of a calibration store.
+    Raises ValueError if they were captured at different exposures or gains,
+    since the dark field would then not match the flat field's offset.
+
+    Returns:
+    - flat_field: numpy.ndarray
+    - dark_field: numpy.ndarray
+        uint8 frames, ready for FFCCorrector.
+    - exposure_us: int
+        Exposure of the flat field.
+    - gain_db: float
+    """
+    store = RawFrameStore(path)
+    kinds = [ffc_id.decode() for ffc_id in store.metadata["ffc_id"]]
+    missing = [kind for kind in KINDS if kind not in kinds]
+    if missing:
+        raise FileNotFoundError(f"Calibration store {path} has no averaged {' or '.join(missing)} field.")
+    flat_index = len(kinds) - 1 - kinds[::-1].index("flat")
+    dark_index = len(kinds) - 1 - kinds[::-1].index("dark")
+    metadata = store.metadata[flat_index]
+    dark_metadata = store.metadata[dark_index]
+    if (metadata["exposure_us"] != dark_metadata["exposure_us"]
+            or abs(float(metadata["gain_db"]) - float(dark_metadata["gain_db"])) > 0.01):
+        raise ValueError(f"Calibration store {path}: the latest flat field ({metadata['exposure_us']} us, "
+                         f"{metadata['gain_db']:.2f} dB) and dark field ({dark_metadata['exposure_us']} us, "
+                         f"{dark_metadata['gain_db']:.2f} dB) were captured with different settings.")
+    return store[flat_index], store[dark_index], int(metadata["exposure_us"]), float(metadata["gain_db"])
+
+def sensor_temperature(cam):
+    """
+    Returns the sensor temperature of a camera in degrees C, or None if the
+    camera does not report it (e.g. simulated cameras).
+    """
+    get_temperature = getattr(cam, "get_chip_temp", None)
+    return float(get_temperature()) if get_temperature is not None else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage a library of FFC calibration sets.")
+    parser.add_argument("library", help="Calibration library folder.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Add a dark/flat pair (TIFF, PNG or .npy) or an averaged store.")
+    add_parser.add_argument("--flat", help="Flat field image.")
+    add_parser.add_argument("--dark", help="Dark field image.")
+    add_parser.add_argument("--store", help="Calibration store of averaged fields (see calibration_capture.py).")
+    add_parser.add_argument("--exposure", type=int, default=None,
+                            help="Calibration exposure in microseconds (default: from the store).")
+    add_parser.add_argument("--gain", type=float, default=None, help="Calibration gain in dB (default: from the store, or 0).")
+    add_parser.add_argument("--temperature", type=float, default=None, help="Sensor temperature in degrees C.")
+    add_parser.add_argument("--id", default=None, help=f"Calibration id (at most {MAX_ID_LENGTH} characters).")
+
+    subparsers.add_parser("list", help="List the calibration sets.")
+
+    select_parser = subparsers.add_parser("select", help="Show the set used for given settings.")
+    select_parser.add_argument("--exposure", type=int, required=True, help="Exposure in microseconds.")
+    select_parser.add_argument("--gain", type=float, default=0.0, help="Gain in dB.")
+    select_parser.add_argument("--temperature", type=float, default=None, help="Sensor temperature in degrees C.")
+    args = parser.parse_args()
+
+    library = CalibrationLibrary(args.library)
+    if args.command == "add":
+        exposure_us, gain_db = args.exposure, args.gain
+        if args.store:
+            flat_field, dark_field, store_exposure_us, store_gain_db = load_averaged(args.store)
+            exposure_us = store_exposure_us if exposure_us is None else exposure_us
+            gain_db = store_gain_db if gain_db is None else gain_db
+        elif args.flat and args.dark and exposure_us is not None:
+            if args.flat.endswith(".npy"):
+                flat_field, dark_field = np.load(args.flat), np.load(args.dark)
+            else:
+                flat_field, dark_field = load_raw8_image(args.flat), load_raw8_image(args.dark)
+        else:
+            parser.error("add needs --store, or --flat, --dark and --exposure.")
+        calibration = library.add(flat_field, dark_field, exposure_us, gain_db or 0.0, args.temperature, args.id)
+        print(f"Added calibration {calibration.id} to {args.library}")
+    elif args.command == "list":
+        for calibration in library:
+            temperature = "-" if calibration.temperature_c is None else f"{calibration.temperature_c:g} C"
+            print(f"{calibration.id}: {calibration.exposure_us} us, {calibration.gain_db:g} dB, {temperature}")
+    else:
+        lower, upper = library.bracket(args.exposure, args.gain, args.temperature)
+        ffc_id, corrector = library.select(args.exposure, args.gain, args.temperature)
+        print(f"{ffc_id}: " + (f"{lower.id}" if upper is None else f"interpolated between {lower.id} and {upper.id}")
+              + f", scale {corrector.scale:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+
+from calibration import KINDS, CalibrationLibrary, save_averaged, load_averaged
+from capture_image import open_camera, new_image, image_to_numpy
+
+class FrameAverager:
+    """
+    Averages RAW8 frames one at a time with per-pixel outlier rejection, so
+    the frames are never held in memory together. Per-pixel sums of the
+    accepted values and of their squares are kept as integers (exact), plus
+    the number of accepted samples.
+
+    After warmup frames, a pixel value further than sigma standard deviations
+    from the running mean of that pixel is rejected (hot pixels, cosmic rays,
+    flicker). The standard deviation is floored at min_sigma because 8-bit
+    frames of a steady scene can have a spread of 0.
+
+    Parameters:
+    - shape: tuple
+        (height, width) of the frames.
+    - sigma: float
+        Rejection threshold in standard deviations.
+    - min_sigma: float
+        Lower bound of the standard deviation used for rejection, in DN.
+    - warmup: int
+        Number of frames accepted unconditionally to seed the statistics.
+    - chunk_rows: int
+        Rows processed at a time, bounding the float temporaries.
+    """
+
+    def __init__(self, shape, sigma=4.0, min_sigma=1.0, warmup=8, chunk_rows=128):
+        self.shape = tuple(shape)
+        self.sigma = sigma
+        self.min_sigma = min_sigma
+        self.warmup = warmup
+        self.chunk_rows = chunk_rows
+        self.frames = 0
+        self.total = np.zeros(self.shape, dtype=np.uint32)
+        self.total_sq = np.zeros(self.shape, dtype=np.uint64)
+        self.count = np.zeros(self.shape, dtype=np.uint32)
+
+    def update(self, frame):
+        """
+        Adds a uint8 frame. Returns the number of rejected pixel values.
+        """
+        if frame.shape != self.shape or frame.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 frame of shape {self.shape}, got {frame.dtype} {frame.shape}.")
+        self.frames += 1
+
+        if self.frames <= self.warmup:
+            self.total += frame
+            self.total_sq += np.square(frame, dtype=np.uint32)
+            self.count += 1
+            return 0
+
+        rejected = 0
+        for row in range(0, self.shape[0], self.chunk_rows):
+            rows = slice(row, row + self.chunk_rows)
+            values = frame[rows]
+            count = self.count[rows]
+            mean, std = _mean_std(self.total[rows], self.total_sq[rows], count, np.float32)
+            np.maximum(std, self.min_sigma, out=std)
+            mean -= values
+            accepted = np.abs(mean, out=mean) <= self.sigma * std
+
+            self.total[rows] += values * accepted
+            self.total_sq[rows] += np.square(values, dtype=np.uint32) * accepted
+            count += accepted
+            rejected += accepted.size - int(np.count_nonzero(accepted))
+        return rejected
+
+    @property
+    def rejected(self):
+        """Per-pixel number of rejected values."""
+        return (self.frames - self.count).astype(np.uint32)
+
+    def mean(self):
+        """Per-pixel mean of the accepted values, float32."""
+        return _mean_std(self.total, self.total_sq, self.count)[0].astype(np.float32)
+
+    def noise(self):
+        """Per-pixel temporal standard deviation of the accepted values, float32."""
+        return _mean_std(self.total, self.total_sq, self.count)[1].astype(np.float32)
+
+    def averaged_frame(self):
+        """The mean rounded to a uint8 frame, as used by FFCCorrector."""
+        return np.clip(np.rint(self.mean()), 0, 255).astype(np.uint8)
+
+def _mean_std(total, total_sq, count, dtype=np.float64):
+    # Mean and population standard deviation from the integer sums. float32 is
+    # precise enough for the rejection test and twice as fast.
+    count = np.maximum(count, 1).astype(dtype)
+    mean = total.astype(dtype)
+    mean /= count
+    var = total_sq.astype(dtype)
+    var /= count
+    var -= mean * mean
+    np.maximum(var, 0, out=var)
+    return mean, np.sqrt(var, out=var)
+
+def capture_average(cam, num_frames, averager=None, **averager_options):
+    """
+    Acquires num_frames from cam and averages them with a FrameAverager.
+    Acquisition is started and stopped here.
+
+    Returns:
+    - averager: FrameAverager
+    """
+    img = new_image(cam)
+    cam.start_acquisition()
+    try:
+        rejected = 0
+        for index in range(num_frames):
+            cam.get_image(img)
+            frame = image_to_numpy(img)
+            if averager is None:
+                averager = FrameAverager(frame.shape, **averager_options)
+            rejected += averager.update(frame)
+            if (index + 1) % 10 == 0 or index + 1 == num_frames:
+                print('Averaged {}/{} frames, {} values rejected'.format(index + 1, num_frames, rejected))
+    finally:
+        cam.stop_acquisition()
+    return averager
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture averaged dark and flat field frames for FFC.")
+    parser.add_argument("kind", choices=KINDS, help="Calibration frame to capture (cover the lens for dark).")
+    parser.add_argument("--output", required=True, help="Calibration store folder (one per exposure/gain).")
+    parser.add_argument("--frames", type=int, default=64, help="Number of frames to average.")
+    parser.add_argument("--sigma", type=float, default=4.0, help="Outlier rejection threshold in standard deviations.")
+    parser.add_argument("--exposure", type=int, default=100000, help="Exposure in microseconds.")
+    parser.add_argument("--gain", type=float, default=0, help="Gain in dB.")
+    parser.add_argument("--library", help="Also add the store to this calibration library once it has both fields.")
+    parser.add_argument("--id", default=None, help="Calibration id in the library.")
+    parser.add_argument("--simulate", metavar="FOLDER", nargs="?", const="fb_images", default=None,
+                        help="Replay images from FOLDER instead of using a camera.")
+    args = parser.parse_args()
+
+    cam = open_camera(simulate=args.simulate is not None, exposure=args.exposure, gain=args.gain,
+                      image_folder=args.simulate)
+    try:
+        exposure_us, gain_db = cam.get_exposure(), cam.get_gain()
+        averager = capture_average(cam, args.frames, sigma=args.sigma)
+    finally:
+        cam.close_device()
+
+    index = save_averaged(args.output, args.kind, averager, exposure_us, gain_db)
+    noise = averager.noise()
+    print('Saved averaged {} field as frame {} of {}: mean {:.2f} DN, median noise {:.2f} DN, '
+          'noise of the average {:.3f} DN'.format(args.kind, index, args.output, float(averager.mean().mean()),
+                                                  float(np.median(noise)), float(np.median(noise)) / args.frames ** 0.5))
+
+    if args.library:
+        try:
+            flat_field, dark_field, exposure_us, gain_db = load_averaged(args.output)
+        except FileNotFoundError as e:
+            print(f"Not added to the library yet: {e}")
+        except ValueError as e:
+            print(f"Not added to the library: {e} Capture the other field again at "
+                  f"{exposure_us} us and {gain_db:.2f} dB.")
+        else:
+            calibration = CalibrationLibrary(args.library).add(flat_field, dark_field, exposure_us, gain_db,
+                                                               calibration_id=args.id)
+            print(f"Added calibration {calibration.id} to {args.library}")
+
+if __name__ == "__main__":
+    main()
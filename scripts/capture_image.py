@@ -1,46 +1,445 @@
 #!/usr/bin/env python3
-from ximea import xiapi
 import numpy as np
-from PIL import Image
 import os
 import glob
-import cv2
+import time
+import queue
+import argparse
+import threading
 
-def main():
-    # ------------- Options -------------
-    # Choose which FFC method to use.
-    use_builtin_ffc = False         # Uses precomputed FFC files via the camera API.
-    compute_ffc_manually = True   # Computes FFC manually using the same TIFF images.
-    output_filename = 'python_ffc_applied.jpg' # Output filename for the captured image.
-    
-    # Ensure that both options are not enabled simultaneously.
-    if use_builtin_ffc and compute_ffc_manually:
-        print("Both built-in FFC and manual FFC computation options are enabled. Defaulting to auto.")
-        compute_ffc_manually = False
+try:
+    from ximea import xiapi
+except ImportError:
+    # The Ximea SDK is only needed for real hardware, see --simulate.
+    xiapi = None
+
+import simulated_camera
+from ffc import FFCCorrector
+from raw_store import RawFrameStore
+from decode import read_raw8
+import profiling
+from auto_exposure import AutoExposure
+from calibration import CalibrationLibrary, load_averaged, sensor_temperature
+from raw_store import is_raw_store, FFC_ID_LENGTH
+
+def find_ffc_files(ffc_folder="ffc"):
+    """
+    Finds the most recent pair of flat field and dark field TIFF files
+    exported from xiCamTool (<prefix>mid.tif and <prefix>dark.tif). Only
+    complete pairs are considered. For calibrations at several exposures, use
+    a CalibrationLibrary instead.
+
+    Parameters:
+    - ffc_folder: str
+        Folder containing the FFC files exported from xiCamTool.
+
+    Returns:
+    - ffc_flat_field_file_name: str
+    - ffc_dark_field_file_name: str
+    """
+
+    # Pair each flat field with the dark field of the same prefix.
+    pairs = []
+    for flat_file in glob.glob(os.path.join(ffc_folder, "*mid.tif")):
+        dark_file = flat_file[:-len("mid.tif")] + "dark.tif"
+        if os.path.exists(dark_file):
+            pairs.append((flat_file, dark_file))
+    if not pairs:
+        raise FileNotFoundError("Could not find the required FFC files in the folder: {}".format(ffc_folder))
+
+    # Use the pair whose newest file is the most recent.
+    flat_file, dark_file = max(pairs, key=lambda pair: max(map(os.path.getmtime, pair)))
+    print(f"Found FFC files with prefix: {flat_file[:-len('mid.tif')]}")
+    return flat_file, dark_file
+
+def load_ffc_images(ffc_flat_field_file_name, ffc_dark_field_file_name, shape=None):
+    """
+    Loads the flat field and dark field images in grayscale.
+
+    Parameters:
+    - ffc_flat_field_file_name: str
+    - ffc_dark_field_file_name: str
+    - shape: tuple, optional
+        Expected (height, width) of the captured images.
+
+    Returns:
+    - flat_field: numpy.ndarray
+    - dark_field: numpy.ndarray
+    """
+
+    try:
+        flat_field = read_raw8(ffc_flat_field_file_name)
+        dark_field = read_raw8(ffc_dark_field_file_name)
+    except FileNotFoundError as e:
+        raise FileNotFoundError("Could not read flat field or dark field images.") from e
+
+    # Optionally, ensure that the flat/dark field dimensions match the captured image.
+    if shape is not None and (flat_field.shape != shape or dark_field.shape != shape):
+        raise ValueError("Flat field/dark field image dimensions do not match the captured image dimensions.")
+
+    return flat_field, dark_field
+
+def load_manual_ffc(ffc_folder="ffc"):
+    """
+    Loads the flat and dark fields for manual FFC, either from a calibration
+    store of averaged fields (see calibration_capture.py) or from the most
+    recent pair of TIFF files in ffc_folder.
+
+    Returns:
+    - flat_field: numpy.ndarray
+    - dark_field: numpy.ndarray
+    - ffc_id: str
+    - exposure_us: int or None
+        Calibration exposure, if recorded (only in calibration stores).
+    """
+    if is_raw_store(ffc_folder):
+        flat_field, dark_field, exposure_us, _ = load_averaged(ffc_folder)
+        return flat_field, dark_field, short_ffc_id(os.path.basename(os.path.normpath(ffc_folder))), exposure_us
+    ffc_files = find_ffc_files(ffc_folder)
+    return (*load_ffc_images(*ffc_files), ffc_id_from_files(*ffc_files), None)
+
+def image_to_numpy(img):
+    """
+    Converts the raw data of a RAW8 xiapi.Image into a 2D NumPy array (no copy).
+    """
+
+    # Retrieve raw image data (as bytes).
+    data_raw = img.get_image_data_raw()
+    width = img.width
+    height = img.height
+
+    # In RAW8 mode, each pixel is 1 byte, so we expect data_raw to be width*height bytes long.
+    expected_length = width * height
+    if len(data_raw) != expected_length:
+        raise ValueError("Unexpected image data size: expected {} bytes, got {} bytes."
+                        .format(expected_length, len(data_raw)))
+
+    # Create a 2D NumPy array (grayscale image) from the raw bytes.
+    return np.frombuffer(data_raw, dtype=np.uint8).reshape((height, width))
+
+def new_image(cam):
+    """
+    Creates the image object that cam.get_image fills.
+    """
+    if isinstance(cam, simulated_camera.Camera):
+        return simulated_camera.Image()
+    return xiapi.Image()
+
+def is_jpeg_path(path):
+    return path.lower().endswith((".jpg", ".jpeg"))
+
+def ffc_id_from_files(ffc_flat_field_file_name, ffc_dark_field_file_name):
+    """
+    Returns the common prefix of the FFC file names, used to record which
+    calibration was applied to a frame.
+    """
+    return short_ffc_id(os.path.basename(os.path.commonprefix([ffc_flat_field_file_name, ffc_dark_field_file_name])))
+
+def short_ffc_id(name):
+    """
+    Cuts an FFC id to the FFC_ID_LENGTH bytes a frame store record holds.
+    """
+    return name.encode()[:FFC_ID_LENGTH].decode(errors="ignore")
+
+@profiling.timed("write")
+def save_jpeg(np_image, output_filename):
+    """
+    Saves a grayscale image as a JPEG file.
+    """
+    # Encoded with the same OpenCV build that decodes the frames (see
+    # decode.py), at the default PIL quality the files were saved with.
+    # Imported here so raw streaming never loads OpenCV.
+    import cv2
+    if not cv2.imwrite(output_filename, np_image, [cv2.IMWRITE_JPEG_QUALITY, 75]):
+        raise OSError(f"Could not write {output_filename}")
+
+class FrameRingBuffer:
+    """
+    Preallocated ring of RAW8 frame slots shared by the acquisition thread
+    and the workers. A slot is acquired, filled by the acquisition thread,
+    handed to a worker and released back once the worker is done with it,
+    so no frame memory is allocated while streaming.
+
+    Parameters:
+    - capacity: int
+        Number of frame slots.
+    - shape: tuple
+        (height, width) of a frame.
+    """
+
+    def __init__(self, capacity, shape):
+        self.frames = np.empty((capacity, *shape), dtype=np.uint8)
+        self.metadata = [None] * capacity
+        self._free = queue.Queue()
+        for slot in range(capacity):
+            self._free.put(slot)
+
+    @property
+    def capacity(self):
+        return len(self.frames)
+
+    def acquire(self, timeout=None):
+        """
+        Returns a free slot index, or None if none frees up within timeout.
+        """
+        try:
+            return self._free.get(timeout=timeout) if timeout else self._free.get_nowait()
+        except queue.Empty:
+            return None
+
+    def release(self, slot):
+        self.metadata[slot] = None
+        self._free.put(slot)
+
+class StreamingCapture:
+    """
+    Continuous acquisition pipeline. An acquisition thread copies each frame
+    from the camera into a FrameRingBuffer slot and queues it, and a pool of
+    worker threads applies FFC and writes the frames to disk, either appended
+    to a RawFrameStore or as one JPEG per frame. When every slot
+    is in use the acquisition thread waits up to block_timeout for a worker to
+    release one and otherwise drops the frame, so a slow disk never stalls the
+    camera indefinitely.
+
+    A frame whose correction or write raises is counted as failed and its
+    slot released, and the workers carry on with the next frames. An error
+    in the acquisition thread (e.g. get_image failing) ends the acquisition
+    once the queued frames are written. The first error of either kind is
+    raised again by wait() and stop().
+
+    Parameters:
+    - cam: xiapi.Camera or simulated_camera.Camera
+        An opened camera configured for XI_RAW8.
+    - output: str
+        Folder of the RawFrameStore the frames are appended to, or folder of
+        JPEG files if output_format is "jpeg".
+    - output_format: str
+        "raw" (lossless, default) or "jpeg".
+    - buffer_size: int
+        Number of frame slots in the ring buffer.
+    - num_workers: int
+        Number of worker threads.
+    - ffc: FFCCorrector, optional
+        Corrector applied in place to each frame before it is written.
+    - ffc_id: str
+        Identifier of the FFC calibration, recorded in the raw store metadata.
+    - block_timeout: float
+        Seconds to wait for a free slot before dropping a frame (0 never waits).
+    - auto_exposure: AutoExposure, optional
+        Controller run on every frame in the acquisition thread. Its settings
+        are applied to the camera, and the FFC id of the calibration matching
+        each frame's exposure is recorded when it has calibrations.
+    - calibrations: CalibrationLibrary, optional
+        Library the corrector of each frame is selected from, by the frame's
+        exposure and gain and the sensor temperature at start. Replaces ffc.
+    """
+
+    def __init__(self, cam, output, output_format="raw", buffer_size=16, num_workers=2, ffc=None,
+                 ffc_id="", block_timeout=0.0, auto_exposure=None, calibrations=None):
+        if output_format not in ("raw", "jpeg"):
+            raise ValueError(f"Unsupported output format: {output_format}")
+        self.cam = cam
+        self.output = output
+        self.output_format = output_format
+        self.ffc_id = ffc_id if ffc is not None else ""
+        self.buffer_size = buffer_size
+        self.num_workers = num_workers
+        self.ffc = ffc
+        self.block_timeout = block_timeout
+        self.auto_exposure = auto_exposure
+        self.calibrations = calibrations
+        self.temperature_c = None
+
+        self.ring = None
+        self.store = None
+        self.captured = 0
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._error = None
+        self._lock = threading.Lock()
+        self._work = queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def stats(self):
+        """
+        Returns the frame counters of the pipeline.
+        """
+        with self._lock:
+            return {
+                "captured": self.captured,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "queued": self._work.qsize(),
+            }
+
+    def start(self, num_frames=None):
+        """
+        Starts acquisition and the workers.
 
-    # for i in range(1, 3):
+        Parameters:
+        - num_frames: int, optional
+            Stop acquiring after this many frames from the camera. Runs until
+            stop() if None.
+        """
+        if self.output_format == "jpeg":
+            os.makedirs(self.output, exist_ok=True)
+        self._stop.clear()
+        if self.calibrations is not None:
+            self.temperature_c = sensor_temperature(self.cam)
+        self._threads = [threading.Thread(target=self._acquire_loop, args=(num_frames,), daemon=True)]
+        self._threads += [threading.Thread(target=self._worker_loop, daemon=True) for _ in range(self.num_workers)]
+        self.cam.start_acquisition()
+        for thread in self._threads:
+            thread.start()
 
-    #     if i == 1:
-    #         use_builtin_ffc = True
-    #         compute_ffc_manually = False
-    #         output_filename = 'python_ffc_auto.jpg'
-    #     else:
-    #         use_builtin_ffc = False
-    #         compute_ffc_manually = True
-    #         output_filename = 'python_ffc_manual.jpg'
+    def is_running(self):
+        return any(thread.is_alive() for thread in self._threads)
 
+    def wait(self):
+        """
+        Blocks until acquisition has finished and every queued frame is written,
+        then raises the first error of the acquisition thread or a worker, if
+        any.
+        """
+        self._threads[0].join()
+        for thread in self._threads[1:]:
+            thread.join()
+        self.cam.stop_acquisition()
+        if self.store is not None:
+            self.store.close()
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def stop(self):
+        """
+        Stops acquisition, then waits for the workers to drain the queue. See
+        wait().
+        """
+        self._stop.set()
+        self.wait()
+
+    def _acquire_loop(self, num_frames):
+        img = new_image(self.cam)
+        try:
+            while not self._stop.is_set() and (num_frames is None or self.captured + self.dropped < num_frames):
+                with profiling.stage("acquire"):
+                    self.cam.get_image(img)
+                received = time.perf_counter()
+                frame = image_to_numpy(img)
+
+                if self.ring is None:
+                    self.ring = FrameRingBuffer(self.buffer_size, frame.shape)
+                    if self.output_format == "raw":
+                        self.store = RawFrameStore.open_or_create(self.output, frame.shape)
+
+                slot = self.ring.acquire(self.block_timeout)
+                if slot is None:
+                    with self._lock:
+                        self.dropped += 1
+                    continue
+
+                self.ring.frames[slot] = frame
+                self.ring.metadata[slot] = {
+                    "nframe": img.nframe,
+                    "timestamp": (img.tsSec, img.tsUSec),
+                    "exposure_us": img.exposure_time_us,
+                    "gain_db": img.gain_db,
+                    "ffc_id": self.ffc_id,
+                    "received": received,
+                }
+                if self.auto_exposure is not None:
+                    # Measured on the subsampled mosaic, well within a frame time.
+                    settings = self.auto_exposure.update(frame, img.exposure_time_us, img.gain_db)
+                    if settings is not None:
+                        self.cam.set_exposure(settings[0])
+                        self.cam.set_gain(settings[1])
+                    if self.ffc is not None and self.calibrations is None and self.auto_exposure.calibrations:
+                        self.ring.metadata[slot]["ffc_id"] = \
+                            self.auto_exposure.matching_calibration(img.exposure_time_us)[1]
+                with self._lock:
+                    self.captured += 1
+                self._work.put(slot)
+        except Exception as error:
+            self._set_error(error)
+        finally:
+            # One sentinel per worker so each one exits after draining the queue.
+            for _ in range(self.num_workers):
+                self._work.put(None)
+
+    def _worker_loop(self):
+        while True:
+            slot = self._work.get()
+            if slot is None:
+                return
+
+            try:
+                self._process(slot)
+            except Exception as error:
+                with self._lock:
+                    self.failed += 1
+                self._set_error(error)
+            else:
+                with self._lock:
+                    self.processed += 1
+            finally:
+                self.ring.release(slot)
+
+    def _set_error(self, error):
+        # Keeps the first error of any thread, raised again by wait().
+        with self._lock:
+            if self._error is None:
+                self._error = error
+
+    def _process(self, slot):
+        frame = self.ring.frames[slot]
+        metadata = self.ring.metadata[slot]
+        if self.calibrations is not None:
+            # A dict lookup once these settings have been seen.
+            metadata["ffc_id"], ffc = self.calibrations.select(metadata["exposure_us"], metadata["gain_db"],
+                                                               self.temperature_c)
+            ffc.apply(frame, out=frame)
+        elif self.ffc is not None:
+            self.ffc.apply(frame, out=frame)
+
+        sec, usec = metadata["timestamp"]
+        if self.store is not None:
+            self.store.append(frame, timestamp_ns=sec * 1000000000 + usec * 1000,
+                              exposure_us=metadata["exposure_us"], gain_db=metadata["gain_db"],
+                              ffc_id=metadata["ffc_id"])
+        else:
+            output_filename = os.path.join(self.output, f"{sec}_{usec * 1000:09d}.jpg")
+            save_jpeg(frame, output_filename)
+
+        # From the frame leaving the camera to the end of its write.
+        profiling.record("frame_to_disk", time.perf_counter() - metadata["received"], frame.nbytes)
+
+def open_camera(simulate=False, exposure=100000, gain=0, image_folder="fb_images", device_id=0, framerate=None):
+    """
+    Opens a connected camera (the first one by default), or a simulated one
+    replaying image_folder at framerate, in RAW8 mode.
+    """
     # ------------- Camera Setup -------------
-    # Create instance for the first connected camera.
-    cam = xiapi.Camera()
-    print('Opening first camera...')
+    if simulate:
+        print('Opening simulated camera replaying {}...'.format(image_folder))
+        cam = simulated_camera.Camera(image_folder, framerate=framerate)
+    else:
+        if xiapi is None:
+            raise ImportError("The ximea package is required to use a real camera (or use --simulate).")
+        # Create instance for the connected camera with this index.
+        cam = xiapi.Camera(dev_id=device_id)
+        print('Opening camera {}...'.format(device_id))
     cam.open_device()
-    
+
     # Set the exposure (in microseconds).
-    cam.set_exposure(100000)
+    cam.set_exposure(exposure)
     print('Exposure set to {} us'.format(cam.get_exposure()))
 
     # Set the gain (in dB).
-    cam.set_gain(0)
+    cam.set_gain(gain)
     print('Gain set to {} dB'.format(cam.get_gain()))
 
     # Set the image data format to RAW8.
@@ -48,27 +447,81 @@ def main():
     cam.set_imgdataformat("XI_RAW8")
     print("Image data format set to XI_RAW8")
 
+    return cam
+
+def converge_exposure(cam, auto_exposure, img, max_frames=10):
+    """
+    Reads frames until auto_exposure settles (or max_frames have been read),
+    applying its settings to the camera. Acquisition must be started.
+
+    Returns:
+    - converged: bool
+    """
+    for _ in range(max_frames):
+        cam.get_image(img)
+        settings = auto_exposure.update(image_to_numpy(img), img.exposure_time_us, img.gain_db)
+        if settings is not None:
+            cam.set_exposure(settings[0])
+            cam.set_gain(settings[1])
+        elif auto_exposure.converged:
+            return True
+    return False
+
+def report_exposure(auto_exposure):
+    """
+    Prints the settings chosen by auto_exposure, and warns when they differ
+    from the exposure of the matching FFC calibration.
+    """
+    print('Auto exposure: {} us, {} dB, brightest band p{:g} at {} DN ({} after {} frames)'.format(
+        auto_exposure.exposure_us, auto_exposure.gain_db, auto_exposure.percentile, auto_exposure.level,
+        "converged" if auto_exposure.converged else "not converged", auto_exposure.frames))
+    calibration_exposure, ffc_id = auto_exposure.matching_calibration()
+    if calibration_exposure is not None:
+        print('Matching FFC calibration: {} ({} us)'.format(ffc_id, calibration_exposure))
+        if abs(auto_exposure.exposure_us / calibration_exposure - 1.0) > auto_exposure.tolerance:
+            print('Warning: the exposure differs from the FFC calibration exposure, the correction may be biased.')
+
+def capture_single(cam, output, use_builtin_ffc=False, compute_ffc_manually=True, ffc_folder="ffc",
+                   auto_exposure=None, ffc_exposure_us=None, calibrations=None):
+    """
+    Captures a single image, optionally applies FFC and saves it. The image is
+    appended to the RawFrameStore at output, or saved as a JPEG if output ends
+    in .jpg/.jpeg.
+
+    With auto_exposure, frames are read until the exposure settles before the
+    image is captured. The FFC files are registered with the controller as
+    calibrated at ffc_exposure_us (default: the exposure recorded in a calibration
+    store, or the exposure set when called).
+
+    With a CalibrationLibrary as calibrations, manual FFC uses the set
+    selected for the final exposure, gain and sensor temperature instead of
+    the files of ffc_folder.
+    """
+    # Ensure that both options are not enabled simultaneously.
+    if use_builtin_ffc and compute_ffc_manually:
+        print("Both built-in FFC and manual FFC computation options are enabled. Defaulting to auto.")
+        compute_ffc_manually = False
+
     # ------------- Flat Field Correction Setup -------------
-    if use_builtin_ffc or compute_ffc_manually:
+    if compute_ffc_manually and calibrations is not None:
+        ffc_id = ""
+        if auto_exposure is not None:
+            auto_exposure.calibrations.update(calibrations.exposures())
+    elif compute_ffc_manually:
+        flat_field, dark_field, ffc_id, calibrated_exposure_us = load_manual_ffc(ffc_folder)
+        if auto_exposure is not None:
+            auto_exposure.calibrations.setdefault(ffc_exposure_us or calibrated_exposure_us or cam.get_exposure(),
+                                                  ffc_id)
+    elif use_builtin_ffc:
         # Set the folder for the FFC files (update path as needed).
         # ffc_folder = "~/.local/share/xiCamTool/shading"
         # ffc_folder = os.path.expanduser(ffc_folder)
-        ffc_folder = "ffc"
-
-        # Get the list of TIFF files in the folder.
-        ffc_files = glob.glob(os.path.join(ffc_folder, "*.tif"))
-        if not ffc_files:
-            raise FileNotFoundError("Could not find the required FFC files in the folder: {}".format(ffc_folder))
-        
-        # Sort the files by modification time in descending order.
-        ffc_files.sort(key=os.path.getmtime, reverse=True)
-        
-        # Get the prefix of the most recent FFC files (assumes at least two exist).
-        ffc_prefix = os.path.commonprefix(ffc_files[0:2])
-        print(f"Found FFC files with prefix: {ffc_prefix}")
-
-        ffc_flat_field_file_name = ffc_prefix + "mid.tif"
-        ffc_dark_field_file_name = ffc_prefix + "dark.tif"
+        ffc_flat_field_file_name, ffc_dark_field_file_name = find_ffc_files(ffc_folder)
+        ffc_id = ffc_id_from_files(ffc_flat_field_file_name, ffc_dark_field_file_name)
+        if auto_exposure is not None:
+            auto_exposure.calibrations.setdefault(ffc_exposure_us or cam.get_exposure(), ffc_id)
+    else:
+        ffc_id = ""
 
     if use_builtin_ffc:
         print("Enabling built-in flat field correction...")
@@ -85,78 +538,174 @@ def main():
 
     # ------------- Image Acquisition -------------
     # Create an Image instance to store image data and metadata.
-    img = xiapi.Image()
+    img = new_image(cam)
 
     # Start data acquisition.
     print('Starting data acquisition...')
     cam.start_acquisition()
 
+    if auto_exposure is not None:
+        print('Adjusting exposure...')
+        converge_exposure(cam, auto_exposure, img)
+        report_exposure(auto_exposure)
+
     # Capture a single image.
     print('Capturing image...')
     cam.get_image(img)
-
-    # Retrieve raw image data (as bytes).
-    data_raw = img.get_image_data_raw()
-    width = img.width
-    height = img.height
-    print('Captured image dimensions: {} x {}'.format(width, height))
-
-    # --- Convert raw data into a NumPy array ---
-    # In RAW8 mode, each pixel is 1 byte, so we expect data_raw to be width*height bytes long.
-    expected_length = width * height
-    if len(data_raw) != expected_length:
-        raise ValueError("Unexpected image data size: expected {} bytes, got {} bytes."
-                        .format(expected_length, len(data_raw)))
-    
-    # Create a 2D NumPy array (grayscale image) from the raw bytes.
-    np_image = np.frombuffer(data_raw, dtype=np.uint8).reshape((height, width))
+    print('Captured image dimensions: {} x {}'.format(img.width, img.height))
+    np_image = image_to_numpy(img)
 
     # ------------- Manual FFC Computation -------------
-    if compute_ffc_manually:
-        print("Computing flat field correction manually using TIF images...")
-
-        # Load the flat field and dark field images in grayscale.
-        flat_field = cv2.imread(ffc_flat_field_file_name, cv2.IMREAD_GRAYSCALE)
-        dark_field = cv2.imread(ffc_dark_field_file_name, cv2.IMREAD_GRAYSCALE)
-        
-        if flat_field is None or dark_field is None:
-            raise FileNotFoundError("Could not read flat field or dark field images.")
-        
-        # Optionally, ensure that the flat/dark field dimensions match the captured image.
-        if flat_field.shape != np_image.shape or dark_field.shape != np_image.shape:
-            raise ValueError("Flat field/dark field image dimensions do not match the captured image dimensions.")
-        
-        # Convert images to float32 for computation.
-        np_image_float = np_image.astype(np.float32)
-        dark_field_float = dark_field.astype(np.float32)
-        flat_field_float = flat_field.astype(np.float32)
-        
-        # Compute the denominator, adding a small epsilon to avoid division by zero.
-        epsilon = 1e-6
-        ratio = (np_image_float - dark_field_float) / (flat_field_float - dark_field_float + epsilon)
-        
-        # Scale factor: use the mean of (flat_field - dark_field) to preserve brightness.
-        scale = np.mean(flat_field_float - dark_field_float)
-        corrected_image = ratio * scale
-        corrected_image = np.clip(corrected_image, 0, 255).astype(np.uint8)
-        
+    if compute_ffc_manually and calibrations is not None:
+        ffc_id, ffc = calibrations.select(cam.get_exposure(), cam.get_gain(), sensor_temperature(cam))
+        np_image = ffc.apply(np_image)
+        print("Manual flat field correction complete using calibration {}.".format(ffc_id))
+    elif compute_ffc_manually:
+        print("Computing flat field correction manually using {}...".format(ffc_id))
+
         # Replace the raw image with the corrected image.
-        np_image = corrected_image
-        print("Manual flat field correction complete using TIF images.")
+        np_image = FFCCorrector(flat_field, dark_field).apply(np_image)
+        print("Manual flat field correction complete.")
 
     # ------------- Save the Image -------------
-    # Create a PIL image from the (possibly corrected) NumPy array.
-    pil_image = Image.fromarray(np_image, mode='L')
-
-    # Save the image as a JPEG file.
-    pil_image.save(output_filename, 'JPEG')
-    print('Image saved as {}'.format(output_filename))
+    if is_jpeg_path(output):
+        save_jpeg(np_image, output)
+        print('Image saved as {}'.format(output))
+    else:
+        with RawFrameStore.open_or_create(output, np_image.shape) as store:
+            index = store.append(np_image, timestamp_ns=img.tsSec * 1000000000 + img.tsUSec * 1000,
+                                 exposure_us=cam.get_exposure(), gain_db=cam.get_gain(), ffc_id=ffc_id)
+        print('Image saved as frame {} of {}'.format(index, output))
 
-    # Stop data acquisition and close the camera.
+    # Stop data acquisition.
     print('Stopping acquisition...')
     cam.stop_acquisition()
-    cam.close_device()
-    print('Camera closed.')
+
+def capture_stream(cam, output, num_frames=None, buffer_size=16, num_workers=2,
+                   compute_ffc_manually=True, ffc_folder="ffc", block_timeout=0.0,
+                   auto_exposure=None, ffc_exposure_us=None, calibrations=None):
+    """
+    Streams frames from the camera to output until num_frames have been
+    acquired (or until interrupted), then prints the frame counters. Frames
+    are appended to the RawFrameStore at output, or written as JPEG files if
+    output ends in .jpg/.jpeg (the extension is stripped for the folder name).
+
+    With auto_exposure, the exposure is adjusted continuously while streaming
+    (see StreamingCapture), with the FFC files registered as calibrated at
+    ffc_exposure_us (default: the exposure recorded in a calibration store, or
+    the exposure set when called).
+
+    With a CalibrationLibrary as calibrations, manual FFC selects the set of
+    each frame from the library instead of using the files of ffc_folder.
+    """
+    # Precompute the FFC gain map once for the whole stream.
+    ffc = None
+    ffc_id = ""
+    if not compute_ffc_manually:
+        calibrations = None
+    elif calibrations is not None:
+        if auto_exposure is not None:
+            auto_exposure.calibrations.update(calibrations.exposures())
+    else:
+        flat_field, dark_field, ffc_id, calibrated_exposure_us = load_manual_ffc(ffc_folder)
+        ffc = FFCCorrector(flat_field, dark_field)
+        if auto_exposure is not None:
+            auto_exposure.calibrations.setdefault(ffc_exposure_us or calibrated_exposure_us or cam.get_exposure(),
+                                                  ffc_id)
+
+    output_format = "raw"
+    if is_jpeg_path(output):
+        output, output_format = os.path.splitext(output)[0], "jpeg"
+
+    stream = StreamingCapture(cam, output, output_format=output_format, buffer_size=buffer_size,
+                              num_workers=num_workers, ffc=ffc, ffc_id=ffc_id, block_timeout=block_timeout,
+                              auto_exposure=auto_exposure, calibrations=calibrations)
+    print('Starting streaming acquisition...')
+    start = time.perf_counter()
+    stream.start(num_frames)
+    try:
+        while stream.is_running():
+            time.sleep(1.0)
+            print('Frames: {}'.format(stream.stats()))
+    except KeyboardInterrupt:
+        print('Stopping acquisition...')
+    stream.stop()
+
+    elapsed = time.perf_counter() - start
+    stats = stream.stats()
+    print('Final counters: {}'.format(stats))
+    print('Throughput: {:.1f} frames/s'.format(stats["processed"] / elapsed))
+    latency = profiling.stats("frame_to_disk")
+    if latency is not None:
+        p50, p90, p99 = latency.percentiles() * 1e3
+        print('Frame to disk latency: p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+            p50, p90, p99, latency.max_s * 1e3))
+    if auto_exposure is not None:
+        report_exposure(auto_exposure)
+    return stats
+
+def main():
+    # ------------- Options -------------
+    parser = argparse.ArgumentParser(description="Capture RAW8 images from a Ximea camera.")
+    parser.add_argument("--output", default="captures",
+                        help="Raw frame store folder to append to, or a .jpg filename to save JPEG instead.")
+    parser.add_argument("--ffc", choices=["manual", "builtin", "none"], default="manual",
+                        help="Flat field correction method.")
+    parser.add_argument("--ffc-folder", default="ffc",
+                        help="Folder containing the FFC TIFF files, or a calibration store of averaged fields.")
+    parser.add_argument("--calibrations", default=None,
+                        help="Calibration library folder (see calibration.py) used for manual FFC instead of --ffc-folder.")
+    parser.add_argument("--exposure", type=int, default=100000, help="Exposure in microseconds.")
+    parser.add_argument("--gain", type=float, default=0, help="Gain in dB.")
+    parser.add_argument("--stream", action="store_true", help="Capture continuously instead of a single frame.")
+    parser.add_argument("--frames", type=int, default=None, help="Number of frames to stream (default: until Ctrl+C).")
+    parser.add_argument("--buffer-size", type=int, default=16, help="Number of frames in the ring buffer.")
+    parser.add_argument("--workers", type=int, default=2, help="Number of FFC/encode/write workers.")
+    parser.add_argument("--block-timeout", type=float, default=0.0,
+                        help="Seconds to wait for a free buffer slot before dropping a frame.")
+    parser.add_argument("--auto-exposure", action="store_true",
+                        help="Adjust exposure (then gain) from the band histograms to avoid clipping.")
+    parser.add_argument("--target", type=float, default=180.0,
+                        help="Auto exposure target for the 99th percentile of the brightest band, in DN.")
+    parser.add_argument("--max-exposure", type=int, default=500000, help="Auto exposure limit in microseconds.")
+    parser.add_argument("--max-gain", type=float, default=12.0, help="Auto exposure gain limit in dB.")
+    parser.add_argument("--ffc-exposure", type=int, default=None,
+                        help="Exposure the FFC files were calibrated at (default: the exposure recorded in "
+                             "the FFC calibration store, otherwise the camera's exposure when capture "
+                             "starts, normally --exposure).")
+    parser.add_argument("--simulate", metavar="FOLDER", nargs="?", const="fb_images", default=None,
+                        help="Replay images from FOLDER instead of using a camera.")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.start(args)
+
+    auto_exposure = None
+    if args.auto_exposure:
+        auto_exposure = AutoExposure(target=args.target, max_exposure_us=args.max_exposure,
+                                     max_gain_db=args.max_gain)
+
+    calibrations = CalibrationLibrary(args.calibrations) if args.calibrations else None
+
+    cam = open_camera(simulate=args.simulate is not None, exposure=args.exposure, gain=args.gain,
+                      image_folder=args.simulate)
+    try:
+        if args.stream:
+            if args.ffc == "builtin":
+                raise ValueError("Streaming only supports manual FFC or none.")
+            capture_stream(cam, args.output, num_frames=args.frames, buffer_size=args.buffer_size,
+                           num_workers=args.workers, compute_ffc_manually=args.ffc == "manual",
+                           ffc_folder=args.ffc_folder, block_timeout=args.block_timeout,
+                           auto_exposure=auto_exposure, ffc_exposure_us=args.ffc_exposure,
+                           calibrations=calibrations)
+        else:
+            capture_single(cam, args.output, use_builtin_ffc=args.ffc == "builtin",
+                           compute_ffc_manually=args.ffc == "manual", ffc_folder=args.ffc_folder,
+                           auto_exposure=auto_exposure, ffc_exposure_us=args.ffc_exposure,
+                           calibrations=calibrations)
+    finally:
+        cam.close_device()
+        print('Camera closed.')
+    profiling.finish(args)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+import numpy as np
+
+from utils import demosaic_ximea_5x5_array
+
+METHODS = ("sam", "distance", "lda")
+
+def load_profiles(path="spectral_profiles.npz"):
+    """
+    Loads the positive/negative box spectra saved by pos_and_neg.py.
+
+    Returns:
+    - positives: numpy.ndarray
+        Array of shape (num_positive_boxes, num_bands).
+    - negatives: numpy.ndarray
+        Array of shape (num_negative_boxes, num_bands).
+    """
+    with np.load(path) as data:
+        return data["positives"], data["negatives"]
+
+class SpectralClassifier:
+    """
+    Per-pixel classifier of hypercubes against the positive and negative
+    spectral signatures. Every method is evaluated with one small GEMM per
+    chunk of rows, (k, num_bands) @ (num_bands, pixels) in float32, plus the
+    per-pixel squared norm where needed, so memory stays bounded by the chunk.
+
+    Scores are positive for pixels that look like the positive class:
+    - "sam": spectral angle to the negative mean minus angle to the positive mean (radians).
+    - "distance": squared distance to the negative mean minus distance to the
+      positive mean, after dividing each spectrum by its mean intensity so
+      brightness does not matter.
+    - "lda": Fisher linear discriminant fitted on the box spectra, with the
+      threshold halfway between the class means.
+
+    Parameters:
+    - positives: numpy.ndarray
+        Positive box spectra of shape (n, num_bands).
+    - negatives: numpy.ndarray
+        Negative box spectra of shape (m, num_bands).
+    - method: str
+        One of METHODS.
+    - shrinkage: float
+        Covariance shrinkage towards the identity for "lda", as a fraction of
+        the mean variance. The box spectra are too few for a stable 25x25 inverse.
+    """
+
+    def __init__(self, positives, negatives, method="sam", shrinkage=0.1):
+        if method not in METHODS:
+            raise ValueError(f"Unknown method {method}, expected one of {METHODS}.")
+
+        positives = np.asarray(positives, dtype=np.float64)
+        negatives = np.asarray(negatives, dtype=np.float64)
+        positive_mean = positives.mean(axis=0)
+        negative_mean = negatives.mean(axis=0)
+        num_bands = positive_mean.shape[0]
+
+        self.method = method
+        self.num_bands = num_bands
+
+        if method == "sam":
+            # Rows: unit positive and negative references.
+            references = np.stack([positive_mean, negative_mean])
+            self._weights = references / np.linalg.norm(references, axis=1, keepdims=True)
+        elif method == "distance":
+            # Rows: references normalized to mean 1, then the mean operator.
+            references = np.stack([positive_mean / positive_mean.mean(), negative_mean / negative_mean.mean()])
+            self._reference_norms = (references ** 2).sum(axis=1)
+            self._weights = np.vstack([references, np.full(num_bands, 1.0 / num_bands)])
+        else:
+            centered = np.vstack([positives - positive_mean, negatives - negative_mean])
+            scatter = centered.T @ centered / max(len(centered) - 2, 1)
+            scatter += shrinkage * np.trace(scatter) / num_bands * np.eye(num_bands)
+            direction = np.linalg.solve(scatter, positive_mean - negative_mean)
+            self._weights = direction[None, :]
+            self._bias = -direction @ (positive_mean + negative_mean) / 2
+
+        self._weights = self._weights.astype(np.float32)
+
+    @classmethod
+    def from_profiles(cls, path="spectral_profiles.npz", method="sam", **kwargs):
+        return cls(*load_profiles(path), method=method, **kwargs)
+
+    def _score_pixels(self, pixels):
+        # pixels: (num_bands, P) float32 -> (P,) float32 scores.
+        products = self._weights @ pixels
+        if self.method == "lda":
+            return products[0] + np.float32(self._bias)
+
+        squared_norms = np.einsum("bp,bp->p", pixels, pixels)
+        if self.method == "sam":
+            norms = np.sqrt(squared_norms)
+            np.maximum(norms, np.float32(1e-6), out=norms)
+            cosines = np.clip(products / norms, -1.0, 1.0)
+            angles = np.arccos(cosines)
+            return angles[1] - angles[0]
+
+        # ||x / m - r||^2 = |x|^2 / m^2 - 2 x.r / m + |r|^2, with m = mean(x).
+        means = np.maximum(products[2], np.float32(1e-6))
+        distances = (squared_norms / means ** 2)[None] - 2 * products[:2] / means + \
+            self._reference_norms[:, None].astype(np.float32)
+        return distances[1] - distances[0]
+
+    def score(self, hypercube, chunk_rows=32, out=None):
+        """
+        Scores every pixel of a hypercube (or a stack of them).
+
+        Parameters:
+        - hypercube: numpy.ndarray
+            Array of shape (num_bands, height, width) or (N, num_bands, height, width).
+        - chunk_rows: int
+            Number of rows converted to float32 and scored at a time.
+        - out: numpy.ndarray, optional
+            float32 output of shape (height, width) or (N, height, width).
+
+        Returns:
+        - scores: numpy.ndarray
+            float32 score map; positive means closer to the positive class.
+        """
+
+        cubes = hypercube[None] if hypercube.ndim == 3 else hypercube
+        num_frames, num_bands, height, width = cubes.shape
+        if num_bands != self.num_bands:
+            raise ValueError(f"Expected {self.num_bands} bands, got {num_bands}.")
+        if out is None:
+            out = np.empty((num_frames, height, width), dtype=np.float32)
+        scores = out.reshape(num_frames, height, width)
+
+        pixels = np.empty((num_bands, chunk_rows * width), dtype=np.float32)
+        for frame, cube in enumerate(cubes):
+            for row in range(0, height, chunk_rows):
+                rows = min(chunk_rows, height - row)
+                chunk = pixels[:, :rows * width]
+                np.copyto(chunk.reshape(num_bands, rows, width), cube[:, row:row + rows], casting="unsafe")
+                scores[frame, row:row + rows] = self._score_pixels(chunk).reshape(rows, width)
+
+        return out.reshape(hypercube.shape[:-3] + (height, width))
+
+    def predict(self, hypercube, threshold=0.0, chunk_rows=32):
+        """
+        Returns the boolean mask of pixels whose score is above threshold.
+        """
+        return self.score(hypercube, chunk_rows) > threshold
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify every pixel of Ximea mosaic images.")
+    parser.add_argument("images", nargs="+", help="Images to classify.")
+    parser.add_argument("--profiles", default="spectral_profiles.npz", help="Spectra saved by pos_and_neg.py.")
+    parser.add_argument("--method", choices=METHODS, default="sam", help="Classification method.")
+    parser.add_argument("--threshold", type=float, default=0.0, help="Score threshold of the positive class.")
+    parser.add_argument("--masks", help="Folder where the masks are saved as PNG.")
+    args = parser.parse_args()
+
+    classifier = SpectralClassifier.from_profiles(args.profiles, method=args.method)
+    if args.masks:
+        import cv2
+        os.makedirs(args.masks, exist_ok=True)
+
+    start = time.perf_counter()
+    for image_path in args.images:
+        mask = classifier.predict(demosaic_ximea_5x5_array(image_path), args.threshold)
+        print(f"{image_path}: {mask.mean() * 100:.2f}% positive")
+        if args.masks:
+            name = os.path.splitext(os.path.basename(image_path))[0] + "_mask.png"
+            cv2.imwrite(os.path.join(args.masks, name), mask.astype(np.uint8) * 255)
+    elapsed = time.perf_counter() - start
+    print(f"Throughput: {len(args.images) / elapsed:.1f} frames/s")
+
+if __name__ == "__main__":
+    main()
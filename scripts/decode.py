@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import profiling
+
+# Geometry of a full RAW8 frame from the Ximea NIR camera, the shape of
+# headerless .bin/.raw frame dumps.
+RAW_FRAME_SHAPE = (1088, 2048)
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff")
+RAW_EXTENSIONS = (".bin", ".raw")
+
+_NPY_HEADER_READERS = {
+    (1, 0): np.lib.format.read_array_header_1_0,
+    (2, 0): np.lib.format.read_array_header_2_0,
+}
+
+# Per-thread decode buffers, reused across calls of the same shape.
+_scratch = threading.local()
+
+def read_npy_header(file, path=""):
+    """
+    Reads the header of an open .npy file, leaving the file at the start of
+    the data.
+
+    Returns:
+    - shape: tuple
+    - dtype: numpy.dtype
+    """
+    version = np.lib.format.read_magic(file)
+    if version not in _NPY_HEADER_READERS:
+        raise ValueError(f"Unsupported .npy version {version}: {path}")
+    shape, fortran_order, dtype = _NPY_HEADER_READERS[version](file)
+    if fortran_order:
+        raise ValueError(f"Fortran ordered arrays are not supported: {path}")
+    return shape, dtype
+
+def _scratch_buffer(shape):
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        _scratch.buffer = buffer
+    return buffer
+
+def _output(out, shape, path):
+    if out is None:
+        return np.empty(shape, dtype=np.uint8)
+    if out.shape != shape or out.dtype != np.uint8:
+        raise ValueError(f"Output must be a uint8 array of shape {shape} to read {path}, got {out.dtype} {out.shape}.")
+    return out
+
+def _crop_window(shape, crop):
+    rows, cols = crop if crop is not None else (slice(None), slice(None))
+    rows, cols = range(shape[0])[rows], range(shape[1])[cols]
+    if rows.step != 1 or cols.step != 1:
+        raise ValueError("Crop slices must have a step of 1.")
+    return rows, cols
+
+def _read_rows(file, offset, shape, crop, out, path):
+    # Reads the rows of the crop window with readinto (the GIL is released
+    # during the read), straight into out when the window spans whole rows.
+    rows, cols = _crop_window(shape, crop)
+    out = _output(out, (len(rows), len(cols)), path)
+    file.seek(offset + rows.start * shape[1])
+    if len(cols) == shape[1] and out.flags.c_contiguous:
+        target = out
+    else:
+        target = _scratch_buffer((len(rows), shape[1]))
+    if file.readinto(memoryview(target).cast("B")) != target.nbytes:
+        raise ValueError(f"Truncated frame file: {path}")
+    if target is not out:
+        with profiling.stage("crop", out.nbytes):
+            np.copyto(out, target[:, cols.start:cols.stop])
+    return out
+
+def _decode_image(path, out, crop):
+    import cv2
+
+    # Decode straight into out when the whole frame is wanted, otherwise into
+    # a per-thread buffer the crop is copied from.
+    if crop is None:
+        target = out
+    else:
+        target = getattr(_scratch, "image", None) if out is not None else None
+    image = None
+    if target is not None:
+        try:
+            image = cv2.imread(path, target, cv2.IMREAD_GRAYSCALE)
+        except (TypeError, cv2.error):
+            # OpenCV < 4.10 cannot decode into a preallocated array, and newer
+            # versions refuse one of another size than the image.
+            image = None
+    if image is None:
+        # Colour images are converted to grayscale, as with load_raw8_image.
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise FileNotFoundError(f"Image not found or unable to read: {path}")
+    if crop is not None and out is not None:
+        _scratch.image = image
+
+    rows, cols = _crop_window(image.shape, crop)
+    window = image[rows.start:rows.stop, cols.start:cols.stop]
+    if out is None:
+        return window
+    if not np.shares_memory(window, out):
+        with profiling.stage("crop", window.nbytes):
+            np.copyto(_output(out, window.shape, path), window)
+    return out
+
+@profiling.timed("decode", count_bytes="output")
+def read_raw8(path, out=None, crop=None, raw_shape=RAW_FRAME_SHAPE):
+    """
+    Decodes a RAW8 mosaic frame from PNG, TIFF, .npy or headerless .bin/.raw.
+
+    Each file is decoded once, straight into out when it is given, so a
+    caller can reuse one buffer for a whole sequence of frames. .npy and
+    raw files are read with file.readinto and only the rows of the crop
+    window are read. PNG and TIFF must be decoded whole: the crop is then
+    copied out of a per-thread buffer. Reads and decodes release the GIL,
+    so read_raw8 scales across a thread pool (see read_many).
+
+    Parameters:
+    - path: str
+        Path of the frame.
+    - out: numpy.ndarray, optional
+        uint8 array of the (cropped) frame shape to decode into.
+    - crop: tuple of slice, optional
+        (rows, cols) window to read, e.g. layout.crop_slices.
+    - raw_shape: tuple
+        (height, width) of headerless raw files.
+
+    Returns:
+    - image: numpy.ndarray
+        uint8 array of shape (height, width), out if it was given.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".npy" or extension in RAW_EXTENSIONS:
+        with open(path, "rb", buffering=0) as file:
+            shape, dtype = (tuple(raw_shape), np.dtype(np.uint8))
+            if extension == ".npy":
+                shape, dtype = read_npy_header(file, path)
+            elif os.fstat(file.fileno()).st_size != shape[0] * shape[1]:
+                raise ValueError(f"Raw file {path} does not hold a single {shape[0]} x {shape[1]} RAW8 frame.")
+            if dtype != np.uint8 or len(shape) != 2:
+                raise TypeError(f"Expected a 2D uint8 array, got {dtype} {shape}: {path}")
+            return _read_rows(file, file.tell(), shape, crop, out, path)
+    return _decode_image(path, out, crop)
+
+def read_many(paths, out=None, crop=None, workers=None, raw_shape=RAW_FRAME_SHAPE):
+    """
+    Decodes several frames of the same shape into one stack with a thread
+    pool, each worker decoding straight into its slice of the stack.
+
+    Parameters:
+    - paths: list of str
+    - out: numpy.ndarray, optional
+        uint8 array of shape (len(paths), height, width).
+    - crop: tuple of slice, optional
+    - workers: int, optional
+        Number of threads (default: number of CPUs).
+
+    Returns:
+    - images: numpy.ndarray
+        uint8 array of shape (len(paths), height, width).
+    """
+    paths = list(paths)
+    if not paths:
+        return np.empty((0, 0, 0), dtype=np.uint8) if out is None else out
+    if out is None:
+        first = read_raw8(paths[0], crop=crop, raw_shape=raw_shape)
+        out = np.empty((len(paths), *first.shape), dtype=np.uint8)
+        out[0] = first
+        start = 1
+    else:
+        start = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda i: read_raw8(paths[i], out[i], crop, raw_shape), range(start, len(paths))))
+    return out
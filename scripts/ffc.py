@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+import threading
+import numpy as np
+
+import profiling
+from utils import XIMEA_NIR_5X5, demosaic_array
+
+# Percentile of the gains of the live pixels that must fit in the uint16
+# fixed-point range. It sets the shift, so a few near-dead pixels (flat
+# barely above dark) do not cost every other pixel its precision.
+GAIN_PERCENTILE = 99.9
+
+def apply_manual_ffc(np_image, flat_field, dark_field):
+    """
+    Applies flat field correction to a RAW8 image in float32. This is the
+    reference implementation of the manual FFC; FFCCorrector computes the
+    same correction with precomputed integer maps.
+
+    Parameters:
+    - np_image: numpy.ndarray
+        The uint8 image to correct.
+    - flat_field: numpy.ndarray
+    - dark_field: numpy.ndarray
+
+    Returns:
+    - corrected_image: numpy.ndarray
+        The corrected uint8 image.
+    """
+
+    # Convert images to float32 for computation.
+    np_image_float = np_image.astype(np.float32)
+    dark_field_float = dark_field.astype(np.float32)
+    flat_field_float = flat_field.astype(np.float32)
+
+    # Compute the denominator, adding a small epsilon to avoid division by zero.
+    epsilon = 1e-6
+    ratio = (np_image_float - dark_field_float) / (flat_field_float - dark_field_float + epsilon)
+
+    # Scale factor: use the mean of (flat_field - dark_field) to preserve brightness.
+    scale = np.mean(flat_field_float - dark_field_float)
+    corrected_image = ratio * scale
+    return np.clip(corrected_image, 0, 255).astype(np.uint8)
+
+class FFCCorrector:
+    """
+    Flat field correction with a precomputed fixed-point gain map.
+
+    The correction scale * (image - dark) / (flat - dark) is rewritten as
+    (max(image, dark) - dark) * gain >> shift, where gain is a uint16 map of
+    round(scale / (flat - dark) * 2**shift). The flat and dark fields are only
+    read once, and each frame is corrected with uint8 subtracts, one uint32
+    multiply and a shift instead of three float32 conversions and a division.
+    The shift is the largest that keeps GAIN_PERCENTILE of the gains within
+    uint16 (see fixed_point_shift_for_spans).
+
+    Dead pixels, where flat <= dark, are set to 255 where image > dark and to
+    0 elsewhere. For flat == dark this matches the float path, whose
+    denominator is then ~0. For flat < dark the float path flips the sign
+    instead (0 where image > dark, a positive value where image < dark);
+    both are meaningless, and saturating flags the pixel the same way.
+    Near-dead pixels whose gain does not fit in uint16 at that shift are
+    treated as dead too: their gain is far above that of the other pixels,
+    so the float path saturates them for all but the faintest signals.
+
+    Parameters:
+    - flat_field: numpy.ndarray
+        uint8 flat field image.
+    - dark_field: numpy.ndarray
+        uint8 dark field image of the same shape.
+    - scale: float, optional
+        Output brightness scale, > 0. Defaults to mean(flat - dark), as in the
+        float path.
+    """
+
+    def __init__(self, flat_field, dark_field, scale=None):
+        if flat_field.shape != dark_field.shape:
+            raise ValueError("Flat field/dark field image dimensions do not match.")
+
+        gain, scale = _gain_map(flat_field, dark_field, scale)
+        shift = fixed_point_shift_for_spans(span_histogram(flat_field, dark_field), scale)
+        fixed_gain = _fixed_point_gain(gain, shift)
+        self._set_maps(dark_field, fixed_gain, shift, scale, fixed_gain == 0)
+
+    @classmethod
+    def from_maps(cls, dark, gain, shift, scale=None, dead=None):
+        """
+        Builds a corrector from precomputed maps, e.g. those of another
+        corrector demosaiced or cut into tiles.
+
+        Parameters:
+        - dark: numpy.ndarray
+            uint8 dark field.
+        - gain: numpy.ndarray
+            uint16 fixed-point gain map of the same shape.
+        - shift: int
+            Number of fractional bits of gain.
+        - scale: float, optional
+            Brightness scale the gain map was computed with (informative).
+        - dead: numpy.ndarray, optional
+            Boolean map of the dead pixels (flat <= dark, or a gain too large
+            for the shift), whose gain is 0.
+        """
+        if dark.shape != gain.shape or (dead is not None and dead.shape != dark.shape):
+            raise ValueError("Dark, gain and dead pixel maps must have the same shape.")
+        corrector = cls.__new__(cls)
+        corrector._set_maps(dark, gain, shift, scale, dead)
+        return corrector
+
+    def _set_maps(self, dark, gain, shift, scale, dead):
+        self.scale = scale
+        self.shift = int(shift)
+        self.dark = np.ascontiguousarray(dark, dtype=np.uint8)
+        self.gain = np.ascontiguousarray(gain, dtype=np.uint16)
+        self.dead = np.zeros(self.dark.shape, dtype=bool) if dead is None else np.asarray(dead, dtype=bool)
+        # Indices of the dead pixels in the trailing dimensions, fixed up after
+        # the multiply (their gain is 0).
+        self._dead_index = (Ellipsis, *np.nonzero(self.dead)) if self.dead.any() else None
+        self._scratch = threading.local()
+
+    @property
+    def shape(self):
+        return self.dark.shape
+
+    def _scratch_buffer(self, shape):
+        # Per-thread uint32 product buffer so workers can share one corrector.
+        buffer = getattr(self._scratch, "buffer", None)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=np.uint32)
+            self._scratch.buffer = buffer
+        return buffer
+
+    @profiling.timed("ffc")
+    def apply(self, image, out=None):
+        """
+        Corrects a uint8 frame, or a stack of frames whose trailing dimensions
+        match the corrector.
+
+        Parameters:
+        - image: numpy.ndarray
+            uint8 frame(s) to correct.
+        - out: numpy.ndarray, optional
+            uint8 output array. Pass image itself to correct in place.
+
+        Returns:
+        - corrected_image: numpy.ndarray
+        """
+
+        if image.dtype != np.uint8:
+            raise TypeError(f"Expected a uint8 image, got {image.dtype}.")
+        if image.shape[image.ndim - self.dark.ndim:] != self.shape:
+            raise ValueError(f"Image shape {image.shape} does not match the FFC shape {self.shape}.")
+        if out is None:
+            out = np.empty_like(image)
+
+        product = self._scratch_buffer(image.shape)
+
+        # (max(image, dark) - dark) never underflows, and clips negative values to 0.
+        np.maximum(image, self.dark, out=out)
+        np.subtract(out, self.dark, out=out)
+        if self._dead_index is not None:
+            saturated = out[self._dead_index] > 0
+
+        # Fixed-point multiply, then shift back to integer intensities. The shift
+        # truncates like the float path's cast to uint8.
+        np.multiply(out, self.gain, out=product, dtype=np.uint32)
+        product >>= self.shift
+        np.minimum(product, 255, out=product)
+        np.copyto(out, product, casting="unsafe")
+        if self._dead_index is not None:
+            out[self._dead_index] = saturated * np.uint8(255)
+        return out
+
+    def demosaiced(self, layout=XIMEA_NIR_5X5):
+        """
+        Returns a corrector for hypercubes demosaiced with layout, so the
+        correction can be applied per band after demosaicing. The dark field
+        and gain map are demosaiced the same way as the frames.
+
+        Parameters:
+        - layout: MosaicLayout
+            Layout used to demosaic the frames.
+
+        Returns:
+        - corrector: FFCCorrector
+            A corrector of shape layout.output_shape.
+        """
+
+        return FFCCorrector.from_maps(demosaic_array(self.dark, layout), demosaic_array(self.gain, layout),
+                                      self.shift, self.scale, demosaic_array(self.dead, layout))
+
+def gain_table(scale, shift):
+    """
+    Returns the fixed-point gain of every possible flat - dark span of uint8
+    fields, as a uint16 table indexed by the span (0 for dead pixels: span 0
+    and the spans whose gain does not fit at shift). It gives the same gain map as FFCCorrector for the same scale and
+    shift, so fields too large to load can be corrected piecewise with
+    FFCCorrector.from_maps.
+    """
+    spans = np.arange(256, dtype=np.float64)
+    gain = np.divide(scale, spans, out=np.zeros_like(spans), where=spans > 0)
+    return _fixed_point_gain(gain, shift)
+
+def _gain_map(flat_field, dark_field, scale=None):
+    # Float64 gain scale / (flat - dark), 0 on dead pixels (flat <= dark).
+    span = flat_field.astype(np.float64) - dark_field.astype(np.float64)
+    if scale is None:
+        scale = float(np.mean(span))
+    if not scale > 0:
+        raise ValueError(f"The FFC scale must be positive, got {scale}.")
+    gain = np.divide(scale, span, out=np.zeros_like(span), where=span > 0)
+    return gain, scale
+
+def span_histogram(flat_field, dark_field):
+    """
+    Returns the number of pixels of each flat - dark span of uint8 fields,
+    an int64 array of 256 counts where index 0 counts the dead pixels
+    (flat <= dark). Histograms of parts of the fields can be summed.
+    """
+    span = flat_field.astype(np.int16) - dark_field
+    np.maximum(span, 0, out=span)
+    return np.bincount(span.ravel(), minlength=256)
+
+def fixed_point_shift(max_gain):
+    """
+    Returns the number of fractional bits that keeps gains up to max_gain
+    within uint16.
+    """
+    return int(np.clip(15 - np.ceil(np.log2(max_gain + 1)), 0, 15))
+
+def fixed_point_shift_for_spans(span_counts, scale):
+    """
+    Returns the fixed-point shift of the gains scale / span of fields with
+    the given span_histogram: the largest that keeps GAIN_PERCENTILE of the
+    gains of the live pixels within uint16.
+    """
+    live = np.cumsum(span_counts[1:])
+    if live[-1] == 0:
+        return fixed_point_shift(1.0)
+    # Gains fall as the span grows, so the percentile gain is that of the
+    # span at the complementary percentile.
+    span = 1 + int(np.searchsorted(live, (100.0 - GAIN_PERCENTILE) / 100.0 * live[-1]))
+    return fixed_point_shift(scale / span)
+
+def _fixed_point_gain(gain, shift):
+    # Gains that do not fit in uint16 become 0 (dead), and positive gains that
+    # round to 0 become 1, so a gain is 0 exactly where the pixel is dead.
+    fixed = np.maximum(np.round(gain * (1 << shift)), gain > 0)
+    fixed[fixed > np.iinfo(np.uint16).max] = 0
+    return fixed.astype(np.uint16)
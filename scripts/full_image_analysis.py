@@ -1,12 +1,28 @@
 #!/usr/bin/env python3
+import os
+import csv
+import glob
+import time
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import make_interp_spline
 import argparse
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from utils import demosaic_ximea_5x5
+from utils import XIMEA_NIR_5X5, demosaic_ximea_5x5_array, band_wavelengths, load_raw8_image
+from raw_store import RawFrameStore, is_raw_store
+from hypercube_cache import HypercubeCache
+from spectral_stats import SpectralReducer, band_histograms, summarize_histograms, histogram_percentiles
+from plotting import use_headless, spectral_axes, plot_spectra, show_or_save
+import profiling
 
-def plot_multiple_spectral_intensities(image_spectra, spectral_range):
+# Image extensions picked up when a folder is given to the batch analyzer.
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+# Per-band statistics computed by the batch analyzer, in table column order.
+BAND_STATISTICS = ("mean", "std", "min", "max", "saturated", "p5", "p50", "p95")
+
+def plot_multiple_spectral_intensities(image_spectra, spectral_range, output=None):
     """
     Plot the spectral intensities for multiple images on the same graph.
     
@@ -16,56 +32,235 @@ def plot_multiple_spectral_intensities(image_spectra, spectral_range):
           the average intensity for each spectral band.
       spectral_range : numpy.ndarray
           1D array of wavelength values (in nm) corresponding to each band.
+      output : str, optional
+          Path of an image file to save the plot to instead of showing it.
     """
-    plt.figure(figsize=(10, 5))
-    x = np.arange(len(spectral_range))
-    
-    # Loop over each image and plot its spectral intensities.
-    colors = ['b', 'r', 'g', 'c', 'm', 'y', 'k']
-    color_index = 0
-    for filename, intensities in image_spectra.items():
-        # Create a smooth curve for visualization using spline interpolation.
-        x_smooth = np.linspace(x.min(), x.max(), 300)
-        intensities_smooth = make_interp_spline(x, intensities)(x_smooth)
-        plt.plot(x_smooth, intensities_smooth, linewidth=2, label=filename, color=colors[color_index % len(colors)])
-        plt.plot(x, intensities, 'o', color=colors[color_index % len(colors)])  # Plot original points
-        color_index += 1
-        
-    plt.xticks(x, [f"{int(wl)} nm" for wl in spectral_range], rotation=45)
-    plt.xlabel("Band Index")
-    plt.ylabel("Average Intensity")
-    plt.title("Spectral Bands")
-    plt.grid(True)
-    plt.legend()
-    plt.tight_layout()
-    plt.show()
+    fig, ax = spectral_axes(spectral_range)
+
+    # All spectra are smoothed with a single spline basis multiply.
+    plot_spectra(ax, np.array(list(image_spectra.values())), labels=list(image_spectra))
+    ax.legend()
+    show_or_save(fig, output)
+
+def iter_hypercubes(image_files):
+    """
+    Yields (name, hypercube) for each image file. Raw frame stores yield one
+    hypercube per frame, demosaiced straight from the memory-mapped frames.
+    """
+    for image_file in image_files:
+        if is_raw_store(image_file):
+            store = RawFrameStore(image_file)
+            for index in range(len(store)):
+                yield f"{image_file}[{index}]", store.hypercube(index)
+        else:
+            yield image_file, demosaic_ximea_5x5_array(image_file)
+
+def collect_inputs(paths):
+    """
+    Expands folders, glob patterns and raw frame stores into a flat list of
+    inputs for the batch analyzer.
+
+    Parameters:
+    - paths: list of str
+        Image files, folders of images, glob patterns or raw frame store folders.
+
+    Returns:
+    - inputs: list of tuple
+        (name, path, frame_index) for every frame, where frame_index is None
+        for image files.
+    """
+    inputs = []
+    for path in paths:
+        if is_raw_store(path):
+            num_frames = len(RawFrameStore(path))
+            inputs += [(f"{path}[{index}]", path, index) for index in range(num_frames)]
+        elif os.path.isdir(path):
+            image_files = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXTENSIONS))
+            inputs += [(image_file, os.path.join(path, image_file), None) for image_file in image_files]
+        else:
+            matches = sorted(glob.glob(path)) or [path]
+            inputs += [(os.path.basename(match), match, None) for match in matches]
+    return inputs
+
+@lru_cache(maxsize=None)
+def _open_store(path):
+    # Opened once per worker process and shared by its threads.
+    return RawFrameStore(path)
+
+_buffers = threading.local()
+
+# Hypercube cache of the current process, set by _init_cache.
+_cache = None
+
+def _init_cache(cache_dir):
+    global _cache
+    _cache = HypercubeCache(cache_dir) if cache_dir else None
+
+def band_statistics(histograms):
+    """
+    Computes BAND_STATISTICS for every band from its 256-bin histogram, so
+    the pixels are only read once (see spectral_stats.band_histograms).
+
+    Parameters:
+    - histograms: numpy.ndarray
+        Array of shape (num_bands, 256).
+
+    Returns:
+    - stats: numpy.ndarray
+        float64 array of shape (len(BAND_STATISTICS), num_bands).
+    """
+    summary = summarize_histograms(histograms)
+    percentiles = histogram_percentiles(histograms, (5, 50, 95))
+    return np.stack([summary["mean"], np.sqrt(summary["var"]), summary["min"], summary["max"],
+                     summary["saturated"], *percentiles.T])
+
+def analyze_input(path, frame_index=None):
+    """
+    Decodes and demosaics a single input and returns its band histograms, of
+    shape (num_bands, 256). The frame and the hypercube are written into
+    per-thread buffers that are reused across calls, or the hypercube is read
+    from the hypercube cache if enabled.
+    """
+    if frame_index is None and _cache is not None:
+        return band_histograms(_cache.get(path))
+    if frame_index is None:
+        try:
+            frame = load_raw8_image(path, _buffers.frame)
+        except (AttributeError, ValueError):
+            # First frame of the thread, or of another shape than the last one.
+            frame = _buffers.frame = load_raw8_image(path)
+    else:
+        frame = _open_store(path)[frame_index]
+
+    out = getattr(_buffers, "hypercube", None)
+    if out is None:
+        out = _buffers.hypercube = np.empty(XIMEA_NIR_5X5.output_shape, dtype=np.uint8)
+    return band_histograms(demosaic_ximea_5x5_array(frame, out=out))
+
+def _analyze_chunk(chunk):
+    return [analyze_input(path, frame_index) for _, path, frame_index in chunk]
+
+def analyze_batch(inputs, workers=None, use_processes=False, chunk_size=8, cache_dir=None):
+    """
+    Runs analyze_input over every input with a pool of workers. Threads are
+    the default since cv2 decoding and the numpy reductions release the GIL;
+    processes avoid the GIL entirely at the cost of worker start up.
+
+    Parameters:
+    - inputs: list of tuple
+        Inputs returned by collect_inputs.
+    - workers: int, optional
+        Number of workers (default: number of CPUs).
+    - use_processes: bool
+        Use a process pool instead of a thread pool.
+    - chunk_size: int
+        Number of inputs handed to a worker at a time.
+    - cache_dir: str, optional
+        Folder of a HypercubeCache for image files, shared by all workers.
+
+    Returns:
+    - stats: numpy.ndarray
+        float64 array of shape (len(inputs), len(BAND_STATISTICS), num_bands).
+    - reducer: SpectralReducer
+        Statistics of all inputs together.
+    """
+    workers = workers or os.cpu_count()
+    chunks = [inputs[i:i + chunk_size] for i in range(0, len(inputs), chunk_size)]
+
+    if use_processes:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_cache, initargs=(cache_dir,))
+    else:
+        _init_cache(cache_dir)
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    reducer = SpectralReducer(XIMEA_NIR_5X5.num_bands)
+    stats = np.empty((len(inputs), len(BAND_STATISTICS), XIMEA_NIR_5X5.num_bands))
+    with pool:
+        all_histograms = (histograms for chunk in pool.map(_analyze_chunk, chunks) for histograms in chunk)
+        for i, histograms in enumerate(all_histograms):
+            stats[i] = band_statistics(histograms)
+            reducer.update_histograms(histograms)
+
+    return stats, reducer
+
+def write_results(output_path, names, stats, spectral_range):
+    """
+    Writes the batch statistics as one table, as CSV (one row per input and a
+    column per statistic and band) or as NPZ, chosen by extension.
+    """
+    if output_path.endswith(".npz"):
+        np.savez(output_path, names=np.array(names), stats=stats,
+                 statistics=np.array(BAND_STATISTICS), spectral_range=spectral_range)
+        return
+
+    header = ["name"] + [f"{stat}_{int(wl)}" for stat in BAND_STATISTICS for wl in spectral_range]
+    with open(output_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for name, row in zip(names, stats.reshape(len(stats), -1)):
+            writer.writerow([name] + [f"{value:.4f}" for value in row])
+
+def batch_main(args):
+    inputs = collect_inputs(args.inputs)
+    if args.profile and args.processes:
+        print("Stages run in worker processes are not profiled, use threads to profile them.")
+    print(f"Analyzing {len(inputs)} frames with {args.workers or os.cpu_count()} "
+          f"{'processes' if args.processes else 'threads'}...")
+
+    start = time.perf_counter()
+    stats, reducer = analyze_batch(inputs, workers=args.workers, use_processes=args.processes,
+                                   cache_dir=args.cache)
+    elapsed = time.perf_counter() - start
+
+    # The last row holds the statistics of the whole dataset.
+    names = [name for name, _, _ in inputs] + ["ALL"]
+    stats = np.concatenate([stats, band_statistics(reducer.histograms)[None]])
+    write_results(args.output, names, stats, band_wavelengths())
+    print(f"Wrote {args.output}")
+    print(f"Throughput: {len(inputs) / elapsed:.1f} frames/s ({elapsed:.2f} s)")
 
 def main():
-    
+    parser = argparse.ArgumentParser(description="Per-band statistics of Ximea mosaic images.")
+    parser.add_argument("inputs", nargs="*",
+                        help="Image files, folders, glob patterns or raw frame stores to analyze in batch.")
+    parser.add_argument("--output", default="band_statistics.csv", help="Results table (.csv or .npz).")
+    parser.add_argument("--workers", type=int, default=None, help="Number of workers (default: CPU count).")
+    parser.add_argument("--processes", action="store_true", help="Use a process pool instead of threads.")
+    parser.add_argument("--cache", help="Folder of a hypercube cache reused across runs.")
+    parser.add_argument("--plot", help="Save the plot to this image file instead of showing it.")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.plot:
+        use_headless()
+
+    if args.inputs:
+        profiling.start(args)
+        batch_main(args)
+        profiling.finish(args)
+        return
+
     image_files = ["ros_ffc_applied.jpg", "python_ffc_applied.jpg"]
 
     image_spectra = {}
     spectral_range = []
-    for image_file in image_files:
+    for image_file, hypercube in iter_hypercubes(image_files):
         print(f"Processing image: {image_file}")
-
-        # Convert the image to a multispectral hypercube.
-        # The hypercube should be a dict of 2D numpy arrays, where each key is a spectral band.
-        hypercube = demosaic_ximea_5x5(image_file)
         
-        # Compute the average intensity of each spectral band.
-        avg_intensities = np.array([np.mean(hypercube[band]) for band in hypercube])
+        # Compute the average intensity of each spectral band of the
+        # (25, height/5, width/5) hypercube.
+        avg_intensities = np.mean(hypercube, axis=(1, 2))
 
         # Retrieve the spectral range from the first image.
         if len(spectral_range) == 0:
-            spectral_range = np.array(list(hypercube.keys()))
+            spectral_range = band_wavelengths()
 
         # Store the average intensities for this image.
         image_spectra[image_file] = avg_intensities
         print(f"Average intensities for {image_file}: {avg_intensities}\n")
     
     # Plot all images' spectral intensities on a single graph.
-    plot_multiple_spectral_intensities(image_spectra, spectral_range)
+    plot_multiple_spectral_intensities(image_spectra, spectral_range, output=args.plot)
 
 if __name__ == "__main__":
     main()
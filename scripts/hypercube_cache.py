@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, demosaic_array, load_raw8_image
+
+# Bump when the demosaic output for the same image and layout changes.
+CACHE_VERSION = 1
+
+class HypercubeCache:
+    """
+    Content-addressed cache of demosaiced hypercubes.
+
+    Entries are keyed by a hash of the image file contents, the mosaic layout,
+    the FFC id and CACHE_VERSION, so renamed or copied files still hit and
+    edited files miss. Recently used hypercubes are kept in memory up to
+    memory_budget bytes (least recently used first out). Every entry is also
+    written to cache_dir as a .npy file, which is memory-mapped on a later hit
+    instead of decoding and demosaicing the image again.
+
+    Parameters:
+    - cache_dir: str, optional
+        Folder of the on-disk cache. If None, only the memory cache is used.
+    - memory_budget: int
+        Maximum bytes of hypercubes kept in memory.
+    - disk_budget: int, optional
+        Maximum bytes of .npy files kept on disk. Least recently used files are
+        deleted when it is exceeded. Unlimited if None.
+    """
+
+    def __init__(self, cache_dir=".hypercube_cache", memory_budget=512 * 2**20, disk_budget=None):
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the memory in use.
+        """
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "memory_bytes": self._memory_bytes,
+            }
+
+    def _content_hash(self, image_path):
+        # Hash each file once per process while its size and mtime are unchanged.
+        stat = os.stat(image_path)
+        signature = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._hashes.get(signature)
+        if digest is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            with open(image_path, "rb") as f:
+                for chunk in iter(lambda: f.read(2**20), b""):
+                    hasher.update(chunk)
+            digest = hasher.hexdigest()
+            with self._lock:
+                self._hashes[signature] = digest
+        return digest
+
+    def key(self, image_path, layout=XIMEA_NIR_5X5, ffc_id=""):
+        """
+        Returns the cache key of an image for a layout and FFC id.
+        """
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(self._content_hash(image_path).encode())
+        hasher.update(repr((CACHE_VERSION, layout, ffc_id)).encode())
+        return hasher.hexdigest()
+
+    def get(self, image_path, layout=XIMEA_NIR_5X5, ffc=None, ffc_id=""):
+        """
+        Returns the hypercube of an image, sorted by wavelength, from the cache
+        or by demosaicing it. Cached hypercubes are read-only.
+
+        Parameters:
+        - image_path: str
+            Path to the RAW8 mosaic image.
+        - layout: MosaicLayout
+        - ffc: FFCCorrector, optional
+            Corrector applied to the raw frame before demosaicing.
+        - ffc_id: str
+            Identifier of the calibration of ffc, part of the key. Required
+            when ffc is given, so corrected and uncorrected entries do not mix.
+
+        Returns:
+        - hypercube: numpy.ndarray
+            uint8 array of shape layout.output_shape.
+        """
+
+        if ffc is not None and not ffc_id:
+            raise ValueError("An ffc_id identifying the calibration is required with ffc.")
+        key = self.key(image_path, layout, ffc_id)
+
+        with self._lock:
+            hypercube = self._entries.get(key)
+            if hypercube is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return hypercube
+
+        path = self._disk_path(key)
+        if path is not None and os.path.exists(path):
+            hypercube = np.load(path, mmap_mode="r")
+            os.utime(path)
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            image = load_raw8_image(image_path)
+            if ffc is not None:
+                image = ffc.apply(image)
+            hypercube = demosaic_array(image, layout)
+            hypercube.flags.writeable = False
+            if path is not None:
+                self._write(path, hypercube)
+            with self._lock:
+                self.misses += 1
+
+        self._remember(key, hypercube)
+        return hypercube
+
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_bytes = 0
+
+    def _disk_path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _remember(self, key, hypercube):
+        with self._lock:
+            if key in self._entries or hypercube.nbytes > self.memory_budget:
+                return
+            self._entries[key] = hypercube
+            self._memory_bytes += hypercube.nbytes
+            while self._memory_bytes > self.memory_budget:
+                _, evicted = self._entries.popitem(last=False)
+                self._memory_bytes -= evicted.nbytes
+
+    def _write(self, path, hypercube):
+        # Write to a temporary file first so readers never see a partial entry.
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            np.save(f, hypercube)
+        os.replace(temporary_path, path)
+        if self.disk_budget is not None:
+            self._evict_disk(hypercube.nbytes)
+
+    def _evict_disk(self, added_bytes):
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                                       if entry.name.endswith(".npy"))
+            else:
+                self._disk_bytes += added_bytes
+            if self._disk_bytes <= self.disk_budget:
+                return
+
+            entries = sorted((entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npy")),
+                             key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if self._disk_bytes <= self.disk_budget:
+                    break
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_bytes -= size
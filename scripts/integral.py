@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, demosaic_array, load_raw8_image
+
+# Bump when the tables built for the same image and layout change.
+CACHE_VERSION = 1
+
+# Most pixels per band whose uint8 sums fit in uint32 (about 16.8 million).
+MAX_UINT32_PIXELS = np.iinfo(np.uint32).max // 255
+
+class IntegralHypercube:
+    """
+    Summed-area tables of every band of a hypercube, so the mean and variance
+    of any box can be read in constant time from four corners per band.
+
+    sums[b, y, x] is the sum of band b over hypercube[b, :y, :x], and squares
+    holds the same for the squared intensities, so both tables have shape
+    (num_bands, height + 1, width + 1).
+
+    Parameters:
+    - hypercube: numpy.ndarray
+        uint8 array of shape (num_bands, height, width).
+    - squares: bool
+        Also build the sum-of-squares table needed for variances.
+    """
+
+    def __init__(self, hypercube, squares=True):
+        num_bands, height, width = hypercube.shape
+
+        # uint8 sums of a 216 x 409 band fit in uint32, their squares do not.
+        # Bands of more than MAX_UINT32_PIXELS pixels need uint64 sums.
+        dtype = np.uint32 if height * width <= MAX_UINT32_PIXELS else np.uint64
+        self.sums = np.zeros((num_bands, height + 1, width + 1), dtype=dtype)
+        np.cumsum(hypercube, axis=1, dtype=dtype, out=self.sums[:, 1:, 1:])
+        np.cumsum(self.sums[:, 1:, 1:], axis=2, out=self.sums[:, 1:, 1:])
+
+        self.squares = None
+        if squares:
+            self.squares = np.zeros((num_bands, height + 1, width + 1), dtype=np.uint64)
+            squared = hypercube.astype(np.uint64)
+            squared *= squared
+            np.cumsum(squared, axis=1, out=self.squares[:, 1:, 1:])
+            np.cumsum(self.squares[:, 1:, 1:], axis=2, out=self.squares[:, 1:, 1:])
+
+    @property
+    def shape(self):
+        """(num_bands, height, width) of the hypercube."""
+        num_bands, height, width = self.sums.shape
+        return (num_bands, height - 1, width - 1)
+
+    @staticmethod
+    def _box_totals(table, boxes):
+        # Corner lookups are gathered for all boxes and bands at once, and
+        # combined in int64 whatever the table dtype (uint64 and int64 would
+        # promote to float64).
+        x1, y1, x2, y2 = boxes.T
+        corners = [table[:, y, x].astype(np.int64) for y, x in ((y2, x2), (y1, x2), (y2, x1), (y1, x1))]
+        return (corners[0] - corners[1] - corners[2] + corners[3]).T
+
+    def _check_boxes(self, boxes):
+        boxes = np.atleast_2d(np.asarray(boxes, dtype=np.intp))
+        _, height, width = self.shape
+        np.clip(boxes[:, 0::2], 0, width, out=boxes[:, 0::2])
+        np.clip(boxes[:, 1::2], 0, height, out=boxes[:, 1::2])
+        # Inverted boxes (x2 < x1 or y2 < y1) are empty.
+        np.maximum(boxes[:, 2:], boxes[:, :2], out=boxes[:, 2:])
+        return boxes
+
+    def box_sums(self, boxes):
+        """
+        Returns the per-band sums of boxes.
+
+        Parameters:
+        - boxes: numpy.ndarray
+            Array of shape (K, 4) of (x1, y1, x2, y2) band coordinates, with
+            x2 and y2 exclusive. Coordinates are clipped to the bands, and
+            inverted boxes are empty.
+
+        Returns:
+        - sums: numpy.ndarray
+            int64 array of shape (K, num_bands).
+        """
+        return self._box_totals(self.sums, self._check_boxes(boxes))
+
+    def box_means(self, boxes):
+        """
+        Returns the per-band means of boxes, of shape (K, num_bands).
+        Empty boxes are NaN.
+        """
+        boxes = self._check_boxes(boxes)
+        areas = self.box_areas(boxes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self._box_totals(self.sums, boxes) / areas[:, None]
+
+    def box_stats(self, boxes):
+        """
+        Returns the per-band means and variances of boxes.
+
+        Parameters:
+        - boxes: numpy.ndarray
+            Array of shape (K, 4) of (x1, y1, x2, y2) band coordinates.
+
+        Returns:
+        - means: numpy.ndarray
+            float64 array of shape (K, num_bands).
+        - variances: numpy.ndarray
+            float64 array of shape (K, num_bands).
+        """
+        if self.squares is None:
+            raise ValueError("The sum-of-squares table was not built (squares=False).")
+
+        boxes = self._check_boxes(boxes)
+        areas = self.box_areas(boxes)[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = self._box_totals(self.sums, boxes) / areas
+            variances = self._box_totals(self.squares, boxes) / areas - means ** 2
+        return means, np.maximum(variances, 0.0)
+
+    @staticmethod
+    def box_areas(boxes):
+        boxes = np.asarray(boxes)
+        widths = np.maximum(boxes[:, 2] - boxes[:, 0], 0)
+        heights = np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+        return (widths * heights).astype(np.float64)
+
+    def save(self, path, key=""):
+        """
+        Saves the tables to an uncompressed .npz file, with a key describing
+        how they were built (see cache_key).
+        """
+        tables = {"sums": self.sums, "key": np.array(key)}
+        if self.squares is not None:
+            tables["squares"] = self.squares
+        np.savez(path, **tables)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads tables saved with save().
+        """
+        integral = object.__new__(cls)
+        with np.load(path) as data:
+            integral.sums = data["sums"]
+            integral.squares = data["squares"] if "squares" in data.files else None
+        return integral
+
+def cache_key(layout=XIMEA_NIR_5X5, sort_bands=True):
+    """
+    Returns the string identifying the tables built for a layout and band
+    order, saved with the tables and checked when they are loaded.
+    """
+    return repr((CACHE_VERSION, layout, sort_bands))
+
+def integral_cache_path(image_path, layout=XIMEA_NIR_5X5, sort_bands=True, cache_dir=".integral_cache"):
+    """
+    Returns the path of the cached summed-area tables of an image in
+    cache_dir. The file name holds a hash of the absolute image path, the
+    layout and the band order, so tables built differently do not collide.
+    """
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(os.path.abspath(image_path).encode())
+    hasher.update(cache_key(layout, sort_bands).encode())
+    return os.path.join(cache_dir, f"{os.path.basename(image_path)}.{hasher.hexdigest()}.sat.npz")
+
+def _is_fresh(cache_path, image_path, key):
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(image_path):
+        return False
+    with np.load(cache_path) as data:
+        return "key" in data.files and str(data["key"]) == key
+
+def load_integral_hypercube(image_path, layout=XIMEA_NIR_5X5, sort_bands=True, cache_dir=".integral_cache"):
+    """
+    Returns the IntegralHypercube of an image file, loading it from cache_dir
+    when the cached tables are newer than the image and were built with the
+    same layout and band order, and building and caching it otherwise.
+
+    Parameters:
+    - image_path: str
+        Path to the RAW8 mosaic image.
+    - layout: MosaicLayout
+    - sort_bands: bool
+        Sort the bands by wavelength, as in utils.demosaic_array.
+    - cache_dir: str, optional
+        Folder of the cached tables. If None, the tables are neither read nor
+        written.
+
+    Returns:
+    - integral: IntegralHypercube
+    """
+    key = cache_key(layout, sort_bands)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = integral_cache_path(image_path, layout, sort_bands, cache_dir)
+        if _is_fresh(cache_path, image_path, key):
+            return IntegralHypercube.load(cache_path)
+
+    integral = IntegralHypercube(demosaic_array(load_raw8_image(image_path), layout, sort_bands))
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        integral.save(cache_path, key)
+    return integral
+
+def grid_boxes(shape, box_size, step=None):
+    """
+    Returns the boxes of a sliding window over bands of the given shape.
+
+    Parameters:
+    - shape: tuple
+        (height, width) of the bands.
+    - box_size: tuple
+        (height, width) of the window.
+    - step: tuple, optional
+        (row, col) step of the window (default: box_size, i.e. a grid).
+
+    Returns:
+    - boxes: numpy.ndarray
+        Array of shape (K, 4) of (x1, y1, x2, y2) band coordinates.
+    """
+    height, width = shape
+    box_height, box_width = box_size
+    step_rows, step_cols = step or box_size
+    ys, xs = np.meshgrid(np.arange(0, height - box_height + 1, step_rows),
+                         np.arange(0, width - box_width + 1, step_cols), indexing="ij")
+    return np.stack([xs.ravel(), ys.ravel(), xs.ravel() + box_width, ys.ravel() + box_height], axis=1)
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+import os
+import time
+import bisect
+import asyncio
+import argparse
+from collections import deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from capture_image import open_camera, new_image, image_to_numpy
+from raw_store import RawFrameStore
+
+@dataclass(frozen=True)
+class Frame:
+    """
+    A frame pulled from one camera of the rig.
+
+    Attributes:
+    - camera: int
+        Index of the camera in the rig.
+    - nframe: int
+        Frame number reported by the camera.
+    - timestamp_ns: int
+        Camera timestamp mapped onto the host clock (see ClockMapper).
+    - device_timestamp_ns: int
+        Timestamp reported by the camera.
+    - received_ns: int
+        Host time (time.time_ns) at which the frame was received.
+    - image: numpy.ndarray
+        The RAW8 mosaic, owned by the frame.
+    - exposure_us: int
+    - gain_db: float
+    """
+
+    camera: int
+    nframe: int
+    timestamp_ns: int
+    device_timestamp_ns: int
+    received_ns: int
+    image: np.ndarray
+    exposure_us: int = 0
+    gain_db: float = 0.0
+
+class ClockMapper:
+    """
+    Maps the timestamps of a camera's own clock onto the host clock. The
+    offset is the smallest (receive time - camera timestamp) seen so far,
+    i.e. the offset measured on the frame that was delivered fastest, so
+    transfer delays never push timestamps later. Cameras that already stamp
+    frames with the host clock get an offset of about 0.
+    """
+
+    def __init__(self):
+        self.offset_ns = None
+
+    def __call__(self, device_timestamp_ns, received_ns):
+        offset = received_ns - device_timestamp_ns
+        if self.offset_ns is None or offset < self.offset_ns:
+            self.offset_ns = offset
+        return device_timestamp_ns + self.offset_ns
+
+class RunningStats:
+    """
+    Count, mean, standard deviation, min and max of a stream of values,
+    updated in constant time and memory (Welford's algorithm).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+    def result(self, scale=1.0):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "mean": self.mean * scale, "std": self.std * scale,
+                "min": self.min * scale, "max": self.max * scale}
+
+class TimestampAligner:
+    """
+    Bounded reorder buffer that groups frames of several cameras into
+    synchronized sets, one frame per camera, whose timestamps are all within
+    tolerance_ns of each other.
+
+    Each camera has a queue sorted by timestamp. Whenever every queue has a
+    frame, the latest head bounds the set: heads older than it by more than
+    the tolerance can never be matched (every other frame of that camera is
+    later still) and are discarded, and once all heads are within the
+    tolerance they are emitted as a set. A queue holding more than
+    max_pending frames drops its oldest frame, so a stalled camera cannot
+    make the buffer grow.
+
+    Parameters:
+    - num_cameras: int
+    - tolerance_ns: int
+        Maximum spread of the timestamps of a set.
+    - max_pending: int
+        Maximum number of frames waiting per camera.
+    """
+
+    def __init__(self, num_cameras, tolerance_ns, max_pending=8):
+        self.num_cameras = num_cameras
+        self.tolerance_ns = tolerance_ns
+        self.max_pending = max_pending
+        self.unmatched = [0] * num_cameras
+        self.overflowed = [0] * num_cameras
+        self._queues = [deque() for _ in range(num_cameras)]
+
+    def pending(self):
+        return [len(queue) for queue in self._queues]
+
+    def add(self, frame):
+        """
+        Adds a frame and returns the list of sets (tuples of frames ordered by
+        camera) completed by it.
+        """
+        queue = self._queues[frame.camera]
+        if queue and frame.timestamp_ns < queue[-1].timestamp_ns:
+            # Out of order: insert at its place (rare, queues are short).
+            index = bisect.bisect([f.timestamp_ns for f in queue], frame.timestamp_ns)
+            queue.insert(index, frame)
+        else:
+            queue.append(frame)
+        if len(queue) > self.max_pending:
+            queue.popleft()
+            self.overflowed[frame.camera] += 1
+
+        sets = []
+        while all(self._queues):
+            heads = [queue[0].timestamp_ns for queue in self._queues]
+            latest = max(heads)
+            if latest - min(heads) <= self.tolerance_ns:
+                sets.append(tuple(queue.popleft() for queue in self._queues))
+                continue
+            for camera, queue in enumerate(self._queues):
+                if queue[0].timestamp_ns < latest - self.tolerance_ns:
+                    queue.popleft()
+                    self.unmatched[camera] += 1
+        return sets
+
+class MultiCameraAcquisition:
+    """
+    asyncio acquisition service for a rig of cameras. Each camera is read by
+    its own executor thread (get_image blocks and releases the GIL), frames
+    are mapped onto the host clock and aligned by a TimestampAligner, and
+    every synchronized set is published to all subscribers.
+
+    Subscribers get a bounded asyncio.Queue; when a subscriber falls behind
+    its oldest set is dropped, so a slow consumer never stalls acquisition.
+
+    Metrics (see metrics()):
+    - per camera: frames, frame interval of the camera timestamps (jitter is
+      its std) and delivery latency (receive time - mapped timestamp).
+    - per set: skew (timestamp spread within the set) and publish latency
+      (publish time - latest timestamp of the set).
+
+    Parameters:
+    - cameras: list
+        Opened xiapi.Camera or simulated_camera.Camera, configured for XI_RAW8.
+    - tolerance_s: float
+        Maximum timestamp spread of a synchronized set, in seconds.
+    - max_pending: int
+        Reorder buffer depth per camera.
+    """
+
+    def __init__(self, cameras, tolerance_s=0.005, max_pending=8):
+        self.cameras = cameras
+        self.aligner = TimestampAligner(len(cameras), int(tolerance_s * 1e9), max_pending)
+        self.published = 0
+        self.subscriber_drops = 0
+
+        self._clocks = [ClockMapper() for _ in cameras]
+        self._images = [new_image(cam) for cam in cameras]
+        self._frames = [0] * len(cameras)
+        self._last_timestamps = [None] * len(cameras)
+        self._intervals = [RunningStats() for _ in cameras]
+        self._latencies = [RunningStats() for _ in cameras]
+        self._skew = RunningStats()
+        self._publish_latency = RunningStats()
+        self._subscribers = []
+        self._stop = None
+        self._start_time = None
+
+    def subscribe(self, maxsize=4):
+        """
+        Returns a queue that receives every synchronized set published from
+        now on, as a tuple of Frame ordered by camera, and None at the end.
+        """
+        queue = asyncio.Queue(maxsize)
+        self._subscribers.append(queue)
+        return queue
+
+    def _grab(self, camera):
+        # Runs in an executor thread: blocks on the camera, copies the frame
+        # out of the driver buffer and stamps it.
+        img = self._images[camera]
+        self.cameras[camera].get_image(img)
+        received_ns = time.time_ns()
+        device_timestamp_ns = img.tsSec * 1000000000 + img.tsUSec * 1000
+        return Frame(camera=camera, nframe=img.nframe,
+                     timestamp_ns=self._clocks[camera](device_timestamp_ns, received_ns),
+                     device_timestamp_ns=device_timestamp_ns, received_ns=received_ns,
+                     image=image_to_numpy(img).copy(), exposure_us=img.exposure_time_us,
+                     gain_db=img.gain_db)
+
+    def _record(self, frame):
+        camera = frame.camera
+        self._frames[camera] += 1
+        if self._last_timestamps[camera] is not None:
+            self._intervals[camera].update(frame.device_timestamp_ns - self._last_timestamps[camera])
+        self._last_timestamps[camera] = frame.device_timestamp_ns
+        self._latencies[camera].update(frame.received_ns - frame.timestamp_ns)
+
+    def _publish(self, frame_set):
+        timestamps = [frame.timestamp_ns for frame in frame_set]
+        self._skew.update(max(timestamps) - min(timestamps))
+        self._publish_latency.update(time.time_ns() - max(timestamps))
+        self.published += 1
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.subscriber_drops += 1
+            queue.put_nowait(frame_set)
+
+    async def _pull(self, camera, executor):
+        loop = asyncio.get_running_loop()
+        while not self._stop.is_set():
+            frame = await loop.run_in_executor(executor, self._grab, camera)
+            self._record(frame)
+            for frame_set in self.aligner.add(frame):
+                self._publish(frame_set)
+                if self._num_sets is not None and self.published >= self._num_sets:
+                    self._stop.set()
+
+    async def run(self, num_sets=None):
+        """
+        Acquires from every camera until stop() is called or num_sets
+        synchronized sets have been published, then sends None to the
+        subscribers. If reading a camera fails (e.g. get_image times out),
+        the other readers are cancelled and the error is raised.
+        """
+        self._stop = asyncio.Event()
+        self._num_sets = num_sets
+        self._start_time = time.perf_counter()
+        for cam in self.cameras:
+            cam.start_acquisition()
+
+        executor = ThreadPoolExecutor(max_workers=len(self.cameras), thread_name_prefix="camera")
+        try:
+            tasks = [asyncio.create_task(self._pull(camera, executor)) for camera in range(len(self.cameras))]
+            stop_task = asyncio.create_task(self._stop.wait())
+            await asyncio.wait([*tasks, stop_task], return_when=asyncio.FIRST_COMPLETED)
+            self._stop.set()
+            await stop_task
+            errors = [task.exception() for task in tasks if task.done() and task.exception() is not None]
+            if errors:
+                # The other readers may be blocked on a camera that is fine.
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise errors[0]
+            # Each reader stops after its current get_image returns.
+            await asyncio.gather(*tasks)
+        finally:
+            executor.shutdown(wait=True)
+            for cam in self.cameras:
+                cam.stop_acquisition()
+            for queue in self._subscribers:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def metrics(self):
+        """
+        Returns the frame counters, latency and jitter statistics, in milliseconds.
+        """
+        elapsed = time.perf_counter() - self._start_time if self._start_time else 0.0
+        return {
+            "elapsed_s": elapsed,
+            "sets": self.published,
+            "sets_per_s": self.published / elapsed if elapsed else 0.0,
+            "subscriber_drops": self.subscriber_drops,
+            "set_skew_ms": self._skew.result(1e-6),
+            "publish_latency_ms": self._publish_latency.result(1e-6),
+            "cameras": [{
+                "frames": self._frames[camera],
+                "unmatched": self.aligner.unmatched[camera],
+                "overflowed": self.aligner.overflowed[camera],
+                "interval_ms": self._intervals[camera].result(1e-6),
+                "latency_ms": self._latencies[camera].result(1e-6),
+            } for camera in range(len(self.cameras))],
+        }
+
+async def record_sets(service, output=None, num_sets=None):
+    """
+    Runs the service and consumes its sets, appending each frame to the
+    RawFrameStore output/cam<i> if output is given.
+    """
+    queue = service.subscribe()
+    stores = {}
+    acquisition = asyncio.create_task(service.run(num_sets))
+    try:
+        while (frame_set := await queue.get()) is not None:
+            if output is None:
+                continue
+            for frame in frame_set:
+                if frame.camera not in stores:
+                    stores[frame.camera] = RawFrameStore.open_or_create(
+                        os.path.join(output, f"cam{frame.camera}"), frame.image.shape)
+                stores[frame.camera].append(frame.image, timestamp_ns=frame.timestamp_ns,
+                                            exposure_us=frame.exposure_us, gain_db=frame.gain_db)
+    finally:
+        service.stop()
+        await acquisition
+        for store in stores.values():
+            store.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Synchronized acquisition from several Ximea cameras.")
+    parser.add_argument("--devices", type=int, nargs="+", default=[0], help="Camera indices to open.")
+    parser.add_argument("--simulate", metavar="FOLDER", nargs="+",
+                        help="Replay one simulated camera per FOLDER instead of using cameras.")
+    parser.add_argument("--framerate", type=float, nargs="+", default=[10.0],
+                        help="Frame rate of each simulated camera (the last value is repeated).")
+    parser.add_argument("--exposure", type=int, default=100000, help="Exposure in microseconds.")
+    parser.add_argument("--gain", type=float, default=0, help="Gain in dB.")
+    parser.add_argument("--tolerance", type=float, default=5.0, help="Maximum timestamp spread of a set in ms.")
+    parser.add_argument("--sets", type=int, default=None, help="Number of sets to acquire (default: until Ctrl+C).")
+    parser.add_argument("--output", help="Folder of one raw frame store per camera.")
+    args = parser.parse_args()
+
+    if args.simulate:
+        framerates = args.framerate + args.framerate[-1:] * len(args.simulate)
+        cameras = [open_camera(simulate=True, exposure=args.exposure, gain=args.gain, image_folder=folder,
+                               framerate=framerate) for folder, framerate in zip(args.simulate, framerates)]
+    else:
+        cameras = [open_camera(exposure=args.exposure, gain=args.gain, device_id=device) for device in args.devices]
+
+    service = MultiCameraAcquisition(cameras, tolerance_s=args.tolerance / 1000)
+    try:
+        asyncio.run(record_sets(service, args.output, args.sets))
+    except KeyboardInterrupt:
+        print('Stopping acquisition...')
+    finally:
+        for cam in cameras:
+            cam.close_device()
+
+    metrics = service.metrics()
+    print(f"Published {metrics['sets']} sets ({metrics['sets_per_s']:.1f} sets/s), "
+          f"{metrics['subscriber_drops']} dropped by slow consumers")
+    print(f"Set skew (ms): {metrics['set_skew_ms']}")
+    print(f"Publish latency (ms): {metrics['publish_latency_ms']}")
+    for camera, camera_metrics in enumerate(metrics["cameras"]):
+        print(f"Camera {camera}: {camera_metrics}")
+
+if __name__ == "__main__":
+    main()
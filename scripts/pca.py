@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import numpy as np
+
+from utils import demosaic_ximea_5x5_array, band_wavelengths
+
+METHODS = ("pca", "mnf")
+
+def basis_path(profiles_path="spectral_profiles.npz"):
+    """
+    Returns the path of the fitted basis, saved next to the spectral profiles.
+    """
+    return os.path.join(os.path.dirname(profiles_path), "spectral_basis.npz")
+
+class CovarianceAccumulator:
+    """
+    Accumulates the band covariance of the pixels of any number of hypercubes,
+    one frame at a time, so a basis can be fitted on far more pixels than fit
+    in memory.
+
+    The pixel count, per-band sums and the (num_bands, num_bands) sum of
+    outer products are kept in float64, which is exact for uint8 cubes up to
+    about 2**53 / 255**2 pixels. Each chunk of rows is added with a single
+    GEMM, (num_bands, P) @ (P, num_bands). For MNF the same pass accumulates
+    the noise covariance from the differences of horizontally adjacent pixels
+    (shift difference), which are mostly noise in smooth scenes. This doubles
+    the cost of an update, so it can be turned off when only PCA is needed.
+
+    Accumulators of different frames can be combined with merge, e.g. one per
+    worker thread.
+
+    Parameters:
+    - num_bands: int
+    - noise: bool
+        Also accumulate the noise covariance, needed for MNF.
+    - chunk_rows: int
+        Number of rows converted to float64 at a time.
+    """
+
+    def __init__(self, num_bands=25, noise=True, chunk_rows=64):
+        self.num_bands = num_bands
+        self.noise = noise
+        self.chunk_rows = chunk_rows
+        self.count = 0
+        self.total = np.zeros(num_bands, dtype=np.float64)
+        self.cross = np.zeros((num_bands, num_bands), dtype=np.float64)
+        self.noise_count = 0
+        self.noise_cross = np.zeros((num_bands, num_bands), dtype=np.float64)
+        self.frames = 0
+
+    def update(self, hypercube):
+        """
+        Adds a hypercube of shape (num_bands, height, width), or a stack of them.
+        """
+        cubes = hypercube[None] if hypercube.ndim == 3 else hypercube
+        num_frames, num_bands, height, width = cubes.shape
+        if num_bands != self.num_bands:
+            raise ValueError(f"Expected {self.num_bands} bands, got {num_bands}.")
+
+        pixels = np.empty((num_bands, self.chunk_rows, width), dtype=np.float64)
+        differences = np.empty((num_bands, self.chunk_rows, width - 1), dtype=np.float64)
+        for cube in cubes:
+            for row in range(0, height, self.chunk_rows):
+                rows = min(self.chunk_rows, height - row)
+                chunk = pixels[:, :rows]
+                np.copyto(chunk, cube[:, row:row + rows], casting="unsafe")
+                flat = chunk.reshape(num_bands, -1)
+                self.total += flat.sum(axis=1)
+                self.cross += flat @ flat.T
+                if not self.noise:
+                    continue
+
+                difference = differences[:, :rows]
+                np.subtract(chunk[:, :, 1:], chunk[:, :, :-1], out=difference)
+                flat = difference.reshape(num_bands, -1)
+                self.noise_cross += flat @ flat.T
+            self.count += height * width
+            if self.noise:
+                self.noise_count += height * (width - 1)
+        self.frames += num_frames
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator.
+        """
+        if other.num_bands != self.num_bands:
+            raise ValueError("Cannot merge accumulators of a different number of bands.")
+        self.count += other.count
+        self.total += other.total
+        self.cross += other.cross
+        self.noise_count += other.noise_count
+        self.noise_cross += other.noise_cross
+        self.frames += other.frames
+        return self
+
+    @property
+    def mean(self):
+        return self.total / max(self.count, 1)
+
+    def covariance(self):
+        """Sample covariance of the pixels, float64 (num_bands, num_bands)."""
+        mean = self.mean
+        return (self.cross - self.count * np.outer(mean, mean)) / max(self.count - 1, 1)
+
+    def noise_covariance(self):
+        """
+        Noise covariance estimated from the shift differences. The difference
+        of two pixels has twice the noise variance, hence the factor 2.
+        """
+        return self.noise_cross / (2 * max(self.noise_count, 1))
+
+class SpectralBasis:
+    """
+    Linear projection of spectra onto k components, fitted by PCA or MNF.
+
+    The projection of a pixel x is components @ (x - mean). It is applied to
+    every pixel of a cube with one matrix product per chunk of rows,
+    components @ pixels - components @ mean, into the float32 output.
+
+    Parameters:
+    - mean: numpy.ndarray
+        Mean spectrum of shape (num_bands,).
+    - components: numpy.ndarray
+        Array of shape (k, num_bands), most significant first.
+    - variance: numpy.ndarray
+        Variance (PCA) or signal-to-noise ratio (MNF) of each component, shape (k,).
+    - method: str
+        One of METHODS.
+    """
+
+    def __init__(self, mean, components, variance, method="pca"):
+        if method not in METHODS:
+            raise ValueError(f"Unknown method {method}, expected one of {METHODS}.")
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.variance = np.asarray(variance, dtype=np.float64)
+        self.method = method
+        self._offset = (self.components.astype(np.float64) @ self.mean).astype(np.float32)[:, None]
+
+    @classmethod
+    def fit(cls, accumulator, num_components, method="pca"):
+        """
+        Fits the basis from the statistics of a CovarianceAccumulator.
+
+        PCA keeps the eigenvectors of the covariance with the largest
+        eigenvalues. MNF first whitens the noise covariance N, then keeps the
+        eigenvectors of the whitened covariance with the largest eigenvalues
+        (signal-to-noise ratio), so components are ordered by image quality
+        rather than variance.
+        """
+        if method not in METHODS:
+            raise ValueError(f"Unknown method {method}, expected one of {METHODS}.")
+        if not 0 < num_components <= accumulator.num_bands:
+            raise ValueError(f"The number of components must be in [1, {accumulator.num_bands}].")
+        if accumulator.count < 2:
+            raise ValueError("At least two pixels are needed to fit a basis.")
+        if method == "mnf" and accumulator.noise_count == 0:
+            raise ValueError("MNF needs the noise covariance, accumulated with noise=True.")
+
+        covariance = accumulator.covariance()
+        if method == "pca":
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+            components = eigenvectors.T
+        else:
+            noise_values, noise_vectors = np.linalg.eigh(accumulator.noise_covariance())
+            # Floor the noise so bands without measurable noise (e.g. a
+            # saturated or blank band) do not blow up the whitening.
+            noise_values = np.maximum(noise_values, noise_values.max() * 1e-9 + 1e-12)
+            whitening = noise_vectors / np.sqrt(noise_values)
+            eigenvalues, eigenvectors = np.linalg.eigh(whitening.T @ covariance @ whitening)
+            components = (whitening @ eigenvectors).T
+        order = np.argsort(eigenvalues)[::-1][:num_components]
+        return cls(accumulator.mean, components[order], np.maximum(eigenvalues[order], 0), method)
+
+    @property
+    def num_components(self):
+        return self.components.shape[0]
+
+    @property
+    def num_bands(self):
+        return self.components.shape[1]
+
+    def transform(self, hypercube, out=None, chunk_rows=64):
+        """
+        Projects a hypercube (or a stack of them) onto the components.
+
+        Parameters:
+        - hypercube: numpy.ndarray
+            Array of shape (num_bands, height, width) or (N, num_bands, height, width).
+        - out: numpy.ndarray, optional
+            C-contiguous float32 output of the returned shape.
+        - chunk_rows: int
+            Number of rows converted to float32 at a time.
+
+        Returns:
+        - projected: numpy.ndarray
+            float32 array of shape (k, height, width), or (N, k, height, width).
+        """
+        cubes = hypercube[None] if hypercube.ndim == 3 else hypercube
+        num_frames, num_bands, height, width = cubes.shape
+        if num_bands != self.num_bands:
+            raise ValueError(f"Expected {self.num_bands} bands, got {num_bands}.")
+        shape = (*hypercube.shape[:-3], self.num_components, height, width)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+            raise ValueError(f"Output must be a C-contiguous float32 array of shape {shape}.")
+        outputs = out.reshape(num_frames, self.num_components, height, width)
+
+        pixels = np.empty((num_bands, chunk_rows * width), dtype=np.float32)
+        for cube, output in zip(cubes, outputs):
+            for row in range(0, height, chunk_rows):
+                rows = min(chunk_rows, height - row)
+                n = rows * width
+                np.copyto(pixels[:, :n].reshape(num_bands, rows, width), cube[:, row:row + rows], casting="unsafe")
+                # Rows of a band are contiguous, so the output chunk is a 2D view.
+                projected = output[:, row:row + rows].reshape(self.num_components, n)
+                np.matmul(self.components, pixels[:, :n], out=projected)
+                projected -= self._offset
+        return out
+
+    def inverse_transform(self, projected):
+        """
+        Reconstructs float32 spectra of shape (num_bands, ...) from components
+        of shape (k, ...). Only exact for PCA with all components.
+        """
+        k = projected.shape[0]
+        flat = projected.reshape(k, -1)
+        spectra = np.linalg.pinv(self.components.astype(np.float64)) @ flat + self.mean[:, None]
+        return spectra.astype(np.float32).reshape(self.num_bands, *projected.shape[1:])
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components, variance=self.variance,
+                 method=np.array(self.method))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["mean"], data["components"], data["variance"], str(data["method"]))
+
+def main():
+    from full_image_analysis import collect_inputs, _open_store
+
+    parser = argparse.ArgumentParser(description="Fit a PCA or MNF basis on the pixels of Ximea mosaic images.")
+    parser.add_argument("inputs", nargs="+", help="Image files, folders, glob patterns or raw frame stores.")
+    parser.add_argument("--components", type=int, default=5, help="Number of components to keep.")
+    parser.add_argument("--method", choices=METHODS, default="pca", help="Dimensionality reduction method.")
+    parser.add_argument("--profiles", default="spectral_profiles.npz",
+                        help="Spectral profiles; the basis is saved next to them.")
+    parser.add_argument("--output", help="Save the basis here instead of next to the profiles.")
+    args = parser.parse_args()
+
+    accumulator = CovarianceAccumulator(noise=args.method == "mnf")
+    hypercube = None
+    for name, path, frame_index in collect_inputs(args.inputs):
+        if frame_index is None:
+            hypercube = demosaic_ximea_5x5_array(path, out=hypercube)
+            accumulator.update(hypercube)
+        else:
+            accumulator.update(_open_store(path).hypercube(frame_index))
+    print(f"Accumulated {accumulator.count} pixels of {accumulator.frames} frames")
+
+    basis = SpectralBasis.fit(accumulator, args.components, args.method)
+    output = args.output or basis_path(args.profiles)
+    basis.save(output)
+
+    if args.method == "pca":
+        total = np.trace(accumulator.covariance())
+        print("Explained variance: " + ", ".join(f"{v / total * 100:.2f}%" for v in basis.variance))
+    else:
+        print("Signal-to-noise ratio: " + ", ".join(f"{v:.1f}" for v in basis.variance))
+    wavelengths = band_wavelengths()
+    for index, component in enumerate(basis.components):
+        peak = int(np.argmax(np.abs(component)))
+        print(f"Component {index}: strongest weight {component[peak]:+.3f} at {int(wavelengths[peak])} nm")
+    print(f"Saved the {args.method.upper()} basis to {output}")
+
+if __name__ == "__main__":
+    main()
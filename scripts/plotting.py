@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+from functools import lru_cache
+import numpy as np
+
+# Number of points of the smoothed spectral curves.
+SMOOTH_POINTS = 300
+
+# Colors cycled through when plotting several spectra.
+COLORS = ("b", "r", "g", "c", "m", "y", "k")
+
+def use_headless():
+    """
+    Switches matplotlib to the Agg backend, so figures are only rendered to
+    files and never open a window. Call before creating any figure.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+
+@lru_cache(maxsize=None)
+def spline_basis(num_bands, num_points=SMOOTH_POINTS, degree=3):
+    """
+    Returns the matrix that evaluates the interpolating spline of a spectrum
+    on a fine grid. The spline of make_interp_spline is linear in the values,
+    so it is built once from the identity for the fixed band axis, and
+    basis @ spectrum equals make_interp_spline(x, spectrum, degree)(x_smooth).
+
+    Parameters:
+    - num_bands: int
+        Number of samples per spectrum, at x = 0, 1, ..., num_bands - 1.
+    - num_points: int
+        Number of points of the smoothed curves.
+    - degree: int
+        Spline degree.
+
+    Returns:
+    - x_smooth: numpy.ndarray
+        Array of shape (num_points,).
+    - basis: numpy.ndarray
+        Read-only array of shape (num_points, num_bands).
+    """
+    from scipy.interpolate import make_interp_spline
+
+    x = np.arange(num_bands)
+    x_smooth = np.linspace(0, num_bands - 1, num_points)
+    basis = make_interp_spline(x, np.eye(num_bands), k=min(degree, num_bands - 1))(x_smooth)
+    x_smooth.flags.writeable = False
+    basis.flags.writeable = False
+    return x_smooth, basis
+
+def smooth_spectra(spectra, num_points=SMOOTH_POINTS):
+    """
+    Smooths any number of spectra with one matrix multiply.
+
+    Parameters:
+    - spectra: numpy.ndarray
+        Array of shape (num_bands,) or (num_spectra, num_bands).
+
+    Returns:
+    - x_smooth: numpy.ndarray
+        Array of shape (num_points,).
+    - smoothed: numpy.ndarray
+        Array of shape (num_points,) or (num_spectra, num_points).
+    """
+    spectra = np.asarray(spectra, dtype=np.float64)
+    x_smooth, basis = spline_basis(spectra.shape[-1], num_points)
+    return x_smooth, spectra @ basis.T
+
+def spectral_axes(spectral_range, title="Spectral Bands", xlabel="Band Index", ylabel="Average Intensity",
+                  ylim=None, figsize=(10, 5), dpi=100):
+    """
+    Creates a figure with the band axis labeled by wavelength.
+
+    Returns:
+    - fig: matplotlib.figure.Figure
+    - ax: matplotlib.axes.Axes
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    x = np.arange(len(spectral_range))
+    ax.set_xticks(x)
+    ax.set_xticklabels([f"{int(wavelength)} nm" for wavelength in spectral_range], rotation=45)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.grid(True)
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    return fig, ax
+
+def plot_spectra(ax, spectra, labels=None, colors=COLORS, points=True, point_color=None, linewidth=2, alpha=1.0):
+    """
+    Draws smoothed spectra on ax. Without labels, all curves are drawn as a
+    single LineCollection, so hundreds of spectra render as fast as one.
+
+    Parameters:
+    - ax: matplotlib.axes.Axes
+    - spectra: numpy.ndarray
+        Array of shape (num_bands,) or (num_spectra, num_bands).
+    - labels: list of str, optional
+        Legend label of each spectrum.
+    - colors: sequence
+        Colors cycled through the spectra.
+    - points: bool
+        Also mark the band values.
+    - point_color: optional
+        Color of the band markers (default: the color of their curve).
+    """
+    from matplotlib.collections import LineCollection
+
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    x_smooth, smoothed = smooth_spectra(spectra)
+    colors = [colors[i % len(colors)] for i in range(len(spectra))]
+
+    if labels is None:
+        segments = np.stack(np.broadcast_arrays(x_smooth, smoothed), axis=-1)
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=linewidth, alpha=alpha))
+        ax.autoscale_view()
+    else:
+        for curve, label, color in zip(smoothed, labels, colors):
+            ax.plot(x_smooth, curve, linewidth=linewidth, label=label, color=color, alpha=alpha)
+
+    if points:
+        x = np.broadcast_to(np.arange(spectra.shape[1]), spectra.shape)
+        point_colors = point_color or np.repeat(colors, spectra.shape[1])
+        ax.scatter(x.ravel(), spectra.ravel(), c=point_colors, alpha=alpha, zorder=3)
+
+def plot_mean_std(ax, spectra, label=None, color="b", alpha=0.2, points=True, linewidth=2):
+    """
+    Draws the smoothed mean of a set of spectra with a shaded mean +/- std band.
+
+    Parameters:
+    - ax: matplotlib.axes.Axes
+    - spectra: numpy.ndarray
+        Array of shape (num_spectra, num_bands).
+    """
+    spectra = np.asarray(spectra, dtype=np.float64)
+    mean = spectra.mean(axis=0)
+    std = spectra.std(axis=0)
+
+    # Mean, lower and upper curves are smoothed with the same multiply.
+    x_smooth, (smooth_mean, lower, upper) = smooth_spectra(np.stack([mean, mean - std, mean + std]))
+    ax.fill_between(x_smooth, lower, upper, color=color, alpha=alpha, linewidth=0)
+    ax.plot(x_smooth, smooth_mean, label=label, color=color, linewidth=linewidth)
+    if points:
+        ax.scatter(np.arange(len(mean)), mean, color=color, zorder=3)
+
+def show_or_save(fig, output=None, dpi=150):
+    """
+    Saves the figure to output and closes it, or shows it if output is None.
+    """
+    import matplotlib.pyplot as plt
+
+    fig.tight_layout()
+    if output:
+        fig.savefig(output, dpi=dpi)
+        plt.close(fig)
+    else:
+        plt.show()
@@ -1,14 +1,15 @@
 import os
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.interpolate import make_interp_spline
-from utils import demosaic_ximea_5x5, hypercube_dict_to_array
 from bbox_image_analysis import ImageBoxSelector
+from roi import ROI, load_rois, save_rois, extract_roi_spectra
+from hypercube_cache import HypercubeCache
+from plotting import use_headless, spectral_axes, plot_mean_std, show_or_save
 
 
-def collect_boxes(label):
-    all_band_intensities = []
+def collect_boxes(label, folder, image_names):
     print(f"\n🟩 Starting {label.upper()} box selection...\n")
+    rois = []
     for i, image_name in enumerate(image_names):
         print(f"[{i+1}/{len(image_names)}] Processing image: {image_name}")
         image_path = os.path.join(folder, image_name)
@@ -22,37 +23,51 @@ def collect_boxes(label):
             continue
 
         print(f"✅ {label.capitalize()} box selected: {box}\n")
+        rois.append(ROI(image_path, label, box))
 
-        hypercube_dict = demosaic_ximea_5x5(image_path)
-        hypercube = hypercube_dict_to_array(hypercube_dict)
+    return rois
 
-        x1, y1, x2, y2 = box
-        x1, y1, x2, y2 = x1 // pattern_size, y1 // pattern_size, x2 // pattern_size, y2 // pattern_size
-        selected_box = hypercube[:, y1:y2, x1:x2]
 
-        band_avg = np.mean(selected_box, axis=(1, 2))
-        all_band_intensities.append(band_avg)
+def main():
+    parser = argparse.ArgumentParser(description="Compare the spectra of positive and negative boxes.")
+    parser.add_argument("--folder", default="fb_images", help="Folder of images to draw boxes on.")
+    parser.add_argument("--rois", help="Replay labeled ROIs from a JSON/CSV spec file instead of drawing them.")
+    parser.add_argument("--record", help="Save the drawn ROIs to this JSON spec file.")
+    parser.add_argument("--cache", help="Folder of a hypercube cache reused across runs.")
+    parser.add_argument("--plot", help="Save the plot to this image file instead of showing it.")
+    args = parser.parse_args()
 
-    return np.array(all_band_intensities)
+    if args.plot and args.rois:
+        # Nothing to draw interactively, so never open a window.
+        use_headless()
 
-
-if __name__ == "__main__":
-
-    pattern_size = 5
     spectral_bands = 25
     spectral_range = np.linspace(665, 960, spectral_bands)
 
-    folder = "fb_images"
-    image_names = os.listdir(folder)
+    if args.rois:
+        rois = load_rois(args.rois)
+    else:
+        image_names = os.listdir(args.folder)
+
+        # Step 1: collect positives
+        rois = collect_boxes("positive", args.folder, image_names)
 
-    positives = []
-    negatives = []
+        # Step 2: collect negatives
+        rois += collect_boxes("negative", args.folder, image_names)
 
-    # Step 1: collect positives
-    positives = collect_boxes("positive")
+        if args.record:
+            save_rois(args.record, rois)
+            print(f"✅ Saved {len(rois)} ROIs to '{args.record}'")
 
-    # Step 2: collect negatives
-    negatives = collect_boxes("negative")
+    # Average spectrum of every box, reading only the mosaic tiles it covers.
+    spectra = extract_roi_spectra(rois, cache=HypercubeCache(args.cache) if args.cache else None)
+    labels = np.array([roi.label for roi in rois])
+
+    # Drop boxes that fell outside the mosaic area.
+    valid = ~np.isnan(spectra).any(axis=1)
+    spectra, labels = spectra[valid], labels[valid]
+    positives = spectra[labels == "positive"]
+    negatives = spectra[labels == "negative"]
 
     # Save results for future plotting
     np.savez("spectral_profiles.npz",
@@ -61,27 +76,14 @@ if __name__ == "__main__":
             spectral_range=spectral_range)
     print("✅ Saved spectral data to 'spectral_profiles.npz'")
 
-    # Step 3: plot both
-    x = np.arange(spectral_bands)
-    x_smooth = np.linspace(x.min(), x.max(), 300)
-
-    pos_avg = np.mean(positives, axis=0)
-    neg_avg = np.mean(negatives, axis=0)
-
-    pos_smooth = make_interp_spline(x, pos_avg)(x_smooth)
-    neg_smooth = make_interp_spline(x, neg_avg)(x_smooth)
-
-    plt.figure(figsize=(10, 5), dpi=300)
-    plt.plot(x_smooth, pos_smooth, label="Positive", color="red", linewidth=2)
-    plt.plot(x_smooth, neg_smooth, label="Negative", color="green", linewidth=2)
-    plt.scatter(x, pos_avg, color="red")
-    plt.scatter(x, neg_avg, color="green")
-    plt.xticks(x, [f"{int(w)} nm" for w in spectral_range], rotation=45)
-    plt.xlabel("Wavelength")
-    plt.ylabel("Average Intensity")
-    plt.title("Spectral Signature: Positive vs Negative")
-    plt.grid()
-    plt.legend()
-    plt.ylim(0, 255)
-    plt.tight_layout()
-    plt.show()
+    # Step 3: plot both, as mean +/- std over the boxes
+    fig, ax = spectral_axes(spectral_range, title="Spectral Signature: Positive vs Negative",
+                            xlabel="Wavelength", ylim=(0, 255))
+    plot_mean_std(ax, positives, label="Positive", color="red")
+    plot_mean_std(ax, negatives, label="Negative", color="green")
+    ax.legend()
+    show_or_save(fig, args.plot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import json
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
+import numpy as np
+
+# Upper bounds of the latency histogram buckets in seconds, 4 per decade from
+# 10 us to 10 s (Prometheus "le" buckets, plus +Inf).
+BUCKETS = tuple(float(f"{m}e{e}") for e in range(-5, 1) for m in (1, 1.8, 3.2, 5.6)) + (10.0,)
+
+# Number of most recent latencies kept per stage for exact percentiles.
+MAX_SAMPLES = 65536
+
+_enabled = False
+_trace_allocations = False
+_lock = threading.Lock()
+_stages = {}
+_null = contextlib.nullcontext()
+
+class StageStats:
+    """
+    Latency, throughput and allocation statistics of one stage.
+
+    Attributes:
+    - count: int
+    - total_s: float
+        Sum of the latencies.
+    - max_s: float
+    - bytes: int
+        Bytes processed, as reported by the stage.
+    - buckets: numpy.ndarray
+        Number of latencies in each of the BUCKETS, and above the last one.
+    - alloc_bytes: int
+        Sum of the peak memory allocated within the stage (with tracemalloc).
+    - alloc_peak_bytes: int
+        Largest peak memory allocated within one call of the stage.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.bytes = 0
+        self.buckets = np.zeros(len(BUCKETS) + 1, dtype=np.int64)
+        self.alloc_bytes = 0
+        self.alloc_peak_bytes = 0
+        self._samples = np.empty(MAX_SAMPLES, dtype=np.float64)
+
+    def add(self, seconds, nbytes=0, allocated=0):
+        self._samples[self.count % MAX_SAMPLES] = seconds
+        self.count += 1
+        self.total_s += seconds
+        self.max_s = max(self.max_s, seconds)
+        self.bytes += nbytes
+        self.buckets[np.searchsorted(BUCKETS, seconds)] += 1
+        self.alloc_bytes += allocated
+        self.alloc_peak_bytes = max(self.alloc_peak_bytes, allocated)
+
+    @property
+    def samples(self):
+        """The most recent latencies, at most MAX_SAMPLES."""
+        return self._samples[:min(self.count, MAX_SAMPLES)]
+
+    def percentiles(self, percentiles=(50, 90, 99)):
+        """Latency percentiles in seconds, over the kept samples."""
+        if self.count == 0:
+            return np.full(len(percentiles), np.nan)
+        return np.percentile(self.samples, percentiles)
+
+    def summary(self):
+        p50, p90, p99 = self.percentiles()
+        return {
+            "count": self.count,
+            "total_s": self.total_s,
+            "mean_ms": self.total_s / max(self.count, 1) * 1e3,
+            "p50_ms": p50 * 1e3,
+            "p90_ms": p90 * 1e3,
+            "p99_ms": p99 * 1e3,
+            "max_ms": self.max_s * 1e3,
+            "bytes": self.bytes,
+            "mb_per_s": self.bytes / self.total_s / 1e6 if self.total_s > 0 else 0.0,
+            "alloc_bytes": self.alloc_bytes,
+            "alloc_peak_bytes": self.alloc_peak_bytes,
+        }
+
+class _Timer:
+    __slots__ = ("name", "nbytes", "_start", "_memory")
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        if _trace_allocations:
+            # Peak since the start of the stage. Nested stages reset the peak
+            # too, so an outer stage only sees the peak after its last inner one.
+            self._memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self._start
+        allocated = 0
+        if _trace_allocations:
+            allocated = max(tracemalloc.get_traced_memory()[1] - self._memory, 0)
+        record(self.name, seconds, self.nbytes, allocated)
+        return False
+
+def enable(trace_allocations=False):
+    """
+    Turns instrumentation on, optionally tracking the memory allocated by each
+    stage with tracemalloc (which slows every allocation down noticeably).
+    """
+    global _enabled, _trace_allocations
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _trace_allocations = trace_allocations
+    _enabled = True
+
+def disable():
+    global _enabled, _trace_allocations
+    if _trace_allocations:
+        tracemalloc.stop()
+    _enabled = _trace_allocations = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """Clears the statistics of every stage."""
+    with _lock:
+        _stages.clear()
+
+def stage(name, nbytes=0):
+    """
+    Context manager timing a stage, e.g.
+
+        with profiling.stage("demosaic", frame.nbytes):
+            ...
+
+    Bytes known only inside the block can be added with add_bytes on the
+    returned timer. When instrumentation is disabled this returns a shared
+    no-op context manager, so the cost is one function call.
+    """
+    if not _enabled:
+        return _null
+    return _Timer(name, nbytes)
+
+def timed(name, count_bytes="input"):
+    """
+    Decorator timing every call of a function as a stage.
+
+    Parameters:
+    - name: str
+        Stage name.
+    - count_bytes: str or None
+        "input" counts the bytes of the first numpy array argument, "output"
+        those of the returned array, None counts nothing.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            nbytes = 0
+            if count_bytes == "input":
+                nbytes = next((arg.nbytes for arg in args if isinstance(arg, np.ndarray)), 0)
+            with _Timer(name, nbytes) as timer:
+                result = func(*args, **kwargs)
+                if count_bytes == "output" and isinstance(result, np.ndarray):
+                    timer.add_bytes(result.nbytes)
+            return result
+        return wrapper
+    return decorator
+
+def record(name, seconds, nbytes=0, allocated=0):
+    """
+    Adds a latency measured elsewhere, e.g. from frame acquisition to disk.
+    Ignored when instrumentation is disabled.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        stats = _stages.get(name)
+        if stats is None:
+            stats = _stages[name] = StageStats()
+        stats.add(seconds, nbytes, allocated)
+
+def stats(name):
+    """Returns the StageStats of a stage, or None if it never ran."""
+    return _stages.get(name)
+
+def summary():
+    """
+    Returns the summary of every stage, keyed by stage name.
+    """
+    with _lock:
+        return {name: stats.summary() for name, stats in sorted(_stages.items())}
+
+def report():
+    """
+    Prints a table of the stage latencies, throughput and allocations.
+    """
+    print("{:<24} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "stage", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "MB/s", "alloc MB"))
+    for name, values in summary().items():
+        print("{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f} {:>10.1f}".format(
+            name, values["count"], values["mean_ms"], values["p50_ms"], values["p90_ms"], values["p99_ms"],
+            values["mb_per_s"], values["alloc_peak_bytes"] / 1e6))
+
+def prometheus_text(prefix="ximea"):
+    """
+    Returns the statistics in the Prometheus text exposition format: one
+    latency histogram per stage, plus counters of bytes and allocations.
+    """
+    lines = [f"# HELP {prefix}_stage_seconds Latency of a processing stage.",
+             f"# TYPE {prefix}_stage_seconds histogram"]
+    with _lock:
+        stages = sorted(_stages.items())
+        for name, stats in stages:
+            cumulative = np.cumsum(stats.buckets)
+            for bound, count in zip((*BUCKETS, "+Inf"), cumulative):
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {stats.total_s:.9g}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {stats.count}')
+        for metric, attribute, kind, help_text in (
+                ("bytes_total", "bytes", "counter", "Bytes processed by a stage."),
+                ("alloc_bytes_total", "alloc_bytes", "counter", "Peak bytes allocated within a stage, summed."),
+                ("alloc_peak_bytes", "alloc_peak_bytes", "gauge", "Largest peak allocated within one call.")):
+            lines.append(f"# HELP {prefix}_stage_{metric} {help_text}")
+            lines.append(f"# TYPE {prefix}_stage_{metric} {kind}")
+            for name, stats in stages:
+                lines.append(f'{prefix}_stage_{metric}{{stage="{name}"}} {getattr(stats, attribute)}')
+    return "\n".join(lines) + "\n"
+
+def export(path):
+    """
+    Writes the statistics to path: JSON if it ends in .json, otherwise the
+    Prometheus text format (e.g. for the node exporter textfile collector).
+    """
+    with open(path, "w") as f:
+        if path.endswith(".json"):
+            json.dump(summary(), f, indent=2)
+        else:
+            f.write(prometheus_text())
+
+def add_arguments(parser):
+    """
+    Adds the --profile and --profile-allocations options to a script's parser.
+    """
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Time the processing stages and save the statistics to PATH "
+                             "(.json, otherwise Prometheus text).")
+    parser.add_argument("--profile-allocations", action="store_true",
+                        help="With --profile, also track the memory allocated by each stage (slower).")
+
+def start(args):
+    """Enables instrumentation if the script was run with --profile."""
+    if args.profile:
+        enable(trace_allocations=args.profile_allocations)
+
+def finish(args):
+    """Prints and saves the statistics if the script was run with --profile."""
+    if args.profile:
+        report()
+        export(args.profile)
+        print(f"Saved the profile to {args.profile}")
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, demosaic_array, band_wavelengths
+
+def load_correction_matrix(path):
+    """
+    Loads a band correction matrix from a .npy file, or from a .npz file with
+    a "matrix" array and optional "names" of the output bands.
+
+    Returns:
+    - matrix: numpy.ndarray
+        float32 array of shape (num_outputs, num_bands).
+    - names: list of str or None
+    """
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            matrix = data["matrix"]
+            names = [str(name) for name in data["names"]] if "names" in data.files else None
+    else:
+        matrix, names = np.load(path), None
+    return np.asarray(matrix, dtype=np.float32), names
+
+def crosstalk_correction(crosstalk):
+    """
+    Returns the matrix that undoes band crosstalk.
+
+    Parameters:
+    - crosstalk: numpy.ndarray
+        Array of shape (num_bands, num_bands) where crosstalk[i, j] is the
+        response of band i to light seen by filter j (1 on the diagonal for
+        normalized filters), e.g. measured with monochromatic light.
+
+    Returns:
+    - matrix: numpy.ndarray
+        float32 array of shape (num_bands, num_bands), its inverse.
+    """
+    return np.linalg.inv(np.asarray(crosstalk, dtype=np.float64)).astype(np.float32)
+
+class RadiometricCorrector:
+    """
+    Radiometric correction of demosaiced hypercubes: per-band dark/flat
+    correction, then a band correction matrix (crosstalk removal or virtual
+    bands) applied to the spectrum of every pixel.
+
+    Unlike FFCCorrector, which scales the whole mosaic by one brightness, each
+    band is normalized by its own flat response, so the result is in the same
+    units for every band: scale * (cube - dark) / (flat - dark) with scale
+    the mean of flat - dark of the band ("band"), or a fixed number (e.g. 1.0
+    for reflectance relative to the flat target). Pixels where flat <= dark
+    are set to 0.
+
+    The matrix is applied as one matrix product per chunk of rows, across all
+    bands and pixels of the chunk, into the float32 output. Rows are processed
+    in chunks, so the float32 working memory does not depend on the frame size.
+
+    Parameters:
+    - flat_cube: numpy.ndarray
+        Demosaiced flat field of shape (num_bands, height, width).
+    - dark_cube: numpy.ndarray
+        Demosaiced dark field of the same shape.
+    - matrix: numpy.ndarray, optional
+        Correction matrix of shape (num_outputs, num_bands). None skips it.
+    - scale: str or float
+        "band" or a fixed output scale, see above.
+    - names: list of str, optional
+        Names of the output bands of the matrix.
+    """
+
+    def __init__(self, flat_cube, dark_cube, matrix=None, scale="band", names=None):
+        if flat_cube.shape != dark_cube.shape or flat_cube.ndim != 3:
+            raise ValueError("Flat and dark cubes must both have shape (num_bands, height, width).")
+        num_bands = flat_cube.shape[0]
+        if matrix is not None:
+            matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+            if matrix.ndim != 2 or matrix.shape[1] != num_bands:
+                raise ValueError(f"Correction matrix must have shape (num_outputs, {num_bands}), got {matrix.shape}.")
+        if names is not None and len(names) != (num_bands if matrix is None else matrix.shape[0]):
+            raise ValueError("One name is needed per output band.")
+
+        span = flat_cube.astype(np.float32) - dark_cube.astype(np.float32)
+        valid = span > 0
+        if isinstance(scale, str):
+            if scale != "band":
+                raise ValueError(f"Unknown scale: {scale}")
+            scale = np.array([band[mask].mean() if mask.any() else 0.0 for band, mask in zip(span, valid)],
+                             dtype=np.float32)[:, None, None]
+
+        self.dark = np.ascontiguousarray(dark_cube, dtype=np.float32)
+        self.gain = np.divide(scale, span, out=np.zeros_like(span), where=valid)
+        self.matrix = matrix
+        self.names = names
+
+    @classmethod
+    def from_mosaic(cls, flat_field, dark_field, matrix=None, scale="band", names=None, layout=XIMEA_NIR_5X5,
+                    sort_bands=True):
+        """
+        Builds a corrector from raw mosaic flat and dark fields (e.g. loaded
+        with capture_image.load_manual_ffc), demosaiced like the cubes.
+        """
+        return cls(demosaic_array(flat_field, layout, sort_bands), demosaic_array(dark_field, layout, sort_bands),
+                   matrix, scale, names)
+
+    @property
+    def shape(self):
+        return self.dark.shape
+
+    @property
+    def num_outputs(self):
+        return self.shape[0] if self.matrix is None else self.matrix.shape[0]
+
+    def apply(self, cube, out=None, chunk_rows=64):
+        """
+        Corrects a hypercube or a batch of hypercubes.
+
+        Parameters:
+        - cube: numpy.ndarray
+            Array of shape (num_bands, height, width) or (N, num_bands, height, width).
+        - out: numpy.ndarray, optional
+            C-contiguous float32 output of the returned shape.
+        - chunk_rows: int
+            Number of rows corrected at a time.
+
+        Returns:
+        - corrected: numpy.ndarray
+            float32 array of shape (num_outputs, height, width), or
+            (N, num_outputs, height, width) for a batch.
+        """
+        cubes = cube[None] if cube.ndim == 3 else cube
+        if cubes.shape[1:] != self.shape:
+            raise ValueError(f"Hypercube shape {cube.shape} does not match the correction shape {self.shape}.")
+        num_bands, height, width = self.shape
+        shape = (*cube.shape[:-3], self.num_outputs, height, width)
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or out.dtype != np.float32 or not out.flags.c_contiguous:
+            raise ValueError(f"Output must be a C-contiguous float32 array of shape {shape}.")
+        outputs = out.reshape(-1, self.num_outputs, height, width)
+
+        buffer = np.empty((num_bands, chunk_rows * width), dtype=np.float32)
+        for frame, output in zip(cubes, outputs):
+            for row in range(0, height, chunk_rows):
+                rows = slice(row, min(row + chunk_rows, height))
+                n = (rows.stop - row) * width
+                # Rows of a band are contiguous, so (bands, rows * width) chunks
+                # are 2D strided views of the cube and of the output.
+                pixels = buffer[:, :n].reshape(num_bands, -1, width)
+                np.subtract(frame[:, rows], self.dark[:, rows], out=pixels, dtype=np.float32)
+                pixels *= self.gain[:, rows]
+                np.maximum(pixels, 0, out=pixels)
+                if self.matrix is None:
+                    output[:, rows] = pixels
+                else:
+                    np.matmul(self.matrix, buffer[:, :n], out=output[:, rows].reshape(self.num_outputs, n))
+        return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-band FFC and band correction matrix on Ximea mosaic images.")
+    parser.add_argument("images", nargs="+", help="Images to correct.")
+    parser.add_argument("--ffc-folder", default="ffc",
+                        help="Folder containing the FFC TIFF files, or a calibration store of averaged fields.")
+    parser.add_argument("--matrix", help="Correction matrix (.npy, or .npz with 'matrix' and optional 'names').")
+    parser.add_argument("--crosstalk", help="Measured crosstalk matrix (.npy), inverted to correct it.")
+    parser.add_argument("--scale", default="band", help="'band' or a fixed output scale (e.g. 1 for reflectance).")
+    parser.add_argument("--output", help="Save the corrected cubes to this .npz file.")
+    args = parser.parse_args()
+
+    from capture_image import load_manual_ffc
+
+    matrix, names = None, None
+    if args.matrix:
+        matrix, names = load_correction_matrix(args.matrix)
+    elif args.crosstalk:
+        matrix = crosstalk_correction(np.load(args.crosstalk))
+    if names is None:
+        names = [f"{int(wavelength)} nm" for wavelength in band_wavelengths()] if matrix is None or \
+            matrix.shape[0] == matrix.shape[1] else [f"band {k}" for k in range(matrix.shape[0])]
+
+    flat_field, dark_field, ffc_id, _ = load_manual_ffc(args.ffc_folder)
+    scale = args.scale if args.scale == "band" else float(args.scale)
+    corrector = RadiometricCorrector.from_mosaic(flat_field, dark_field, matrix, scale, names)
+    print(f"Using FFC calibration {ffc_id}")
+
+    results = []
+    for image_path in args.images:
+        corrected = corrector.apply(demosaic_array(image_path))
+        means = corrected.reshape(corrector.num_outputs, -1).mean(axis=1)
+        print(image_path + ": " + ", ".join(f"{name} {mean:.2f}" for name, mean in zip(names, means)))
+        if args.output:
+            results.append(corrected)
+
+    if args.output:
+        np.savez(args.output, names=np.array(names), images=np.array(args.images), values=np.stack(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+import os
+import json
+import threading
+import numpy as np
+
+import profiling
+from utils import XIMEA_NIR_5X5, MosaicLayout, mosaic_band_view, demosaic_array
+
+# Per-frame metadata stored alongside each mosaic frame.
+METADATA_DTYPE = np.dtype([
+    ("timestamp_ns", "<i8"),
+    ("exposure_us", "<i4"),
+    ("gain_db", "<f4"),
+    ("ffc_id", "S32"),
+])
+
+# Longest ffc_id, in bytes, that fits in a metadata record.
+FFC_ID_LENGTH = METADATA_DTYPE["ffc_id"].itemsize
+
+HEADER_FILE = "header.json"
+FRAMES_FILE = "frames.u8"
+METADATA_FILE = "metadata.bin"
+
+class RawFrameStore:
+    """
+    Append-only store of uint8 mosaic frames. Frames are written back to back
+    to a single raw file and read through a memory map, so frame k is a view
+    at a fixed offset and never has to be decoded. A parallel fixed-size
+    record file holds the per-frame metadata (METADATA_DTYPE).
+
+    A store is a folder containing header.json, frames.u8 and metadata.bin.
+    Use RawFrameStore.create to make a new one and RawFrameStore(path) to
+    open an existing one.
+
+    Parameters:
+    - path: str
+        Folder of the store.
+    - mode: str
+        "r" to read, "a" to read and append.
+    """
+
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError(f"Unsupported mode: {mode}")
+
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            header = json.load(f)
+
+        self.path = path
+        self.mode = mode
+        self.frame_shape = tuple(header["frame_shape"])
+        self.layout = MosaicLayout(**header["layout"])
+        self._lock = threading.Lock()
+        self._frames_file = None
+        self._metadata_file = None
+        if mode == "a":
+            self._truncate_partial_frames()
+            self._frames_file = open(os.path.join(path, FRAMES_FILE), "ab")
+            self._metadata_file = open(os.path.join(path, METADATA_FILE), "ab")
+        self.refresh()
+        self._next_index = len(self.frames)
+
+    @classmethod
+    def create(cls, path, frame_shape, layout=XIMEA_NIR_5X5):
+        """
+        Creates an empty store and opens it for appending.
+
+        Parameters:
+        - path: str
+            Folder of the new store. It must not already contain a store.
+        - frame_shape: tuple
+            (height, width) of the raw mosaic frames.
+        - layout: MosaicLayout
+            Layout used to demosaic the frames, saved in the header.
+
+        Returns:
+        - store: RawFrameStore
+        """
+
+        if os.path.exists(os.path.join(path, HEADER_FILE)):
+            raise FileExistsError(f"A frame store already exists at: {path}")
+        os.makedirs(path, exist_ok=True)
+
+        header = {
+            "frame_shape": list(frame_shape),
+            "dtype": "uint8",
+            "layout": layout.to_dict(),
+            "metadata": [list(field) for field in METADATA_DTYPE.descr],
+        }
+        with open(os.path.join(path, HEADER_FILE), "w") as f:
+            json.dump(header, f, indent=4)
+        open(os.path.join(path, FRAMES_FILE), "wb").close()
+        open(os.path.join(path, METADATA_FILE), "wb").close()
+        return cls(path, mode="a")
+
+    @classmethod
+    def open_or_create(cls, path, frame_shape, layout=XIMEA_NIR_5X5):
+        """
+        Opens the store at path for appending, creating it if it does not exist.
+        """
+        if not is_raw_store(path):
+            return cls.create(path, frame_shape, layout)
+        store = cls(path, mode="a")
+        if store.frame_shape != tuple(frame_shape):
+            store.close()
+            raise ValueError(f"Frame store {path} holds frames of shape {store.frame_shape}, not {tuple(frame_shape)}.")
+        return store
+
+    def _truncate_partial_frames(self):
+        # A crash between the frame and metadata writes of append leaves bytes
+        # of a frame (or of a record) without its counterpart. Appending after
+        # them would shift every later frame away from the offset its record
+        # implies, so both files are cut back to the last complete frame.
+        frame_bytes = int(np.prod(self.frame_shape))
+        frames_path = os.path.join(self.path, FRAMES_FILE)
+        metadata_path = os.path.join(self.path, METADATA_FILE)
+        num_frames = min(os.path.getsize(frames_path) // frame_bytes,
+                         os.path.getsize(metadata_path) // METADATA_DTYPE.itemsize)
+        for path, size in ((frames_path, num_frames * frame_bytes),
+                           (metadata_path, num_frames * METADATA_DTYPE.itemsize)):
+            if os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+    def refresh(self):
+        """
+        Re-maps the frame and metadata files, picking up frames appended since
+        the store was opened (e.g. by a capture running in another process).
+        """
+        num_frames = os.path.getsize(os.path.join(self.path, METADATA_FILE)) // METADATA_DTYPE.itemsize
+        if num_frames == 0:
+            self.frames = np.empty((0, *self.frame_shape), dtype=np.uint8)
+            self.metadata = np.empty(0, dtype=METADATA_DTYPE)
+            return
+
+        self.frames = np.memmap(os.path.join(self.path, FRAMES_FILE), dtype=np.uint8, mode="r",
+                                shape=(num_frames, *self.frame_shape))
+        self.metadata = np.memmap(os.path.join(self.path, METADATA_FILE), dtype=METADATA_DTYPE, mode="r",
+                                  shape=(num_frames,))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @profiling.timed("write")
+    def append(self, frame, timestamp_ns=0, exposure_us=0, gain_db=0.0, ffc_id=""):
+        """
+        Appends a frame and its metadata. Safe to call from several threads.
+
+        Parameters:
+        - frame: numpy.ndarray
+            uint8 mosaic frame of shape frame_shape.
+        - timestamp_ns: int
+        - exposure_us: int
+        - gain_db: float
+        - ffc_id: str
+            Identifier of the flat field correction applied to the frame ("" if
+            none), at most FFC_ID_LENGTH bytes in UTF-8.
+
+        Returns:
+        - index: int
+            Index of the appended frame.
+        """
+
+        if self.mode != "a":
+            raise IOError("Frame store is not open for appending.")
+        if frame.shape != self.frame_shape or frame.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 frame of shape {self.frame_shape}, got {frame.dtype} {frame.shape}.")
+
+        encoded_id = ffc_id.encode()
+        if len(encoded_id) > FFC_ID_LENGTH:
+            raise ValueError(f"FFC id {ffc_id!r} is longer than {FFC_ID_LENGTH} bytes.")
+        record = np.array([(timestamp_ns, exposure_us, gain_db, encoded_id)], dtype=METADATA_DTYPE)
+        with self._lock:
+            # The frame is written before its metadata record, so readers that
+            # size the store by the metadata file never see a partial frame.
+            self._frames_file.write(np.ascontiguousarray(frame).data)
+            self._frames_file.flush()
+            self._metadata_file.write(record.tobytes())
+            self._metadata_file.flush()
+            index = self._next_index
+            self._next_index += 1
+            return index
+
+    def close(self):
+        if self._frames_file is not None:
+            self._frames_file.close()
+            self._metadata_file.close()
+            self._frames_file = None
+            self._metadata_file = None
+            self.refresh()
+
+    def band_view(self, index):
+        """
+        Returns a zero-copy view of frame(s) split into mosaic offsets, of shape
+        (..., p, p, block_rows, block_cols). See utils.mosaic_band_view.
+        """
+        return mosaic_band_view(self.frames[index], self.layout)
+
+    def hypercube(self, index, sort_bands=True, out=None):
+        """
+        Demosaics frame(s) into a hypercube array. See utils.demosaic_array.
+        """
+        return demosaic_array(self.frames[index], self.layout, sort_bands, out)
+
+def is_raw_store(path):
+    """
+    Returns True if path is the folder of a RawFrameStore.
+    """
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+import os
+import csv
+import json
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, load_raw8_image, mosaic_band_view, demosaic_array
+from integral import IntegralHypercube
+
+# Number of box ROIs on one image above which box means are read from
+# summed-area tables instead of averaging the tiles of each box.
+INTEGRAL_MIN_ROIS = 64
+
+@dataclass(frozen=True)
+class ROI:
+    """
+    A labeled region of interest on a raw mosaic image.
+
+    Parameters:
+    - image: str
+        Path of the image the ROI was drawn on.
+    - label: str
+        Label of the region (e.g. "positive", "negative").
+    - box: tuple
+        (x1, y1, x2, y2) in raw image pixels, as returned by ImageBoxSelector.
+        For polygons this is the bounding box.
+    - polygon: tuple, optional
+        ((x, y), ...) vertices in raw image pixels.
+    """
+
+    image: str
+    label: str
+    box: tuple
+    polygon: tuple = None
+
+    @classmethod
+    def from_polygon(cls, image, label, polygon):
+        points = np.asarray(polygon, dtype=np.float64)
+        box = (int(points[:, 0].min()), int(points[:, 1].min()),
+               int(np.ceil(points[:, 0].max())), int(np.ceil(points[:, 1].max())))
+        return cls(image, label, box, tuple(tuple(float(v) for v in point) for point in points))
+
+    def to_dict(self):
+        roi = {"image": self.image, "label": self.label, "box": list(self.box)}
+        if self.polygon is not None:
+            roi["polygon"] = [list(point) for point in self.polygon]
+        return roi
+
+def load_rois(path):
+    """
+    Loads ROIs from a JSON or CSV spec file, chosen by extension.
+
+    JSON files hold a list of objects with "image", "label" and either "box"
+    ([x1, y1, x2, y2]) or "polygon" ([[x, y], ...]). CSV files have the
+    columns image, label, x1, y1, x2, y2 and an optional polygon column of
+    "x y;x y;..." vertices. Relative image paths are resolved against the
+    folder of the spec file.
+
+    Parameters:
+    - path: str
+        Path to the spec file.
+
+    Returns:
+    - rois: list of ROI
+    """
+
+    if path.lower().endswith(".csv"):
+        with open(path, newline="") as f:
+            records = []
+            for row in csv.DictReader(f):
+                record = {"image": row["image"], "label": row["label"]}
+                if row.get("polygon"):
+                    record["polygon"] = [point.split() for point in row["polygon"].split(";")]
+                else:
+                    record["box"] = [row["x1"], row["y1"], row["x2"], row["y2"]]
+                records.append(record)
+    else:
+        with open(path) as f:
+            records = json.load(f)
+
+    base = os.path.dirname(path)
+    rois = []
+    for record in records:
+        image = os.path.join(base, record["image"])
+        if "polygon" in record:
+            rois.append(ROI.from_polygon(image, record["label"], record["polygon"]))
+        else:
+            rois.append(ROI(image, record["label"], tuple(int(float(v)) for v in record["box"])))
+    return rois
+
+def save_rois(path, rois):
+    """
+    Saves ROIs to a JSON spec file, with image paths relative to its folder.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    records = []
+    for roi in rois:
+        record = roi.to_dict()
+        record["image"] = os.path.relpath(os.path.abspath(roi.image), base)
+        records.append(record)
+    with open(path, "w") as f:
+        json.dump(records, f, indent=4)
+
+def roi_block_bounds(box, layout=XIMEA_NIR_5X5):
+    """
+    Converts a box in raw image pixels into band (block) coordinates,
+    accounting for the mosaic crop offset.
+
+    Parameters:
+    - box: tuple
+        (x1, y1, x2, y2) in raw image pixels, in any corner order.
+    - layout: MosaicLayout
+
+    Returns:
+    - bounds: tuple
+        (bx1, by1, bx2, by2) block indices, clipped to the band size.
+    """
+    x1, y1, x2, y2 = box
+    x1, x2 = sorted((x1, x2))
+    y1, y2 = sorted((y1, y2))
+    row, col = layout.crop_origin
+    block_rows, block_cols = layout.block_shape
+    p = layout.pattern_size
+    bx1, bx2 = np.clip([(x1 - col) // p, (x2 - col) // p], 0, block_cols)
+    by1, by2 = np.clip([(y1 - row) // p, (y2 - row) // p], 0, block_rows)
+    return int(bx1), int(by1), int(bx2), int(by2)
+
+def polygon_block_mask(polygon, bounds, layout=XIMEA_NIR_5X5):
+    """
+    Returns a boolean mask over the blocks in bounds whose centers lie inside
+    the polygon (even-odd rule).
+    """
+    bx1, by1, bx2, by2 = bounds
+    row, col = layout.crop_origin
+    p = layout.pattern_size
+    xs = col + (np.arange(bx1, bx2) + 0.5) * p
+    ys = row + (np.arange(by1, by2) + 0.5) * p
+    px, py = np.meshgrid(xs, ys)
+
+    inside = np.zeros(px.shape, dtype=bool)
+    vertices = np.asarray(polygon, dtype=np.float64)
+    for (xa, ya), (xb, yb) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        crosses = (ya > py) != (yb > py)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x_cross = xa + (py - ya) * (xb - xa) / (yb - ya)
+        inside ^= crosses & (px < x_cross)
+    return inside
+
+def roi_spectra(image, rois, layout=XIMEA_NIR_5X5, sort_bands=True):
+    """
+    Computes the mean spectrum of each ROI on one raw mosaic image. Only the
+    mosaic tiles covering each ROI are read, through the zero-copy view of
+    utils.mosaic_band_view, so the full frame is never demosaiced. When an
+    image has INTEGRAL_MIN_ROIS boxes or more, their means are instead read
+    in one batch from an IntegralHypercube.
+
+    Parameters:
+    - image: numpy.ndarray
+        The RAW8 mosaic image, or its demosaiced (num_bands, height, width)
+        hypercube (e.g. from a HypercubeCache), with bands in sort_bands order.
+    - rois: list of ROI
+    - layout: MosaicLayout
+    - sort_bands: bool
+        Order the bands by ascending wavelength.
+
+    Returns:
+    - spectra: numpy.ndarray
+        float64 array of shape (len(rois), num_bands). Empty ROIs are NaN.
+    """
+
+    if image.ndim == 3:
+        # Already demosaiced, so the bands are in their final order.
+        hypercube = image
+        view = image.reshape(layout.pattern_size, layout.pattern_size, *image.shape[1:])
+        order = np.arange(layout.num_bands)
+    else:
+        hypercube = None
+        view = mosaic_band_view(image, layout)
+        order = layout.sort_order if sort_bands else np.arange(layout.num_bands)
+    spectra = np.full((len(rois), layout.num_bands), np.nan)
+
+    remaining = range(len(rois))
+    boxes = [i for i, roi in enumerate(rois) if roi.polygon is None]
+    if len(boxes) >= INTEGRAL_MIN_ROIS:
+        if hypercube is None:
+            hypercube = demosaic_array(image, layout, sort_bands)
+        integral = IntegralHypercube(hypercube, squares=False)
+        bounds = np.array([roi_block_bounds(rois[i].box, layout) for i in boxes])
+        spectra[boxes] = integral.box_means(bounds)
+        remaining = [i for i, roi in enumerate(rois) if roi.polygon is not None]
+
+    for i in remaining:
+        roi = rois[i]
+        bx1, by1, bx2, by2 = bounds = roi_block_bounds(roi.box, layout)
+        if bx2 <= bx1 or by2 <= by1:
+            continue
+        tiles = view[:, :, by1:by2, bx1:bx2].reshape(layout.num_bands, by2 - by1, bx2 - bx1)
+        if roi.polygon is not None:
+            mask = polygon_block_mask(roi.polygon, bounds, layout)
+            if not mask.any():
+                continue
+            band_means = tiles[:, mask].mean(axis=1)
+        else:
+            band_means = tiles.mean(axis=(1, 2))
+        spectra[i] = band_means[order]
+
+    return spectra
+
+def extract_roi_spectra(rois, layout=XIMEA_NIR_5X5, workers=None, cache=None, images=None):
+    """
+    Computes the mean spectrum of every ROI, decoding each image once and
+    processing images in parallel.
+
+    Parameters:
+    - rois: list of ROI
+    - layout: MosaicLayout
+    - workers: int, optional
+        Number of threads (default: number of CPUs).
+    - cache: HypercubeCache, optional
+        Read the demosaiced hypercubes from this cache instead of decoding
+        the images.
+    - images: dict, optional
+        Already decoded RAW8 images keyed by path (e.g. the images shown
+        to draw the ROIs), used instead of decoding them again.
+
+    Returns:
+    - spectra: numpy.ndarray
+        float64 array of shape (len(rois), num_bands), in the order of rois.
+    """
+
+    by_image = {}
+    for i, roi in enumerate(rois):
+        by_image.setdefault(roi.image, []).append(i)
+
+    def process(item):
+        image_path, indices = item
+        if images and image_path in images:
+            image = images[image_path]
+        elif cache is not None:
+            image = cache.get(image_path, layout)
+        else:
+            image = load_raw8_image(image_path)
+        return indices, roi_spectra(image, [rois[i] for i in indices], layout)
+
+    spectra = np.full((len(rois), layout.num_bands), np.nan)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for indices, image_spectra in pool.map(process, by_image.items()):
+            spectra[indices] = image_spectra
+    return spectra
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import os
+import time
+import glob
+import numpy as np
+
+from decode import read_many
+
+class Image:
+    """
+    Stand-in for xiapi.Image. Holds the raw data and metadata of the last
+    frame returned by Camera.get_image.
+    """
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.nframe = 0
+        self.tsSec = 0
+        self.tsUSec = 0
+        self.exposure_time_us = 0
+        self.gain_db = 0.0
+        self._data = b""
+
+    def get_image_data_raw(self):
+        return self._data
+
+    def get_image_data_numpy(self):
+        return np.frombuffer(self._data, dtype=np.uint8).reshape((self.height, self.width))
+
+class Camera:
+    """
+    Stand-in for xiapi.Camera that replays RAW8 images from a folder
+    (e.g. fb_images) in a loop, so the capture pipeline can run without
+    hardware. Only the calls used by capture_image.py are implemented.
+
+    Parameters:
+    - image_folder: str
+        Folder of RAW8 mosaic images to replay.
+    - framerate: float, optional
+        Maximum frame rate of get_image. If None, frames are returned as fast
+        as they are requested.
+    """
+
+    def __init__(self, image_folder="fb_images", framerate=None):
+        self.image_folder = image_folder
+        self.framerate = framerate
+        self.exposure = 10000
+        self.gain = 0.0
+        self.imgdataformat = "XI_MONO8"
+        self.ffc_enabled = False
+        self.ffc_flat_field_file_name = None
+        self.ffc_dark_field_file_name = None
+        self._frames = []
+        self._opened = False
+        self._acquiring = False
+        self._nframe = 0
+        self._last_time = None
+
+    # ------------- Device -------------
+    def open_device(self):
+        image_files = sorted(glob.glob(os.path.join(self.image_folder, "*.png")))
+        if not image_files:
+            raise FileNotFoundError(f"No images to replay in folder: {self.image_folder}")
+        self._frames = read_many(image_files)
+        self._opened = True
+
+    def close_device(self):
+        self._frames = []
+        self._opened = False
+
+    # ------------- Parameters -------------
+    def set_exposure(self, exposure):
+        self.exposure = int(exposure)
+
+    def get_exposure(self):
+        return self.exposure
+
+    def set_gain(self, gain):
+        self.gain = float(gain)
+
+    def get_gain(self):
+        return self.gain
+
+    def set_imgdataformat(self, imgdataformat):
+        self.imgdataformat = imgdataformat
+
+    def get_imgdataformat(self):
+        return self.imgdataformat
+
+    def get_framerate(self):
+        return self.framerate
+
+    def enable_ffc(self):
+        self.ffc_enabled = True
+
+    def disable_ffc(self):
+        self.ffc_enabled = False
+
+    def set_ffc_flat_field_file_name(self, file_name):
+        self.ffc_flat_field_file_name = file_name
+
+    def set_ffc_dark_field_file_name(self, file_name):
+        self.ffc_dark_field_file_name = file_name
+
+    # ------------- Acquisition -------------
+    def start_acquisition(self):
+        if not self._opened:
+            raise RuntimeError("Device is not open.")
+        self._acquiring = True
+        self._last_time = None
+
+    def stop_acquisition(self):
+        self._acquiring = False
+
+    def get_image(self, image, timeout=None):
+        """
+        Fills image with the next replayed frame, waiting to honour the frame rate.
+        """
+        if not self._acquiring:
+            raise RuntimeError("Acquisition is not started.")
+
+        if self.framerate:
+            now = time.perf_counter()
+            if self._last_time is not None:
+                delay = self._last_time + 1.0 / self.framerate - now
+                if delay > 0:
+                    time.sleep(delay)
+            self._last_time = time.perf_counter()
+
+        frame = self._frames[self._nframe % len(self._frames)]
+        timestamp = time.time()
+        image.height, image.width = frame.shape
+        image.nframe = self._nframe
+        image.tsSec = int(timestamp)
+        image.tsUSec = int((timestamp - image.tsSec) * 1e6)
+        image.exposure_time_us = self.exposure
+        image.gain_db = self.gain
+        image._data = frame.tobytes()
+        self._nframe += 1
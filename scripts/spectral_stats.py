@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+import numpy as np
+
+import profiling
+
+# Number of intensity levels of a RAW8 band.
+NUM_LEVELS = 256
+
+_LEVELS = np.arange(NUM_LEVELS, dtype=np.float64)
+
+@profiling.timed("reduction")
+def band_histograms(hypercube):
+    """
+    Computes the 256-bin intensity histogram of every band in a single pass
+    over a uint8 hypercube (or stack of hypercubes).
+
+    Parameters:
+    - hypercube: numpy.ndarray
+        uint8 array of shape (num_bands, height, width) or (N, num_bands, height, width).
+        Any spatial crop (e.g. a box) is accepted.
+
+    Returns:
+    - histograms: numpy.ndarray
+        int64 array of shape (num_bands, 256).
+    """
+
+    if hypercube.dtype != np.uint8:
+        raise TypeError(f"Expected a uint8 hypercube, got {hypercube.dtype}.")
+    if hypercube.ndim == 4:
+        hypercube = np.moveaxis(hypercube, 1, 0)
+
+    histograms = np.empty((hypercube.shape[0], NUM_LEVELS), dtype=np.int64)
+    for band, values in enumerate(hypercube):
+        histograms[band] = np.bincount(values.ravel(), minlength=NUM_LEVELS)
+    return histograms
+
+def histogram_percentiles(histograms, percentiles):
+    """
+    Computes per-band percentiles from histograms. For integer intensities
+    this is exact: the result is the lowest level whose cumulative count
+    reaches the percentile (numpy's "inverted_cdf" method).
+
+    Parameters:
+    - histograms: numpy.ndarray
+        Array of shape (num_bands, 256).
+    - percentiles: sequence of float
+        Percentiles in [0, 100].
+
+    Returns:
+    - values: numpy.ndarray
+        float64 array of shape (num_bands, len(percentiles)). Bands without
+        any samples are NaN.
+    """
+
+    cumulative = np.cumsum(histograms, axis=1)
+    targets = np.asarray(percentiles, dtype=np.float64) / 100.0 * cumulative[:, -1:]
+    targets = np.maximum(targets, 1)
+    values = np.stack([np.searchsorted(row, target) for row, target in zip(cumulative, targets)]).astype(np.float64)
+    values[cumulative[:, -1] == 0] = np.nan
+    return values
+
+def summarize_histograms(histograms):
+    """
+    Derives count, mean, variance, min, max and saturation counts per band from
+    histograms, without touching the pixels again.
+
+    Parameters:
+    - histograms: numpy.ndarray
+        Array of shape (num_bands, 256).
+
+    Returns:
+    - summary: dict
+        Per-band arrays keyed by "count", "mean", "var", "min", "max",
+        "saturated" (pixels at 255) and "dark" (pixels at 0).
+    """
+
+    count = histograms.sum(axis=1)
+    safe_count = np.maximum(count, 1)
+    mean = histograms @ _LEVELS / safe_count
+    var = histograms @ (_LEVELS ** 2) / safe_count - mean ** 2
+
+    nonzero = histograms > 0
+    return {
+        "count": count,
+        "mean": mean,
+        "var": np.maximum(var, 0.0),
+        "min": np.where(count > 0, np.argmax(nonzero, axis=1), 0),
+        "max": np.where(count > 0, NUM_LEVELS - 1 - np.argmax(nonzero[:, ::-1], axis=1), 0),
+        "saturated": histograms[:, -1].copy(),
+        "dark": histograms[:, 0].copy(),
+    }
+
+class SpectralReducer:
+    """
+    Accumulates per-band statistics over any number of hypercubes, one frame
+    at a time, so dataset-level statistics never need all frames in memory.
+
+    Each update makes a single histogram pass over the frame. Mean and
+    variance are combined across frames with Welford/Chan's parallel update
+    (count, mean, M2), min/max are kept as running extremes and the histograms
+    are summed, so percentiles are available for the whole dataset.
+
+    Parameters:
+    - num_bands: int
+        Number of bands of the hypercubes.
+    """
+
+    def __init__(self, num_bands=25):
+        self.num_bands = num_bands
+        self.count = np.zeros(num_bands, dtype=np.int64)
+        self.mean = np.zeros(num_bands, dtype=np.float64)
+        self.m2 = np.zeros(num_bands, dtype=np.float64)
+        self.min = np.full(num_bands, NUM_LEVELS - 1, dtype=np.int64)
+        self.max = np.zeros(num_bands, dtype=np.int64)
+        self.histograms = np.zeros((num_bands, NUM_LEVELS), dtype=np.int64)
+        self.frames = 0
+
+    def update(self, hypercube):
+        """
+        Adds a hypercube of shape (num_bands, height, width), or a stack of
+        them, to the statistics. Returns the histograms of the new data.
+        """
+        histograms = band_histograms(hypercube)
+        self.update_histograms(histograms, frames=hypercube.shape[0] if hypercube.ndim == 4 else 1)
+        return histograms
+
+    def update_histograms(self, histograms, frames=1):
+        """
+        Adds precomputed band histograms (e.g. computed by a worker) to the statistics.
+        """
+        summary = summarize_histograms(histograms)
+        self._combine(summary["count"], summary["mean"], summary["var"] * summary["count"],
+                      summary["min"], summary["max"], histograms, frames)
+
+    def merge(self, other):
+        """
+        Merges the statistics of another reducer into this one.
+        """
+        self._combine(other.count, other.mean, other.m2, other.min, other.max, other.histograms, other.frames)
+
+    def _combine(self, count, mean, m2, minimum, maximum, histograms, frames):
+        total = self.count + count
+        safe_total = np.maximum(total, 1)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / safe_total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * count / safe_total
+        self.count = total
+
+        has_data = count > 0
+        self.min = np.where(has_data, np.minimum(self.min, minimum), self.min)
+        self.max = np.where(has_data, np.maximum(self.max, maximum), self.max)
+        self.histograms += histograms
+        self.frames += frames
+
+    @property
+    def var(self):
+        return self.m2 / np.maximum(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    @property
+    def saturated(self):
+        return self.histograms[:, -1]
+
+    def percentiles(self, percentiles):
+        """
+        Returns per-band percentiles of all accumulated pixels, of shape
+        (num_bands, len(percentiles)). See histogram_percentiles.
+        """
+        return histogram_percentiles(self.histograms, percentiles)
+
+    def result(self, percentiles=(5, 50, 95)):
+        """
+        Returns the accumulated statistics as a dict of per-band arrays.
+        """
+        values = self.percentiles(percentiles)
+        result = {
+            "frames": self.frames,
+            "count": self.count,
+            "mean": self.mean,
+            "var": self.var,
+            "std": self.std,
+            "min": self.min,
+            "max": self.max,
+            "saturated": self.saturated.copy(),
+        }
+        for i, percentile in enumerate(percentiles):
+            result[f"p{percentile:g}"] = values[:, i]
+        return result
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+import os
+import mmap
+import argparse
+from dataclasses import replace
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from utils import XIMEA_NIR_5X5, get_layout, demosaic_array, mosaic_band_view
+from decode import read_npy_header
+from ffc import FFCCorrector, fixed_point_shift_for_spans, gain_table, span_histogram
+from spectral_stats import NUM_LEVELS, SpectralReducer
+
+# Default bound on the memory used by one strip of tiles, in bytes.
+MEMORY_BUDGET = 256 * 2**20
+
+# Bytes of temporaries per pixel of a tile (span, gain and dead pixel maps of
+# the FFC, and its uint32 product).
+TILE_BYTES_PER_PIXEL = 16
+
+class MappedArray:
+    """
+    A memory-mapped .npy or raw file whose pages can be dropped from the
+    process once they have been processed. Pages of a file mapping count
+    towards the resident set size until the kernel reclaims them, so without
+    release() a pass over a file larger than memory would grow to the file size.
+
+    Parameters:
+    - path: str
+        Path to a .npy file, or to a raw file of the given shape and dtype.
+    - shape: tuple, optional
+        Shape of a raw file. Ignored for .npy files.
+    - dtype: numpy.dtype
+        Element type of a raw file. Ignored for .npy files.
+    - writable: bool
+        Map the file for writing. Writes go straight to the file.
+    """
+
+    def __init__(self, path, shape=None, dtype=np.uint8, writable=False):
+        self.path = path
+        self._file = open(path, "r+b" if writable else "rb")
+
+        offset = 0
+        if path.endswith(".npy"):
+            shape, dtype = read_npy_header(self._file, path)
+            offset = self._file.tell()
+        elif shape is None:
+            raise ValueError(f"The shape of raw file {path} is required.")
+
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=access)
+        self._offset = offset
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self._mmap, offset=offset)
+
+    @classmethod
+    def create(cls, path, shape, dtype=np.uint8):
+        """
+        Creates a zero-filled .npy file (sparse where supported) and maps it for writing.
+        """
+        np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape).flush()
+        return cls(path, writable=True)
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def release_rows(self, start, stop):
+        """
+        Drops the pages of rows start:stop of the last two axes (of every
+        leading index, e.g. every band) from the process. Written pages stay
+        in the page cache and are written back to the file by the kernel.
+        """
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        *lead, height, width = self.array.shape
+        row_bytes = width * self.array.itemsize
+        plane_bytes = height * row_bytes
+        for index in range(int(np.prod(lead, dtype=np.int64))):
+            begin = self._offset + index * plane_bytes + start * row_bytes
+            end = self._offset + index * plane_bytes + stop * row_bytes
+            # madvise needs a page aligned start. Dropping the shared page of the
+            # previous rows is harmless, it is read back from the file if needed.
+            begin -= begin % mmap.PAGESIZE
+            if end > begin:
+                self._mmap.madvise(mmap.MADV_DONTNEED, begin, end - begin)
+
+    def flush(self):
+        if self._mmap is not None and not self._mmap.closed:
+            self._mmap.flush()
+
+    def close(self):
+        self.flush()
+        self.array = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Views of the array are still alive; the mapping closes with them.
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_mosaic(path, shape=None):
+    """
+    Maps a (stitched) RAW8 mosaic for reading: a 2D uint8 .npy file, or a raw
+    file of the given (height, width).
+    """
+    mosaic = MappedArray(path, shape, np.uint8)
+    if mosaic.array.ndim != 2 or mosaic.array.dtype != np.uint8:
+        raise ValueError(f"Expected a 2D uint8 mosaic, got {mosaic.array.dtype} {mosaic.shape}: {path}")
+    return mosaic
+
+def stitched_layout(shape, layout=XIMEA_NIR_5X5):
+    """
+    Returns the layout of a stitched mosaic of the given (height, width),
+    made of frames of layout that keep its mosaic phase. The crop origin is
+    kept and the crop shape extended to the whole mosaic patterns that fit.
+    """
+    row, col = layout.crop_origin
+    p = layout.pattern_size
+    height = (shape[0] - row) // p * p
+    width = (shape[1] - col) // p * p
+    if height <= 0 or width <= 0:
+        raise ValueError(f"Mosaic of shape {shape} is smaller than one {p}x{p} pattern.")
+    return replace(layout, name=f"{layout.name}_{shape[1]}x{shape[0]}", crop_shape=(height, width))
+
+@lru_cache(maxsize=64)
+def _tile_layout(layout, block_rows, block_cols):
+    # Layout of a tile cut at a pattern boundary, so it has no crop offset.
+    p = layout.pattern_size
+    return replace(layout, crop_origin=(0, 0), crop_shape=(block_rows * p, block_cols * p))
+
+def strip_block_rows(layout, num_inputs=1, memory_budget=MEMORY_BUDGET, tile_block_cols=256, workers=1):
+    """
+    Returns the number of block rows processed per strip so that the pages of
+    one strip of every input and of the hypercube output, plus the tile
+    temporaries of every worker, fit in memory_budget. At least one block row.
+
+    The kernel can map the page cache in folios of up to 2 MB, so a strip may
+    keep up to that much more resident per band plane and input while it is
+    processed. This is bounded and does not grow with the mosaic height.
+    """
+    p = layout.pattern_size
+    block_cols = layout.block_shape[1]
+    # Per block row: p raw rows of every input, and one row of every band.
+    row_bytes = p * p * block_cols * (num_inputs + 1)
+    tile_bytes = workers * p * p * min(tile_block_cols, block_cols) * TILE_BYTES_PER_PIXEL
+    return max(1, int(memory_budget // (row_bytes + tile_bytes)))
+
+def _tile_grid(layout, rows_per_strip, tile_block_cols):
+    # Yields the strips of tiles as lists of (by1, by2, bx1, bx2) block bounds.
+    block_rows, block_cols = layout.block_shape
+    for by1 in range(0, block_rows, rows_per_strip):
+        by2 = min(by1 + rows_per_strip, block_rows)
+        yield [(by1, by2, bx1, min(bx1 + tile_block_cols, block_cols))
+               for bx1 in range(0, block_cols, tile_block_cols)]
+
+def _raw_rows(layout, by1, by2):
+    row = layout.crop_origin[0]
+    return row + by1 * layout.pattern_size, row + by2 * layout.pattern_size
+
+def _raw_tile(array, layout, tile):
+    by1, by2, bx1, bx2 = tile
+    row, col = layout.crop_origin
+    p = layout.pattern_size
+    return array[row + by1 * p:row + by2 * p, col + bx1 * p:col + bx2 * p]
+
+def _run_strips(layout, process_tile, mapped, num_inputs, workers, memory_budget, tile_block_cols):
+    # Processes the tiles of each strip in parallel and yields their results,
+    # then drops the pages of the strip from every mapped file before moving on.
+    rows_per_strip = strip_block_rows(layout, num_inputs, memory_budget, tile_block_cols, workers or os.cpu_count())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for strip in _tile_grid(layout, rows_per_strip, tile_block_cols):
+            yield list(pool.map(process_tile, strip))
+            by1, by2 = strip[0][:2]
+            for array, is_mosaic in mapped:
+                start, stop = _raw_rows(layout, by1, by2) if is_mosaic else (by1, by2)
+                array.release_rows(start, stop)
+
+def ffc_parameters(flat, dark, memory_budget=MEMORY_BUDGET):
+    """
+    Returns the FFC brightness scale, mean(flat - dark), and the fixed-point
+    shift of mapped stitched flat and dark fields, computed in strips of
+    rows from their span_histogram. Both must be those of the whole
+    mosaic for the tiles to be corrected exactly like FFCCorrector(flat, dark).
+
+    Returns:
+    - scale: float
+    - shift: int
+    """
+    height, width = flat.shape
+    rows = max(1, int(memory_budget // (4 * width)))
+    total = 0
+    span_counts = np.zeros(256, dtype=np.int64)
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        span = flat.array[start:stop].astype(np.int16) - dark.array[start:stop]
+        total += int(span.sum(dtype=np.int64))
+        span_counts += span_histogram(flat.array[start:stop], dark.array[start:stop])
+        flat.release_rows(start, stop)
+        dark.release_rows(start, stop)
+    scale = total / (height * width)
+    if not scale > 0:
+        raise ValueError(f"The FFC scale must be positive, got {scale}.")
+    return scale, fixed_point_shift_for_spans(span_counts, scale)
+
+def tiled_demosaic(mosaic_path, output_path, shape=None, layout=XIMEA_NIR_5X5, sort_bands=True,
+                   flat_path=None, dark_path=None, workers=None, memory_budget=MEMORY_BUDGET,
+                   tile_block_cols=256):
+    """
+    Demosaics a stitched RAW8 mosaic of any size into a hypercube .npy file,
+    optionally flat field corrected, with bounded memory. The mosaic is cut
+    into tiles aligned to the mosaic pattern (starting at the layout's crop
+    origin), tiles are demosaiced by a pool of threads straight into the
+    memory-mapped output, and the pages of every strip of tiles are dropped
+    once it is done, so the resident memory depends on memory_budget and the
+    mosaic width, not on its height.
+
+    Parameters:
+    - mosaic_path: str
+        2D uint8 .npy file, or raw file of the given shape.
+    - output_path: str
+        Path of the hypercube .npy file to write.
+    - shape: tuple, optional
+        (height, width) of raw input files.
+    - layout: MosaicLayout
+        Layout of the frames the mosaic was stitched from.
+    - sort_bands: bool
+        Order the bands by ascending wavelength.
+    - flat_path, dark_path: str, optional
+        Stitched flat and dark fields of the same shape as the mosaic. When
+        given, each tile is corrected with the gain map of the whole mosaic
+        (brightness scale and fixed-point shift), so the result does not
+        depend on the tiles, before demosaicing.
+    - workers: int, optional
+        Number of threads (default: number of CPUs).
+    - memory_budget: int
+        Approximate bound on the bytes in use per strip.
+    - tile_block_cols: int
+        Width of a tile, in mosaic patterns.
+
+    Returns:
+    - layout: MosaicLayout
+        The layout of the stitched mosaic (see stitched_layout).
+    """
+
+    mosaic = open_mosaic(mosaic_path, shape)
+    full_layout = stitched_layout(mosaic.shape, layout)
+    output = MappedArray.create(output_path, full_layout.output_shape)
+    mapped = [(mosaic, True), (output, False)]
+
+    flat = dark = None
+    if flat_path is not None:
+        flat, dark = open_mosaic(flat_path, shape), open_mosaic(dark_path, shape)
+        if flat.shape != mosaic.shape or dark.shape != mosaic.shape:
+            raise ValueError("Flat field/dark field mosaic dimensions do not match.")
+        scale, shift = ffc_parameters(flat, dark, memory_budget)
+        # Gain of every flat - dark span, so tiles look their gains up.
+        gains = gain_table(scale, shift)
+        mapped += [(flat, True), (dark, True)]
+
+    def process_tile(tile):
+        by1, by2, bx1, bx2 = tile
+        tile_layout = _tile_layout(layout, by2 - by1, bx2 - bx1)
+        raw = _raw_tile(mosaic.array, full_layout, tile)
+        if flat is not None:
+            dark_tile = _raw_tile(dark.array, full_layout, tile)
+            span = _raw_tile(flat.array, full_layout, tile).astype(np.int16) - dark_tile
+            np.maximum(span, 0, out=span)
+            tile_gains = gains[span]
+            corrector = FFCCorrector.from_maps(dark_tile, tile_gains, shift, scale, tile_gains == 0)
+            raw = corrector.apply(raw)
+        demosaic_array(raw, tile_layout, sort_bands, out=output.array[:, by1:by2, bx1:bx2])
+
+    try:
+        for _ in _run_strips(full_layout, process_tile, mapped, len(mapped) - 1, workers, memory_budget,
+                             tile_block_cols):
+            pass
+    finally:
+        for array, _ in mapped:
+            array.close()
+    return full_layout
+
+def tiled_band_histograms(path, shape=None, layout=XIMEA_NIR_5X5, sort_bands=True, workers=None,
+                          memory_budget=MEMORY_BUDGET, tile_block_cols=256):
+    """
+    Computes the per-band intensity histograms of a stitched RAW8 mosaic (2D)
+    or of a hypercube .npy file written by tiled_demosaic (3D), tile by tile.
+    Mosaics are read through the strided band view, without demosaicing.
+
+    Returns:
+    - histograms: numpy.ndarray
+        int64 array of shape (num_bands, 256), e.g. for
+        SpectralReducer.update_histograms or spectral_stats.summarize_histograms.
+    """
+
+    source = MappedArray(path, shape, np.uint8)
+    is_mosaic = source.array.ndim == 2
+    if is_mosaic:
+        full_layout = stitched_layout(source.shape, layout)
+        order = layout.sort_order if sort_bands else np.arange(layout.num_bands)
+    else:
+        num_bands, block_rows, block_cols = source.shape
+        p = layout.pattern_size
+        full_layout = replace(layout, crop_origin=(0, 0), crop_shape=(block_rows * p, block_cols * p))
+        order = np.arange(num_bands)
+
+    def process_tile(tile):
+        by1, by2, bx1, bx2 = tile
+        if is_mosaic:
+            tile_layout = _tile_layout(layout, by2 - by1, bx2 - bx1)
+            view = mosaic_band_view(_raw_tile(source.array, full_layout, tile), tile_layout)
+            bands = view.reshape(layout.num_bands, by2 - by1, bx2 - bx1)
+        else:
+            bands = source.array[:, by1:by2, bx1:bx2]
+        histograms = np.empty((len(bands), NUM_LEVELS), dtype=np.int64)
+        for band, values in enumerate(bands):
+            histograms[band] = np.bincount(values.ravel(), minlength=NUM_LEVELS)
+        return histograms
+
+    histograms = np.zeros((len(order), NUM_LEVELS), dtype=np.int64)
+    try:
+        for strip in _run_strips(full_layout, process_tile, [(source, is_mosaic)], 0, workers,
+                                 memory_budget, tile_block_cols):
+            histograms += np.sum(strip, axis=0)
+    finally:
+        source.close()
+    return histograms[order]
+
+def main():
+    parser = argparse.ArgumentParser(description="Demosaic and summarize stitched mosaics larger than memory.")
+    parser.add_argument("mosaic", help="Stitched RAW8 mosaic (2D uint8 .npy, or raw file with --shape).")
+    parser.add_argument("--shape", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"), help="Shape of a raw mosaic file.")
+    parser.add_argument("--output", help="Hypercube .npy file to write.")
+    parser.add_argument("--flat", help="Stitched flat field, to apply FFC.")
+    parser.add_argument("--dark", help="Stitched dark field, to apply FFC.")
+    parser.add_argument("--layout", default=XIMEA_NIR_5X5.name, help="Layout name or calibration file.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker threads.")
+    parser.add_argument("--memory", type=int, default=MEMORY_BUDGET // 2**20, help="Memory budget in MB.")
+    args = parser.parse_args()
+
+    if bool(args.flat) != bool(args.dark):
+        parser.error("--flat and --dark must be given together.")
+
+    layout = get_layout(args.layout)
+    shape = tuple(args.shape) if args.shape else None
+    memory_budget = args.memory * 2**20
+
+    source = args.mosaic
+    if args.output:
+        full_layout = tiled_demosaic(args.mosaic, args.output, shape, layout, flat_path=args.flat,
+                                     dark_path=args.dark, workers=args.workers, memory_budget=memory_budget)
+        print(f"Wrote {full_layout.output_shape} hypercube to {args.output}")
+        source = args.output
+
+    reducer = SpectralReducer(layout.num_bands)
+    reducer.update_histograms(tiled_band_histograms(source, shape, layout, workers=args.workers,
+                                                    memory_budget=memory_budget))
+    stats = reducer.result()
+    for wavelength, mean, std in zip(layout.band_wavelengths(), stats["mean"], stats["std"]):
+        print(f"{wavelength} nm: mean {mean:7.2f}, std {std:7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,287 @@
 # Hayden Feddock
 # 1/29/2025
 
-import cv2
+import os
+import json
+from dataclasses import dataclass
+from functools import cached_property, lru_cache
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+import profiling
+from decode import read_raw8
+
+@dataclass(frozen=True)
+class MosaicLayout:
+    """
+    Immutable description of a snapshot mosaic sensor. Everything the 
+    demosaic hot path needs (crop window, block shape, band order) is 
+    derived once from these fields and cached on the instance.
+
+    Attributes:
+    - name: str
+        Identifier of the sensor layout.
+    - pattern_size: int
+        Size of the repeating square mosaic pattern (e.g. 5 for 5x5).
+    - crop_origin: tuple of int
+        (row, col) of the top left pixel of the mosaic on the raw frame.
+    - crop_shape: tuple of int
+        (height, width) of the mosaic area, both divisible by pattern_size.
+    - wavelengths: tuple of tuple of int
+        Wavelength (nm) of each offset in the mosaic pattern, row by row.
+    """
+
+    name: str
+    pattern_size: int
+    crop_origin: tuple
+    crop_shape: tuple
+    wavelengths: tuple
+
+    def __post_init__(self):
+        # Normalize the fields so layouts loaded from files compare and hash equal.
+        object.__setattr__(self, "crop_origin", tuple(int(v) for v in self.crop_origin))
+        object.__setattr__(self, "crop_shape", tuple(int(v) for v in self.crop_shape))
+        object.__setattr__(self, "wavelengths", tuple(tuple(int(v) for v in row) for row in self.wavelengths))
+
+        if len(self.wavelengths) != self.pattern_size or any(len(row) != self.pattern_size for row in self.wavelengths):
+            raise ValueError(f"Layout {self.name}: wavelengths must be a {self.pattern_size}x{self.pattern_size} table.")
+        if self.crop_shape[0] % self.pattern_size != 0 or self.crop_shape[1] % self.pattern_size != 0:
+            raise ValueError(f"Layout {self.name}: cropped dimensions are not divisible by {self.pattern_size}.")
+
+    @property
+    def num_bands(self):
+        return self.pattern_size * self.pattern_size
+
+    @property
+    def block_shape(self):
+        """(height, width) of a single band."""
+        return (self.crop_shape[0] // self.pattern_size, self.crop_shape[1] // self.pattern_size)
+
+    @property
+    def output_shape(self):
+        """Shape of the hypercube of a single frame, (num_bands, height, width)."""
+        return (self.num_bands, *self.block_shape)
+
+    @cached_property
+    def crop_slices(self):
+        row, col = self.crop_origin
+        height, width = self.crop_shape
+        return (slice(row, row + height), slice(col, col + width))
+
+    @cached_property
+    def sort_order(self):
+        """Row-major mosaic indices of the bands in ascending wavelength order."""
+        return np.argsort(np.ravel(self.wavelengths), kind="stable")
+
+    @cached_property
+    def sorted_offsets(self):
+        """Mosaic (row, col) offsets of the bands in ascending wavelength order."""
+        return tuple(divmod(int(index), self.pattern_size) for index in self.sort_order)
+
+    @cached_property
+    def mosaic_offsets(self):
+        """Mosaic (row, col) offsets of the bands in row-major mosaic order."""
+        return tuple(divmod(index, self.pattern_size) for index in range(self.num_bands))
+
+    def band_wavelengths(self, sort_bands=True):
+        """
+        Returns the wavelength of each band along the band axis of the hypercube.
+        """
+        wavelengths = np.ravel(self.wavelengths)
+        return wavelengths[self.sort_order] if sort_bands else wavelengths
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "pattern_size": self.pattern_size,
+            "crop_origin": list(self.crop_origin),
+            "crop_shape": list(self.crop_shape),
+            "wavelengths": [list(row) for row in self.wavelengths],
+        }
+
+    def save(self, path):
+        """
+        Saves the layout as a JSON or NPZ calibration file, chosen by extension.
+        """
+        if path.endswith(".npz"):
+            np.savez(path, **self.to_dict())
+        else:
+            with open(path, "w") as f:
+                json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Loads a layout from a JSON or NPZ calibration file with the fields of to_dict.
+        """
+        if path.endswith(".npz"):
+            with np.load(path) as data:
+                fields = {key: data[key].tolist() for key in data.files}
+        else:
+            with open(path) as f:
+                fields = json.load(f)
+        return cls(**fields)
+
+# The Ximea multispectral NIR camera. The mosaic starts in the top left corner 
+# at x = 0, y = 3 and ends at x = 2044, y = 1082, so the cropped image is 2045 x 1080.
+XIMEA_NIR_5X5 = MosaicLayout(
+    name="ximea_nir_5x5",
+    pattern_size=5,
+    crop_origin=(3, 0),
+    crop_shape=(1080, 2045),
+    wavelengths=(
+        (886, 896, 877, 867, 951),
+        (793, 806, 782, 769, 675),
+        (743, 757, 730, 715, 690),
+        (926, 933, 918, 910, 946),
+        (846, 857, 836, 824, 941),
+    ),
+)
+
+LAYOUTS = {XIMEA_NIR_5X5.name: XIMEA_NIR_5X5}
+
+@lru_cache(maxsize=None)
+def get_layout(layout):
+    """
+    Returns a mosaic layout by name or calibration file path. Layouts loaded 
+    from files are cached, so each sensor is only parsed once per process.
+
+    Parameters:
+    - layout: str
+        Name of a layout in LAYOUTS, or path to a JSON/NPZ calibration file.
+
+    Returns:
+    - layout: MosaicLayout
+    """
+
+    if layout in LAYOUTS:
+        return LAYOUTS[layout]
+    if os.path.isfile(layout):
+        return MosaicLayout.from_file(layout)
+    raise KeyError(f"Unknown mosaic layout: {layout}")
+
+def load_raw8_image(image_path, out=None):
+    """
+    Reads a RAW8 mosaic image from disk as a 2D uint8 array.
+
+    Parameters:
+    - image_path: str
+        Path to the input mosaic image (PNG, TIFF, .npy or raw .bin).
+    - out: numpy.ndarray, optional
+        uint8 array of the image shape to decode into, reused across frames.
+
+    Returns:
+    - image: numpy.ndarray
+        The grayscale (RAW8) image of shape (height, width).
+    """
+    return read_raw8(image_path, out)
+
+def mosaic_band_view(image, layout=XIMEA_NIR_5X5):
+    """
+    Returns a zero-copy view of a mosaic image (or a stack of them) split 
+    into its mosaic offsets. The crop is applied to the last two axes, then 
+    each frame is reshaped and transposed, e.g. for the 5x5 NIR sensor from 
+    (216, 5, 409, 5) to (5, 5, 216, 409), so no pixel data is copied.
+
+    Parameters:
+    - image: numpy.ndarray
+        A RAW8 mosaic of shape (height, width), or a stack of shape (N, height, width).
+    - layout: MosaicLayout
+        Layout of the sensor that captured the image.
+
+    Returns:
+    - view: numpy.ndarray
+        A strided view of shape (..., p, p, block_rows, block_cols), where
+        view[..., row_offset, col_offset] is the band at that mosaic offset.
+    """
+
+    crop_rows, crop_cols = layout.crop_slices
+    block_rows, block_cols = layout.block_shape
+    p = layout.pattern_size
+
+    # (..., block_rows, p, block_cols, p) -> (..., p, p, block_rows, block_cols)
+    cropped_image = image[..., crop_rows, crop_cols]
+    *lead, cropped_height, cropped_width = cropped_image.shape
+    if (cropped_height, cropped_width) != layout.crop_shape:
+        row, col = layout.crop_origin
+        raise ValueError(f"Layout {layout.name} expects a {layout.crop_shape[0]}x{layout.crop_shape[1]} mosaic at "
+                         f"({row}, {col}), but the {image.shape[-2]}x{image.shape[-1]} image only has "
+                         f"{cropped_height}x{cropped_width} pixels there.")
+    blocks = cropped_image.reshape(*lead, block_rows, p, block_cols, p)
+    n = len(lead)
+    return blocks.transpose(*range(n), n + 1, n + 3, n, n + 2)
+
+def demosaic_array(image, layout=XIMEA_NIR_5X5, sort_bands=True, out=None):
+    """
+    Demosaics a mosaic image (or a stack of them) directly into a hypercube 
+    array. The bands are copied once out of the strided view returned by 
+    mosaic_band_view, in the layout's precomputed band order.
+
+    Parameters:
+    - image: str or numpy.ndarray
+        Path to the input mosaic image, a RAW8 mosaic of shape (height, width), 
+        or a stack of mosaics of shape (N, height, width).
+    - layout: MosaicLayout
+        Layout of the sensor that captured the image.
+    - sort_bands: bool
+        If True, the bands are ordered by ascending wavelength, otherwise they 
+        are in row-major mosaic order.
+    - out: numpy.ndarray, optional
+        Preallocated output of the returned shape. Reusing it across calls 
+        avoids allocating a new hypercube for every frame.
+
+    Returns:
+    - hypercube: numpy.ndarray
+        An array of shape layout.output_shape, or (N, *layout.output_shape) 
+        for a stack of mosaics.
+    """
+
+    if isinstance(image, str):
+        image = load_raw8_image(image)
+
+    view = mosaic_band_view(image, layout)
+    shape = (*view.shape[:-4], *layout.output_shape)
+    if out is None:
+        out = np.empty(shape, dtype=view.dtype)
+    elif out.shape != shape:
+        raise ValueError(f"Output shape {out.shape} does not match hypercube shape {shape}.")
+
+    offsets = layout.sorted_offsets if sort_bands else layout.mosaic_offsets
+
+    # Copy band by band, frame by frame, so each copy stays cache friendly.
+    frame_views = view.reshape(-1, *view.shape[-4:])
+    frame_outs = out.reshape(-1, *layout.output_shape)
+    with profiling.stage("demosaic", out.nbytes):
+        for frame_view, frame_out in zip(frame_views, frame_outs):
+            for band, (row_offset, col_offset) in enumerate(offsets):
+                np.copyto(frame_out[band], frame_view[row_offset, col_offset])
+
+    return out
+
+def demosaic_ximea_5x5_array(image, sort_bands=True, out=None):
+    """
+    Demosaics a Ximea 5x5 NIR mosaic image (or a stack of them) into a 
+    hypercube array of shape (25, 216, 409), or (N, 25, 216, 409) for a stack.
+    See demosaic_array.
+    """
+    return demosaic_array(image, XIMEA_NIR_5X5, sort_bands, out)
+
+def band_wavelengths(sort_bands=True, layout=XIMEA_NIR_5X5):
+    """
+    Returns the bandwidth (nm) of each band along the band axis of the 
+    hypercube produced by demosaic_array.
+
+    Parameters:
+    - sort_bands: bool
+        Must match the value passed to demosaic_array.
+    - layout: MosaicLayout
+        Layout of the sensor.
+
+    Returns:
+    - wavelengths: numpy.ndarray
+        A 1D array of layout.num_bands bandwidths.
+    """
+    return layout.band_wavelengths(sort_bands)
 
 def demosaic_ximea_5x5(image_path, sort_bands=True):
     """
@@ -20,9 +298,12 @@ def demosaic_ximea_5x5(image_path, sort_bands=True):
         Row 3: 926, 933, 918, 910, 946
         Row 4: 846, 857, 836, 824, 941
 
+    This is a thin wrapper around mosaic_band_view. Prefer 
+    demosaic_ximea_5x5_array when a hypercube array is needed.
+
     Parameters:
-    - image_path: str
-        Path to the input mosaic image.
+    - image_path: str or numpy.ndarray
+        Path to the input mosaic image, or an already loaded RAW8 mosaic.
 
     Returns:
     - hypercube_dict: dict
@@ -30,54 +311,20 @@ def demosaic_ximea_5x5(image_path, sort_bands=True):
         corresponding 2D numpy.ndarray (of shape (height/5, width/5)) for that spectral band.
     """
 
-    # Read the image in grayscale (RAW8 format)
-    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-    if image is None:
-        raise FileNotFoundError(f"Image not found or unable to read: {image_path}")
-
-    # Crop the image.
-    # Rows: 3 to 1082 (inclusive) -> 1080 rows; Columns: 0 to 2044 (inclusive) -> 2045 columns.
-    cropped_image = image[3:1083, 0:2045]
+    if isinstance(image_path, str):
+        image = load_raw8_image(image_path)
+    else:
+        image = image_path
 
-    # Get the dimensions of the cropped image.
-    cropped_height, cropped_width = cropped_image.shape
+    layout = XIMEA_NIR_5X5
+    view = mosaic_band_view(image, layout)
+    offsets = layout.sorted_offsets if sort_bands else layout.mosaic_offsets
 
-    # Ensure that the cropped dimensions are divisible by 5.
-    if cropped_height % 5 != 0 or cropped_width % 5 != 0:
-        raise ValueError("Cropped image dimensions are not divisible by 5.")
-
-    block_rows = cropped_height // 5  # e.g., 1080 / 5 = 216
-    block_cols = cropped_width // 5   # e.g., 2045 / 5 = 409
-
-    # Define the bandwidth keys as a 5x5 array.
-    bandwidth_keys = [
-        [886, 896, 877, 867, 951],
-        [793, 806, 782, 769, 675],
-        [743, 757, 730, 715, 690],
-        [926, 933, 918, 910, 946],
-        [846, 857, 836, 824, 941]
-    ]
-
-    # Create a dictionary to store the hypercube channels keyed by bandwidth.
+    # Each value is a strided view into the image, as before.
     hypercube_dict = {}
-
-    # Loop over each offset in the 5x5 mosaic pattern.
-    for row_offset in range(5):
-        for col_offset in range(5):
-            # Extract the spectral band for this offset.
-            band = cropped_image[row_offset::5, col_offset::5]
-            if band.shape != (block_rows, block_cols):
-                raise ValueError(
-                    f"Unexpected shape for band with offset ({row_offset},{col_offset}): "
-                    f"expected ({block_rows}, {block_cols}), got {band.shape}"
-                )
-            # Retrieve the corresponding bandwidth value.
-            key = bandwidth_keys[row_offset][col_offset]
-            hypercube_dict[key] = band
-
-    if sort_bands:
-        # Sort the hypercube channels by bandwidth.
-        hypercube_dict = dict(sorted(hypercube_dict.items()))
+    for row_offset, col_offset in offsets:
+        key = layout.wavelengths[row_offset][col_offset]
+        hypercube_dict[key] = view[row_offset, col_offset]
 
     return hypercube_dict
 
@@ -111,6 +358,7 @@ def hypercube_dict_to_array(hypercube_dict):
 
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
 
     # Path to your mosaic image
     image_path = "fb_images/1737575462_857274124_ximea.jpg"
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from bandmath import BandMath, INDICES, band_math
+from utils import XIMEA_NIR_5X5
+
+@pytest.fixture
+def cube():
+    rng = np.random.default_rng(0)
+    return rng.integers(1, 256, size=(2, *XIMEA_NIR_5X5.output_shape), dtype=np.uint8)
+
+def _band(cube, wavelength, sort_bands=True):
+    index = list(XIMEA_NIR_5X5.band_wavelengths(sort_bands)).index(wavelength)
+    return cube[..., index, :, :].astype(np.float32)
+
+def test_indices_match_numpy(cube):
+    values = BandMath(INDICES).evaluate(cube, chunk_rows=50)
+    b951, b675 = _band(cube, 951), _band(cube, 675)
+    b793, b715 = _band(cube, 793), _band(cube, 715)
+    np.testing.assert_allclose(values[:, 0], b951 / b675, rtol=1e-6)
+    np.testing.assert_allclose(values[:, 1], (b951 - b675) / (b951 + b675), rtol=1e-6, atol=1e-7)
+    np.testing.assert_allclose(values[:, 2], (b793 - b715) / (b793 + b715), rtol=1e-6, atol=1e-7)
+
+def test_operators_functions_and_constants(cube):
+    expression = "-sqrt(abs(b951 - 2 * b675)) + max(b793, b715) ** 0.5 / (1 + 3) - log(exp(1))"
+    b951, b675 = _band(cube[0], 951), _band(cube[0], 675)
+    b793, b715 = _band(cube[0], 793), _band(cube[0], 715)
+    expected = -np.sqrt(np.abs(b951 - 2 * b675)) + np.maximum(b793, b715) ** 0.5 / 4 - 1
+    np.testing.assert_allclose(band_math(expression, cube[0]), expected, rtol=1e-5, atol=1e-5)
+
+def test_constant_band_and_unsorted_results(cube):
+    values = BandMath({"two": "1 + 1", "band": "+b951"}, sort_bands=False).evaluate(cube[0])
+    assert (values[0] == 2).all()
+    assert (values[1] == _band(cube[0], 951, sort_bands=False)).all()
+
+def test_division_by_zero_is_silent():
+    cube = np.zeros(XIMEA_NIR_5X5.output_shape, dtype=np.uint8)
+    values = band_math("b951 / b675", cube)
+    assert np.isnan(values).all()
+
+@pytest.mark.parametrize("expression", ["b123 + b951", "b951 +", "b951 % 2", "sqrt(b951, b675)", "foo(b951)"])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        BandMath(expression)
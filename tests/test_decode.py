@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from decode import read_raw8, read_many
+
+SHAPE = (24, 30)
+CROP = (slice(3, 18), slice(0, 25))
+
+def _frame(seed, shape=SHAPE):
+    return np.random.default_rng(seed).integers(0, 256, size=shape, dtype=np.uint8)
+
+def test_npy_and_raw_round_trip(tmp_path):
+    frame = _frame(0)
+    np.save(tmp_path / "frame.npy", frame)
+    frame.tofile(tmp_path / "frame.bin")
+
+    for name in ("frame.npy", "frame.bin"):
+        path = str(tmp_path / name)
+        assert (read_raw8(path, raw_shape=SHAPE) == frame).all()
+        out = np.empty((15, 25), dtype=np.uint8)
+        assert read_raw8(path, out, CROP, raw_shape=SHAPE) is out
+        assert (out == frame[CROP]).all()
+
+def test_mixed_grayscale_colour_and_sizes_into_reused_buffer(tmp_path):
+    cv2 = pytest.importorskip("cv2")
+    gray = _frame(1)
+    colour = np.random.default_rng(2).integers(0, 256, size=(*SHAPE, 3), dtype=np.uint8)
+    cv2.imwrite(str(tmp_path / "gray.png"), gray)
+    cv2.imwrite(str(tmp_path / "colour.png"), colour)
+    cv2.imwrite(str(tmp_path / "colour.jpg"), colour)
+    cv2.imwrite(str(tmp_path / "large.png"), _frame(3, (SHAPE[0] + 5, SHAPE[1])))
+
+    out = np.empty(SHAPE, dtype=np.uint8)
+    cropped = np.empty((15, 25), dtype=np.uint8)
+    for name in ("colour.png", "gray.png", "colour.jpg", "gray.png"):
+        path = str(tmp_path / name)
+        expected = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        assert read_raw8(path, out) is out
+        assert (out == expected).all()
+        read_raw8(path, cropped, CROP)
+        assert (cropped == expected[CROP]).all()
+
+    # A frame of another size cannot go into the buffer: a ValueError the
+    # callers fall back on, never a cv2.error.
+    with pytest.raises(ValueError):
+        read_raw8(str(tmp_path / "large.png"), out)
+    read_raw8(str(tmp_path / "large.png"), cropped, CROP)
+    read_raw8(str(tmp_path / "gray.png"), out)
+    assert (out == gray).all()
+
+def test_read_many(tmp_path):
+    frames = [_frame(seed) for seed in range(4)]
+    paths = []
+    for index, frame in enumerate(frames):
+        paths.append(str(tmp_path / f"{index}.npy"))
+        np.save(paths[-1], frame)
+
+    assert (read_many(paths, workers=2) == np.stack(frames)).all()
+    assert (read_many(paths, crop=CROP, workers=2) == np.stack(frames)[:, CROP[0], CROP[1]]).all()
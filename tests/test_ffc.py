@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from ffc import FFCCorrector, apply_manual_ffc, gain_table, span_histogram, fixed_point_shift_for_spans
+from utils import XIMEA_NIR_5X5, demosaic_array
+
+SHAPE = (1088, 2048)
+
+@pytest.fixture
+def fields():
+    rng = np.random.default_rng(0)
+    dark = rng.integers(0, 20, size=SHAPE, dtype=np.uint8)
+    flat = rng.integers(120, 250, size=SHAPE, dtype=np.uint8)
+    image = rng.integers(0, 256, size=SHAPE, dtype=np.uint8)
+    return flat, dark, image
+
+def _errors(corrector, image, flat, dark):
+    return np.abs(corrector.apply(image).astype(np.int16) - apply_manual_ffc(image, flat, dark))
+
+def test_matches_float_path(fields):
+    flat, dark, image = fields
+    errors = _errors(FFCCorrector(flat, dark), image, flat, dark)
+    assert errors.max() <= 1
+    assert np.mean(errors > 0) < 0.005
+
+def test_outlier_gain_keeps_precision(fields):
+    flat, dark, image = fields
+    shift = FFCCorrector(flat, dark).shift
+    flat = flat.copy()
+    flat[5, 5] = dark[5, 5] + 1
+    image = image.copy()
+    image[5, 5] = dark[5, 5] + 3
+
+    corrector = FFCCorrector(flat, dark)
+    assert corrector.shift == shift
+    errors = _errors(corrector, image, flat, dark)
+    assert errors.max() <= 1
+    assert np.mean(errors > 0) < 0.005
+    # The outlier saturates like the float path.
+    assert corrector.dead[5, 5]
+    assert corrector.apply(image)[5, 5] == 255
+
+def test_dead_pixels_saturate_above_dark(fields):
+    flat, dark, image = fields
+    flat = flat.copy()
+    flat[0, :4] = dark[0, :4]
+    image = image.copy()
+    image[0, :2] = dark[0, :2] + 10
+    image[0, 2:4] = dark[0, 2:4]
+
+    corrected = FFCCorrector(flat, dark).apply(image)
+    assert list(corrected[0, :4]) == [255, 255, 0, 0]
+    assert list(apply_manual_ffc(image, flat, dark)[0, :4]) == [255, 255, 0, 0]
+
+def test_in_place_stack_and_demosaiced(fields):
+    flat, dark, image = fields
+    corrector = FFCCorrector(flat, dark)
+    expected = corrector.apply(image)
+
+    stack = np.stack([image, image])
+    corrector.apply(stack, out=stack)
+    assert (stack == expected).all()
+
+    cube = demosaic_array(image, XIMEA_NIR_5X5)
+    bands = corrector.demosaiced(XIMEA_NIR_5X5).apply(cube)
+    assert (bands == demosaic_array(expected, XIMEA_NIR_5X5)).all()
+
+def test_gain_table_matches_gain_map(fields):
+    flat, dark, _ = fields
+    flat = flat.copy()
+    flat[5, 5] = dark[5, 5] + 1
+    corrector = FFCCorrector(flat, dark)
+    shift = fixed_point_shift_for_spans(span_histogram(flat, dark), corrector.scale)
+    assert shift == corrector.shift
+
+    span = np.maximum(flat.astype(np.int16) - dark, 0)
+    assert (gain_table(corrector.scale, shift)[span] == corrector.gain).all()
+
+def test_rejects_non_positive_scale(fields):
+    flat, dark, _ = fields
+    with pytest.raises(ValueError):
+        FFCCorrector(dark, flat)
+    with pytest.raises(ValueError):
+        FFCCorrector(flat, dark, scale=0)
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+
+from raw_store import RawFrameStore, FRAMES_FILE, METADATA_FILE, FFC_ID_LENGTH
+
+SHAPE = (16, 20)
+
+def test_append_after_partial_frame(tmp_path):
+    path = str(tmp_path / "store")
+    with RawFrameStore.create(path, SHAPE) as store:
+        store.append(np.full(SHAPE, 1, dtype=np.uint8))
+    # Bytes of a frame whose metadata record was never written (crash).
+    with open(os.path.join(path, FRAMES_FILE), "ab") as f:
+        f.write(bytes([9]) * 16)
+
+    with RawFrameStore(path, mode="a") as store:
+        assert store.append(np.full(SHAPE, 2, dtype=np.uint8)) == 1
+
+    store = RawFrameStore(path)
+    assert len(store) == 2
+    assert (store[0] == 1).all()
+    assert (store[1] == 2).all()
+    assert os.path.getsize(os.path.join(path, FRAMES_FILE)) == 2 * SHAPE[0] * SHAPE[1]
+
+def test_partial_metadata_record_is_dropped(tmp_path):
+    path = str(tmp_path / "store")
+    with RawFrameStore.create(path, SHAPE) as store:
+        store.append(np.full(SHAPE, 1, dtype=np.uint8), ffc_id="a")
+    with open(os.path.join(path, METADATA_FILE), "ab") as f:
+        f.write(b"\x00" * 5)
+
+    with RawFrameStore(path, mode="a") as store:
+        store.append(np.full(SHAPE, 2, dtype=np.uint8), ffc_id="b")
+
+    store = RawFrameStore(path)
+    assert list(store.metadata["ffc_id"]) == [b"a", b"b"]
+    assert (store[1] == 2).all()
+
+def test_ffc_id_too_long(tmp_path):
+    path = str(tmp_path / "store")
+    with RawFrameStore.create(path, SHAPE) as store:
+        store.append(np.zeros(SHAPE, dtype=np.uint8), ffc_id="x" * FFC_ID_LENGTH)
+        with pytest.raises(ValueError):
+            store.append(np.zeros(SHAPE, dtype=np.uint8), ffc_id="x" * (FFC_ID_LENGTH + 1))
+    assert len(RawFrameStore(path)) == 1